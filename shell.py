@@ -1,18 +1,3724 @@
 import os
+import posixpath
 import cmd
 import shlex
 import subprocess
 import readline
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 import signal
 import tempfile
 import atexit
 import glob  
 import shutil
 import getpass
+import pwd
+import grp
 import paramiko
+import sys
+import codecs
+import threading
+import re
+import fcntl
+import time
+import sqlite3
+from contextlib import closing, ExitStack, contextmanager, redirect_stdout, redirect_stderr
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import itertools
+import operator
+import heapq
+import functools
+import queue
+import multiprocessing
+import fnmatch
+import hashlib
+import mmap
+import stat
+import errno
+import ctypes
+import ctypes.util
+import struct
+import select
+import zlib
+import io
+import gzip
+import lzma
+import tarfile
+import zipfile
+from array import array
+
+CHUNK_SIZE = 64 * 1024
+HISTORY_LIMIT = 1000
+HISTORY_BATCH_SIZE = 50
+HISTORY_FLUSH_INTERVAL = 5.0
+HISTORY_SEARCH_LIMIT = 50
+FIND_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+INDEX_VERIFY_INTERVAL = 5.0
+FIND_OPTIONS = ('-name', '-iname', '-regex', '-type', '-size', '-mtime', '-maxdepth', '-prune', '-limit')
+GREP_WORKERS = os.cpu_count() or 1
+LISTING_CACHE_SIZE = 128
+SSH_KEEPALIVE = 30
+SSH_IDLE_TIMEOUT = 600
+SSH_CONNECT_TIMEOUT = 10
+PEXEC_CONCURRENCY = 32
+PEXEC_TIMEOUT = 60
+SFTP_WORKERS = 4
+SFTP_REQUESTS = 128
+SFTP_WINDOW_SIZE = 16 * 1024 * 1024
+SFTP_PACKET_SIZE = 64 * 1024
+HASH_WORKERS = os.cpu_count() or 1
+HASH_ALGORITHMS = ('sha256', 'sha1', 'sha512', 'md5', 'blake2b')
+DUPES_ALGORITHM = 'sha256'
+DUPES_PREFIX_SIZE = 64 * 1024
+WC_CHUNK_SIZE = 16 * 1024 * 1024
+SORT_BUFFER_SIZE = 512 * 1024 * 1024
+SORT_WORKERS = os.cpu_count() or 1
+SORT_MERGE_WIDTH = 64
+SORT_FIELD = re.compile(rb'[ \t]*[^ \t]+')
+SORT_NUMBER = re.compile(rb'\s*([-+]?(?:\d+\.?\d*|\.\d+))')
+FOLLOW_POLL_INTERVAL = 1.0
+FOLLOW_FILE_EVENTS = 0x2 | 0x4 | 0x400 | 0x800          # IN_MODIFY | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF
+FOLLOW_DIRECTORY_EVENTS = 0x100 | 0x80                  # IN_CREATE | IN_MOVED_TO
+COPY_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+COPY_RANGE_SIZE = 1 << 30
+COPY_FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL, errno.ETXTBSY)
+REMOVE_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+REMOVE_OPEN_DIRECTORIES = 256
+SYNC_BLOCK_SIZE = 128 * 1024
+SYNC_DELTA_MIN = 4 * 1024 * 1024
+DU_TOP = 20
+COMPRESS_WORKERS = os.cpu_count() or 1
+COMPRESS_BLOCK_SIZE = 1024 * 1024
+COMPRESS_LEVEL = 6
+GZIP_INDEX_SUFFIX = '.idx'
+GZIP_INDEX_HEADER = struct.Struct('<8sQQ')                # magic, block size, uncompressed size
+GZIP_INDEX_MAGIC = b'GZBLKIX1'
+XZ_BLOCK_SIZE = 24 * 1024 * 1024                       # three dictionaries at preset 6, as xz -T does
+ARCHIVE_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+ARCHIVE_FORMATS = (('.tar.gz', 'gz'), ('.tgz', 'gz'), ('.tar.xz', 'xz'), ('.txz', 'xz'), ('.tar', 'tar'), ('.zip', 'zip'))
+SIZE_UNITS = {'': 1, 'c': 1, 'k': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def has_fileno(stream):
+    """Return True if the stream is backed by an OS file descriptor."""
+    try:
+        stream.fileno()
+        return True
+    except (AttributeError, OSError, ValueError):
+        return False
+
+
+def to_bytes(data):
+    """Encode text input for a child process; bytes and None pass through."""
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    return data
+
+
+def feed_stdin(pipe, data):
+    """Write data to a child's stdin and close it."""
+    try:
+        pipe.write(data)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
 
+def tail_offset(file, count, block_size=CHUNK_SIZE):
+    """Return the offset at which the last count lines of a binary file start.
+
+    The file is read backwards in blocks from the end, so the cost depends
+    on the size of the tail rather than of the file.
+    """
+    position = file.seek(0, os.SEEK_END)
+    if count <= 0:
+        return position
+    if position:
+        file.seek(position - 1)
+        if file.read(1) == b'\n':
+            # A trailing newline ends the last line rather than starting one.
+            position -= 1
+    while position > 0:
+        step = min(block_size, position)
+        position -= step
+        file.seek(position)
+        block = file.read(step)
+        index = len(block)
+        while True:
+            index = block.rfind(b'\n', 0, index)
+            if index == -1:
+                break
+            count -= 1
+            if count == 0:
+                return position + index + 1
+    return 0
+
+
+def head_length(file, count, block_size=CHUNK_SIZE):
+    """Return the number of bytes taken by the first count lines of a binary file."""
+    length = 0
+    while count > 0:
+        block = file.read(block_size)
+        if not block:
+            break
+        index = -1
+        while count > 0:
+            index = block.find(b'\n', index + 1)
+            if index == -1:
+                break
+            count -= 1
+        length += len(block) if index == -1 else index + 1
+    return length
+
+
+class Inotify:
+    """Minimal ctypes wrapper around the Linux inotify API."""
 
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+
+    def add_watch(self, path, mask):
+        """Watch a path for the events in mask and return the watch descriptor."""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code), path)
+        return wd
+
+    def remove_watch(self, wd):
+        """Stop watching a watch descriptor."""
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Return the pending events as (wd, mask, name) tuples."""
+        try:
+            data = os.read(self.fd, CHUNK_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+            events.append((wd, mask, os.fsdecode(name)))
+            offset += 16 + length
+        return events
+
+    def close(self):
+        """Close the inotify descriptor, removing all watches."""
+        os.close(self.fd)
+
+
+class FollowedFile:
+    """One file followed by follow_files, reopened when it is rotated."""
+
+    def __init__(self, path, prefix):
+        self.path = path
+        self.prefix = prefix
+        self.file = None
+        self.identity = None
+        self.position = 0
+        self.partial = b''
+        self.wd = None
+
+    def open(self, lines, inotify=None):
+        """Open the path if it exists, showing its last lines, and watch it."""
+        try:
+            self.file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        info = os.fstat(self.file.fileno())
+        self.identity = (info.st_dev, info.st_ino)
+        self.position = tail_offset(self.file, lines) if lines is not None else 0
+        if inotify is not None:
+            self.wd = inotify.add_watch(self.path, FOLLOW_FILE_EVENTS)
+        self.read_new()
+
+    def close(self, inotify=None):
+        """Close the current file and drop its watch."""
+        if inotify is not None and self.wd is not None:
+            inotify.remove_watch(self.wd)
+        self.wd = None
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+
+    def emit(self, data):
+        """Write complete lines, prefixed with the file name if needed."""
+        data = self.partial + data
+        end = data.rfind(b'\n') + 1
+        self.partial = data[end:]
+        if end and self.prefix:
+            data = b''.join(self.prefix + line for line in data[:end].splitlines(keepends=True))
+            write_output(data)
+        elif end:
+            write_output(data[:end])
+
+    def read_new(self):
+        """Emit the bytes appended since the last read, handling truncation."""
+        if self.file is None:
+            return
+        size = os.fstat(self.file.fileno()).st_size
+        if size < self.position:
+            print(f"{self.path}: file truncated")
+            self.position = 0
+            self.partial = b''
+        while self.position < size:
+            data = os.pread(self.file.fileno(), min(CHUNK_SIZE, size - self.position), self.position)
+            if not data:
+                break
+            self.position += len(data)
+            self.emit(data)
+
+    def check(self, inotify=None):
+        """Read new data and follow the path to a new file if it was replaced."""
+        self.read_new()
+        try:
+            info = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if (info.st_dev, info.st_ino) != self.identity:
+            if self.file is not None:
+                print(f"{self.path}: file replaced, following the new file")
+                if self.partial:
+                    self.emit(b'\n')
+            self.close(inotify)
+            self.open(None, inotify)
+
+
+def follow_files(paths, lines=10):
+    """Print the tail of each file, then new data as it is appended, until Ctrl-C.
+
+    On Linux the loop sleeps in epoll on an inotify descriptor, so it uses
+    no CPU until a followed file or its directory changes; the directory
+    watch catches files that are rotated or created later. Elsewhere the
+    files are polled every FOLLOW_POLL_INTERVAL seconds.
+    """
+    prefix_lines = len(paths) > 1
+    followed = [FollowedFile(path, os.fsencode(path) + b': ' if prefix_lines else b'') for path in paths]
+    try:
+        inotify = Inotify()
+    except (OSError, AttributeError):
+        inotify = None
+    try:
+        directories = {}
+        for item in followed:
+            item.open(lines, inotify)
+            if inotify is not None:
+                directory = os.path.dirname(os.path.abspath(item.path))
+                if directory not in directories.values():
+                    directories[inotify.add_watch(directory, FOLLOW_DIRECTORY_EVENTS)] = directory
+        if inotify is None:
+            while True:
+                time.sleep(FOLLOW_POLL_INTERVAL)
+                for item in followed:
+                    item.check()
+        with select.epoll() as epoll:
+            epoll.register(inotify.fd, select.EPOLLIN)
+            while True:
+                epoll.poll()
+                changed = set()
+                for wd, mask, name in inotify.read_events():
+                    if wd in directories:
+                        changed.update(item for item in followed
+                                       if os.path.abspath(item.path) == os.path.join(directories[wd], name))
+                    else:
+                        changed.update(item for item in followed if item.wd == wd)
+                for item in changed:
+                    item.check(inotify)
+    finally:
+        for item in followed:
+            item.close()
+        if inotify is not None:
+            inotify.close()
+
+
+def read_tail_lines(path, count, block_size=CHUNK_SIZE):
+    """Return the last count lines of a file, reading backwards in blocks."""
+    with open(path, 'rb') as file:
+        file.seek(tail_offset(file, count, block_size))
+        data = file.read()
+    return data.decode('utf-8', errors='replace').splitlines()
+
+
+def write_all(fd, data):
+    """Write all of data to a descriptor, retrying after partial writes."""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def send_to_stdout(fd, offset=0, count=None):
+    """Copy count bytes of fd (or everything) starting at offset to stdout.
+
+    Regular files are sent with os.sendfile, so the data moves inside the
+    kernel without entering the shell. Other files, descriptors sendfile
+    refuses, and a stdout without a descriptor fall back to a CHUNK_SIZE
+    read/write loop.
+    """
+    sys.stdout.flush()
+    out_fd = sys.stdout.fileno() if has_fileno(sys.stdout) else None
+    info = os.fstat(fd)
+    # Files such as those in /proc report a size of 0 but still have
+    # content, so only sized regular files take the sendfile path.
+    if stat.S_ISREG(info.st_mode) and info.st_size:
+        end = info.st_size
+        if count is not None:
+            end = min(end, offset + count)
+        count = max(end - offset, 0)
+        if out_fd is not None:
+            try:
+                while count:
+                    sent = os.sendfile(out_fd, fd, offset, count)
+                    if sent == 0:
+                        return
+                    offset += sent
+                    count -= sent
+                return
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+        os.lseek(fd, offset, os.SEEK_SET)
+    while count is None or count > 0:
+        data = os.read(fd, CHUNK_SIZE if count is None else min(CHUNK_SIZE, count))
+        if not data:
+            return
+        if count is not None:
+            count -= len(data)
+        if out_fd is not None:
+            write_all(out_fd, data)
+        else:
+            write_output(data)
+
+
+class HistoryWriter:
+    """Append history entries to a file in batches.
+
+    Entries are buffered and written with a single O_APPEND write under an
+    exclusive flock, so concurrent sessions interleave whole lines instead
+    of overwriting each other's history. The buffer is flushed once it
+    holds HISTORY_BATCH_SIZE entries, HISTORY_FLUSH_INTERVAL seconds after
+    the first pending entry, or when flush() is called at exit. If an index
+    is given, the same batch is added to it.
+    """
+
+    def __init__(self, path, index=None, batch_size=HISTORY_BATCH_SIZE, interval=HISTORY_FLUSH_INTERVAL):
+        self.path = path
+        self.index = index
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pending = []
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def add(self, line, cwd=None, status=None):
+        """Queue a history entry for writing."""
+        with self.lock:
+            self.pending.append((line, time.time(), cwd, status))
+            flush_now = len(self.pending) >= self.batch_size
+            if not flush_now and self.timer is None:
+                self.timer = threading.Timer(self.interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if flush_now:
+            self.flush()
+
+    def flush(self):
+        """Write all pending entries to the history file."""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.pending:
+                return
+            entries = self.pending
+            self.pending = []
+            data = ''.join(entry[0] + '\n' for entry in entries).encode('utf-8')
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            if self.index is not None:
+                try:
+                    self.index.add(entries)
+                except sqlite3.Error as e:
+                    print(f"Error updating history index: {e}")
+
+
+class HistoryIndex:
+    """Searchable, deduplicated history kept in an SQLite database.
+
+    Each distinct command is stored once with the time, working directory
+    and exit status of its latest run. Substring searches go through an
+    FTS5 trigram index that is updated by triggers as entries are added,
+    so lookups stay fast with hundreds of thousands of entries. Patterns
+    shorter than a trigram, or SQLite builds without the trigram
+    tokenizer, fall back to a LIKE scan.
+    """
+
+    def __init__(self, path, legacy_file=None):
+        self.path = path
+        with closing(self.connect()) as connection, connection:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS history (
+                    id INTEGER PRIMARY KEY,
+                    command TEXT NOT NULL UNIQUE,
+                    timestamp REAL NOT NULL,
+                    cwd TEXT,
+                    status INTEGER,
+                    count INTEGER NOT NULL DEFAULT 1
+                );
+                CREATE INDEX IF NOT EXISTS history_timestamp ON history (timestamp);
+            """)
+            try:
+                connection.executescript("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+                        command, content='history', content_rowid='id', tokenize='trigram'
+                    );
+                    CREATE TRIGGER IF NOT EXISTS history_fts_insert AFTER INSERT ON history BEGIN
+                        INSERT INTO history_fts (rowid, command) VALUES (new.id, new.command);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON history BEGIN
+                        INSERT INTO history_fts (history_fts, rowid, command) VALUES ('delete', old.id, old.command);
+                    END;
+                """)
+                self.trigram = True
+            except sqlite3.OperationalError:
+                self.trigram = False
+            empty = connection.execute("SELECT NOT EXISTS (SELECT 1 FROM history)").fetchone()[0]
+        if empty and legacy_file and os.path.exists(legacy_file):
+            # Seed a new index from the plain history file, oldest first.
+            with open(legacy_file, encoding='utf-8', errors='replace') as file:
+                self.add((line.rstrip('\n'), 0, None, None) for line in file if line.strip())
+
+    def connect(self):
+        """Open a connection; each caller uses its own so threads never share one."""
+        return sqlite3.connect(self.path, timeout=10)
+
+    def add(self, entries):
+        """Insert or refresh (command, timestamp, cwd, status) entries."""
+        with closing(self.connect()) as connection, connection:
+            connection.executemany("""
+                INSERT INTO history (command, timestamp, cwd, status) VALUES (?, ?, ?, ?)
+                ON CONFLICT (command) DO UPDATE SET
+                    timestamp = excluded.timestamp,
+                    cwd = excluded.cwd,
+                    status = excluded.status,
+                    count = count + 1
+            """, entries)
+
+    def search(self, pattern, cwd=None, status=None, limit=HISTORY_SEARCH_LIMIT):
+        """Return (command, timestamp, cwd, status) rows matching pattern, newest first."""
+        conditions = []
+        params = []
+        if pattern and self.trigram and len(pattern) >= 3:
+            conditions.append("id IN (SELECT rowid FROM history_fts WHERE history_fts MATCH ?)")
+            params.append('"' + pattern.replace('"', '""') + '"')
+        elif pattern:
+            conditions.append("command LIKE ? ESCAPE '\\'")
+            params.append('%' + re.sub(r'([%_\\])', r'\\\1', pattern) + '%')
+        if cwd is not None:
+            conditions.append("cwd = ?")
+            params.append(cwd)
+        if status is not None:
+            conditions.append("status = ?")
+            params.append(status)
+        query = "SELECT command, timestamp, cwd, status FROM history"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+        params.append(limit)
+        with closing(self.connect()) as connection:
+            return connection.execute(query, params).fetchall()
+
+
+def scan_directory(path, depth, results):
+    """List one directory for walk_entries and put (entries, depth, error) on results."""
+    try:
+        with os.scandir(path) as iterator:
+            results.put((list(iterator), depth, None))
+    except OSError as e:
+        results.put(([], depth, e))
+
+
+def walk_entries(root, max_depth=None, prune=None, onerror=None, workers=FIND_WORKERS):
+    """Yield os.DirEntry objects below root, scanning directories in parallel.
+
+    Directories are listed on a thread pool and their entries are yielded
+    as soon as each listing completes, so callers can act on results while
+    the walk continues. Symbolic links are not followed. prune is called
+    with each directory entry; returning True skips its contents. Closing
+    the generator cancels the directories that have not been scanned yet.
+    A max_depth of 0 yields nothing, as root itself is depth 0.
+    """
+    if max_depth is not None and max_depth < 1:
+        return
+    results = queue.SimpleQueue()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    executor.submit(scan_directory, root, 1, results)
+    outstanding = 1
+    try:
+        while outstanding:
+            entries, depth, error = results.get()
+            outstanding -= 1
+            if error is not None and onerror is not None:
+                onerror(error)
+            if max_depth is None or depth < max_depth:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False) and not (prune and prune(entry)):
+                        executor.submit(scan_directory, entry.path, depth + 1, results)
+                        outstanding += 1
+            yield from entries
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def parse_size(text):
+    """Convert a size such as 512, 10k or 2G to bytes."""
+    match = re.fullmatch(r'(\d+)([ckMGT]?)', text)
+    if not match:
+        raise ValueError(f"invalid size: {text}")
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+def compare_spec(spec, convert):
+    """Turn '+N', '-N' or 'N' into a test: greater than, less than or equal to N."""
+    if spec[:1] == '+':
+        limit = convert(spec[1:])
+        return lambda value: value > limit
+    if spec[:1] == '-':
+        limit = convert(spec[1:])
+        return lambda value: value < limit
+    limit = convert(spec)
+    return lambda value: value == limit
+
+
+def build_find_filter(options):
+    """Build a predicate over os.DirEntry objects from parsed find options.
+
+    Name, pattern and type tests come from the directory listing itself;
+    the entry is only stat()ed when a size or mtime test needs it. The
+    files_only option keeps the legacy 'find <directory> <name>' result:
+    everything but directories and links to them.
+    """
+    tests = []
+    if 'contains' in options:
+        tests.append(lambda entry: options['contains'] in entry.name)
+    if options.get('files_only'):
+        tests.append(lambda entry: not entry.is_dir())
+    if 'name' in options:
+        tests.append(lambda entry: fnmatch.fnmatchcase(entry.name, options['name']))
+    if 'iname' in options:
+        pattern = options['iname'].lower()
+        tests.append(lambda entry: fnmatch.fnmatchcase(entry.name.lower(), pattern))
+    if 'regex' in options:
+        regex = re.compile(options['regex'])
+        tests.append(lambda entry: regex.search(entry.path) is not None)
+    if 'type' in options:
+        type_tests = {
+            'f': lambda entry: entry.is_file(follow_symlinks=False),
+            'd': lambda entry: entry.is_dir(follow_symlinks=False),
+            'l': lambda entry: entry.is_symlink(),
+        }
+        if options['type'] not in type_tests:
+            raise ValueError(f"unknown type: {options['type']}")
+        tests.append(type_tests[options['type']])
+    if 'size' in options:
+        size_matches = compare_spec(options['size'], parse_size)
+        tests.append(lambda entry: size_matches(entry.stat(follow_symlinks=False).st_size))
+    if 'mtime' in options:
+        age_matches = compare_spec(options['mtime'], int)
+        now = time.time()
+        tests.append(lambda entry: age_matches(int((now - entry.stat(follow_symlinks=False).st_mtime) // 86400)))
+
+    def matches(entry):
+        try:
+            return all(test(entry) for test in tests)
+        except OSError:
+            return False
+    return matches
+
+
+def glob_to_regex(pattern):
+    """Translate a glob for a single path component into a regex fragment."""
+    parts = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '*':
+            parts.append('[^/\n]*')
+        elif char == '?':
+            parts.append('[^/\n]')
+        elif char == '[':
+            start = i + 1
+            if pattern[start:start + 1] == '!':
+                start += 1
+            if pattern[start:start + 1] == ']':
+                start += 1
+            end = pattern.find(']', start)
+            if end == -1:
+                parts.append(re.escape(char))
+            else:
+                body = pattern[i + 1:end].replace('\\', '\\\\')
+                if body.startswith('!'):
+                    body = '^/\n' + body[1:]
+                parts.append('[' + body + ']')
+                i = end
+        else:
+            parts.append(re.escape(char))
+        i += 1
+    return ''.join(parts)
+
+
+def index_directory(path, old_dirs, results):
+    """Stat one directory for FileIndex.update and list it if its mtime changed."""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        record = old_dirs.get(path)
+        if record is not None and record[0] == mtime:
+            results.put((path, mtime, None))
+            return
+        with os.scandir(path) as iterator:
+            children = [(entry.name, entry.is_dir(follow_symlinks=False))
+                        for entry in iterator if b'\n' not in entry.name]
+        results.put((path, mtime, children))
+    except OSError:
+        results.put((path, None, None))
+
+
+class FileIndex:
+    """A locate-style index of every path below a root directory.
+
+    The index is kept in three files. <key>.paths holds one absolute path
+    per line, grouped by parent directory, with directories marked by a
+    trailing '/'. <key>.dirs holds one sorted record per directory: its
+    path, mtime and the byte range of its children in .paths. <key>.dirx
+    is an array of offsets into .dirs used for binary search. Queries
+    memory-map these files, so tens of millions of entries can be searched
+    without loading them into the heap. update() only rescans directories
+    whose mtime changed and copies the rest from the previous index.
+    """
+
+    def __init__(self, base, root):
+        self.root = os.path.abspath(root)
+        key = hashlib.sha1(os.fsencode(self.root)).hexdigest()[:16]
+        self.base = os.path.join(base, key)
+        self.verified = {}
+
+    def file(self, suffix):
+        """Return the path of one of the index files."""
+        return self.base + suffix
+
+    def exists(self):
+        """Return True if the index has been built."""
+        return os.path.exists(self.file('.dirx'))
+
+    def open_map(self, suffix):
+        """Memory-map an index file read-only, or return None if it is missing or empty."""
+        try:
+            with open(self.file(suffix), 'rb') as file:
+                return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def load_dir_table(self):
+        """Read the directory records into a dict of path -> (mtime, start, end)."""
+        table = {}
+        try:
+            with open(self.file('.dirs'), 'rb') as dirs:
+                next(dirs)
+                for line in dirs:
+                    path, mtime, start, end = line.rstrip(b'\n').split(b'\0')
+                    table[path] = (int(mtime), int(start), int(end))
+        except (FileNotFoundError, StopIteration):
+            pass
+        return table
+
+    def update(self, rebuild=False, workers=FIND_WORKERS):
+        """Build or refresh the index, returning (entries, directories, rescanned)."""
+        old_dirs = {} if rebuild else self.load_dir_table()
+        if old_dirs:
+            # Listings taken right after their directory changed may be
+            # missing entries added in the same clock tick; rescan those.
+            built = self.built()
+            old_dirs = {path: record for path, record in old_dirs.items()
+                        if record[0] <= built - 1_000_000_000}
+        old_paths = self.open_map('.paths') if old_dirs else None
+        results = queue.SimpleQueue()
+        records = []
+        entries = rescanned = 0
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            with open(self.file('.paths.tmp'), 'wb') as paths:
+                executor.submit(index_directory, os.fsencode(self.root), old_dirs, results)
+                outstanding = 1
+                while outstanding:
+                    path, mtime, children = results.get()
+                    outstanding -= 1
+                    if mtime is None:
+                        continue
+                    if children is None:
+                        _, start, end = old_dirs[path]
+                        # An index without a single file has an empty .paths.
+                        block = old_paths[start:end] if old_paths is not None else b''
+                        subdirs = [line[:-1] for line in block.split(b'\n') if line.endswith(b'/')]
+                    else:
+                        rescanned += 1
+                        block = b''.join(os.path.join(path, name) + (b'/\n' if is_dir else b'\n')
+                                         for name, is_dir in sorted(children))
+                        subdirs = [os.path.join(path, name) for name, is_dir in children if is_dir]
+                    start = paths.tell()
+                    paths.write(block)
+                    records.append((path, mtime, start, start + len(block)))
+                    entries += block.count(b'\n')
+                    for subdir in subdirs:
+                        executor.submit(index_directory, subdir, old_dirs, results)
+                        outstanding += 1
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            if old_paths is not None:
+                old_paths.close()
+
+        records.sort()
+        offsets = array('Q')
+        with open(self.file('.dirs.tmp'), 'wb') as dirs:
+            dirs.write(os.fsencode(self.root) + b'\n')
+            for path, mtime, start, end in records:
+                offsets.append(dirs.tell())
+                dirs.write(b'\0'.join([path, b'%d' % mtime, b'%d' % start, b'%d' % end]) + b'\n')
+        with open(self.file('.dirx.tmp'), 'wb') as dirx:
+            offsets.tofile(dirx)
+        for suffix in ('.paths', '.dirs', '.dirx'):
+            os.replace(self.file(suffix + '.tmp'), self.file(suffix))
+        return entries, len(records), rescanned
+
+    def remove(self):
+        """Delete the index files."""
+        for suffix in ('.paths', '.dirs', '.dirx'):
+            try:
+                os.remove(self.file(suffix))
+            except FileNotFoundError:
+                pass
+
+    def records(self, directory):
+        """Yield (path, mtime, start, end) for directory and every indexed directory below it."""
+        key = os.fsencode(os.path.abspath(directory))
+        prefix = key.rstrip(b'/') + b'/'
+        dirs = self.open_map('.dirs')
+        dirx = self.open_map('.dirx')
+        try:
+            if dirs is None or dirx is None:
+                return
+            with memoryview(dirx) as view, view.cast('Q') as offsets:
+                low, high = 0, len(offsets)
+                while low < high:
+                    middle = (low + high) // 2
+                    start = offsets[middle]
+                    if dirs[start:dirs.find(b'\0', start)] < key:
+                        low = middle + 1
+                    else:
+                        high = middle
+                # Directories below key sort together after it, possibly
+                # after siblings such as key-old, which are skipped.
+                for position in range(low, len(offsets)):
+                    start = offsets[position]
+                    path, mtime, first, last = dirs[start:dirs.find(b'\n', start)].split(b'\0')
+                    if not path.startswith(key):
+                        break
+                    if path == key or path.startswith(prefix):
+                        yield path, int(mtime), int(first), int(last)
+        finally:
+            for mapped in (dirs, dirx):
+                if mapped is not None:
+                    mapped.close()
+
+    def changed(self, path, mtime, built):
+        """Return True if a directory's mtime differs from its record or is too recent to trust.
+
+        A directory modified in the second before the index was built may
+        change again within the same clock tick without its mtime moving.
+        """
+        try:
+            return os.stat(path).st_mtime_ns != mtime or mtime > built - 1_000_000_000
+        except OSError:
+            return True
+
+    def built(self):
+        """Return when the index was last written, in nanoseconds."""
+        return os.stat(self.file('.dirx')).st_mtime_ns
+
+    def stale(self, directory):
+        """Return True if directory or any directory below it has changed or is not indexed.
+
+        Creating, removing or renaming an entry changes its directory's
+        mtime, so one stat per directory tells whether name queries can
+        still be answered from the index. That costs a stat for every
+        directory in the tree, so after a tree passes, only directory
+        itself is checked for INDEX_VERIFY_INTERVAL seconds; changes
+        deeper down may go unnoticed for that long.
+        """
+        try:
+            built = self.built()
+        except OSError:
+            return True
+        key = os.fsencode(os.path.abspath(directory))
+        verified = self.verified.get(key)
+        recent = (verified is not None and verified[0] == built
+                  and time.monotonic() - verified[1] < INDEX_VERIFY_INTERVAL)
+        found = False
+        with closing(self.records(directory)) as records:
+            for path, mtime, _, _ in records:
+                found = True
+                if self.changed(path, mtime, built):
+                    self.verified.pop(key, None)
+                    return True
+                if recent:
+                    break
+        if found and not recent:
+            self.verified[key] = (built, time.monotonic())
+        return not found
+
+    def children(self, directory):
+        """Return [(name, is_dir)] for an indexed directory, or None if it is not indexed or is stale."""
+        key = os.fsencode(os.path.abspath(directory))
+        with closing(self.records(directory)) as records:
+            record = next(records, None)
+        if record is None or record[0] != key:
+            return None
+        path, mtime, start, end = record
+        try:
+            if self.changed(path, mtime, self.built()):
+                return None
+        except OSError:
+            return None
+        paths = self.open_map('.paths')
+        if paths is None:
+            return []
+        with paths:
+            block = paths[start:end]
+        return [(os.fsdecode(os.path.basename(line.rstrip(b'/'))), line.endswith(b'/'))
+                for line in block.split(b'\n') if line]
+
+    def search(self, pattern, literal=b''):
+        """Yield every indexed path whose line matches a bytes regex, without a trailing '/'.
+
+        If literal is given it must occur in every matching line; the file
+        is then scanned with mmap.find and the regex is only tried on the
+        lines containing it.
+        """
+        paths = self.open_map('.paths')
+        if paths is None:
+            return
+        with paths:
+            if not literal:
+                for match in pattern.finditer(paths):
+                    yield os.fsdecode(match.group().rstrip(b'/'))
+                return
+            position = paths.find(literal)
+            while position != -1:
+                start = paths.rfind(b'\n', 0, position) + 1
+                end = paths.find(b'\n', position)
+                match = pattern.match(paths, start, end)
+                if match:
+                    yield os.fsdecode(match.group().rstrip(b'/'))
+                position = paths.find(literal, end)
+
+
+def index_query_pattern(directory, options):
+    """Build a (regex, literal) query over FileIndex lines for find options.
+
+    literal is the longest fixed string every match must contain, used to
+    skip non-matching lines quickly. Returns None if the index cannot answer
+    the options. -regex and -type f are not part of the query: the index
+    holds absolute paths and does not tell files from links, so callers
+    test those on the results with index_result_filter.
+    """
+    if any(option in options for option in ('size', 'mtime', 'prune')) or options.get('type') == 'l':
+        return None
+    if 'maxdepth' in options and int(options['maxdepth']) < 1:
+        return None
+    literals = [options.get('contains', '')]
+    if 'name' in options:
+        literals.extend(re.split(r'[*?\[\]]', options['name']))
+    name_tests = []
+    if 'contains' in options:
+        name_tests.append('[^/\n]*' + re.escape(options['contains']) + '[^/\n]*')
+    if 'name' in options:
+        name_tests.append(glob_to_regex(options['name']))
+    if 'iname' in options:
+        name_tests.append('(?i:' + glob_to_regex(options['iname']) + ')')
+    depth = '*' if 'maxdepth' not in options else '{0,%d}' % max(int(options['maxdepth']) - 1, 0)
+    names = ''.join(f'(?={test}/?$)' for test in name_tests)
+    suffix = {'d': '/', 'f': ''}.get(options.get('type'), '' if options.get('files_only') else '/?')
+    pattern = f"^{re.escape(directory.rstrip('/'))}/(?:[^/\n]+/){depth}{names}[^/\n]+{suffix}$"
+    return re.compile(os.fsencode(pattern), re.MULTILINE), os.fsencode(max(literals, key=len))
+
+
+def index_result_filter(options):
+    """Build a predicate over paths found in a FileIndex for the tests its query left out.
+
+    Paths are as displayed, i.e. relative to the directory as given, so
+    -regex sees the same strings as on a directory walk. -type f means a
+    regular file there, which takes an lstat per result here, and
+    files_only a stat.
+    """
+    tests = []
+    if 'regex' in options:
+        regex = re.compile(options['regex'])
+        tests.append(lambda path: regex.search(path) is not None)
+    if options.get('type') == 'f':
+        tests.append(lambda path: stat.S_ISREG(os.lstat(path).st_mode))
+    if options.get('files_only'):
+        tests.append(lambda path: not os.path.isdir(path))
+
+    def matches(path):
+        try:
+            return all(test(path) for test in tests)
+        except OSError:
+            return False
+    return matches
+
+
+class ListingCache:
+    """A small LRU cache of directory listings, shared by ls and tab completion.
+
+    A listing is the directory's os.DirEntry objects, whose file types come
+    from reading the directory itself, and it is reused only while the
+    directory's mtime is unchanged. File metadata is never cached; callers
+    stat entries when a column needs it. Directories changed within the
+    last second are not cached, since a second change in the same clock
+    tick would leave the mtime as it is.
+    """
+
+    def __init__(self, size=LISTING_CACHE_SIZE):
+        self.size = size
+        self.listings = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, directory):
+        """Return the DirEntry objects of directory, in no particular order."""
+        path = os.path.abspath(directory)
+        info = os.stat(path)
+        key = (info.st_dev, info.st_ino, info.st_mtime_ns)
+        with self.lock:
+            cached = self.listings.get(path)
+            if cached is not None and cached[0] == key:
+                self.listings.move_to_end(path)
+                return cached[1]
+        with os.scandir(path) as iterator:
+            entries = list(iterator)
+        if time.time_ns() - info.st_mtime_ns > 1_000_000_000:
+            with self.lock:
+                self.listings[path] = (key, entries)
+                self.listings.move_to_end(path)
+                while len(self.listings) > self.size:
+                    self.listings.popitem(last=False)
+        return entries
+
+
+@functools.lru_cache(maxsize=None)
+def user_name(uid):
+    """Return the name of a user id, or the id itself if it has no name."""
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return str(uid)
+
+
+@functools.lru_cache(maxsize=None)
+def group_name(gid):
+    """Return the name of a group id, or the id itself if it has no name."""
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return str(gid)
+
+
+def format_columns(names, width):
+    """Lay names out in columns running down the page, like ls, within width characters."""
+    if not names:
+        return []
+    lengths = [len(name) for name in names]
+    most = max(1, min(len(names), width // (min(lengths) + 2)))
+    fewest = max(1, min(most, width // (max(lengths) + 2)))
+    for columns in range(most, fewest - 1, -1):
+        rows = -(-len(names) // columns)
+        widths = [max(lengths[start:start + rows]) + 2 for start in range(0, len(names), rows)]
+        if sum(widths) - 2 < width:
+            break
+    return [''.join(names[start + row].ljust(widths[column])
+                    for column, start in enumerate(range(0, len(names), rows))
+                    if start + row < len(names)).rstrip()
+            for row in range(rows)]
+
+
+def format_long(items):
+    """Format (name, path, stat) items as the lines of ls -l."""
+    now = time.time()
+    rows = []
+    for name, path, info in items:
+        modified = time.localtime(info.st_mtime)
+        recent = abs(now - info.st_mtime) < 182 * 24 * 3600
+        if stat.S_ISLNK(info.st_mode):
+            try:
+                name = f"{name} -> {os.readlink(path)}"
+            except OSError:
+                pass
+        rows.append((stat.filemode(info.st_mode), str(info.st_nlink), user_name(info.st_uid),
+                     group_name(info.st_gid), str(info.st_size),
+                     time.strftime('%b %e %H:%M' if recent else '%b %e  %Y', modified), name))
+    widths = [max(len(row[column]) for row in rows) for column in range(5)] if rows else []
+    return [f"{mode} {links:>{widths[1]}} {user:<{widths[2]}} {group:<{widths[3]}} "
+            f"{size:>{widths[4]}} {modified} {name}"
+            for mode, links, user, group, size, modified, name in rows]
+
+
+def expand_globs(args):
+    """Expand glob patterns in command arguments; patterns without matches are kept as given."""
+    paths = []
+    for arg in args:
+        matches = sorted(glob.glob(arg)) if glob.has_magic(arg) else []
+        paths.extend(matches or [arg])
+    return paths
+
+
+def write_output(data, stream=None):
+    """Write bytes to stdout (or stream), bypassing text decoding when it has a binary buffer."""
+    stream = stream or sys.stdout
+    stream.flush()
+    if hasattr(stream, 'buffer'):
+        stream.buffer.write(data)
+        stream.buffer.flush()
+    else:
+        stream.write(data.decode('utf-8', errors='replace'))
+
+
+def count_newlines(data, start, end):
+    """Count newlines in data[start:end] without copying more than CHUNK_SIZE bytes at a time."""
+    count = 0
+    for offset in range(start, end, CHUNK_SIZE):
+        count += data[offset:min(offset + CHUNK_SIZE, end)].count(b'\n')
+    return count
+
+
+def matching_line_spans(data, regex):
+    """Yield (start, end) for each line of data containing a match of regex.
+
+    The regex runs over the whole buffer, so stretches without matches are
+    skipped at C speed; lines are only located around actual matches. end
+    excludes the newline.
+    """
+    position = 0
+    while position <= len(data):
+        match = regex.search(data, position)
+        if not match:
+            return
+        start = data.rfind(b'\n', 0, match.start()) + 1
+        end = data.find(b'\n', match.start())
+        if end == -1:
+            end = len(data)
+        # A match that spans lines (e.g. via \s) only counts if the line
+        # matches on its own.
+        if match.end() <= end or regex.search(data, start, end):
+            if start < len(data):
+                yield start, end
+        position = end + 1
+
+
+def selected_line_spans(data, regex, invert):
+    """Yield (start, end) of the lines grep selects, inverting the match if asked."""
+    if not invert:
+        yield from matching_line_spans(data, regex)
+        return
+    position = 0
+    for match_start, match_end in itertools.chain(matching_line_spans(data, regex), [(len(data), None)]):
+        while position < match_start:
+            end = data.find(b'\n', position, match_start)
+            end = match_start if end == -1 else end
+            yield position, end
+            position = end + 1
+        if match_end is not None:
+            position = match_end + 1
+
+
+def grep_file(path, pattern, flags, invert, line_numbers, mode, show_name, write=None):
+    """Search one memory-mapped file and return (count, output).
+
+    mode is 'lines', 'count' or 'files'. Output is the formatted grep
+    output as bytes. When write is given, output is passed to it in
+    CHUNK_SIZE pieces as it is produced instead of being collected.
+    """
+    regex = re.compile(pattern, flags)
+    prefix = os.fsencode(path) + b':' if show_name else b''
+    with open(path, 'rb') as file:
+        try:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped.
+            data = b''
+    parts = []
+    size = 0
+    count = 0
+    line_number = 1
+    counted_to = 0
+    for start, end in selected_line_spans(data, regex, invert):
+        count += 1
+        if mode == 'files':
+            break
+        if mode == 'count':
+            continue
+        if line_numbers:
+            line_number += count_newlines(data, counted_to, start)
+            counted_to = start
+            parts.append(prefix + b'%d:' % line_number)
+        elif prefix:
+            parts.append(prefix)
+        parts.append(data[start:end] + b'\n')
+        size += end - start
+        if write is not None and size >= CHUNK_SIZE:
+            write(b''.join(parts))
+            parts, size = [], 0
+    if isinstance(data, mmap.mmap):
+        data.close()
+    return count, b''.join(parts)
+
+
+def grep_file_to_spool(path, spool_dir, **options):
+    """Run grep_file in a pool worker and return (count, spool file holding its output).
+
+    Output is written to the spool file in CHUNK_SIZE pieces, so neither
+    the worker nor the parent holds a whole file's matches in memory.
+    """
+    with tempfile.NamedTemporaryFile(dir=spool_dir, delete=False) as spool:
+        count, output = grep_file(path, write=spool.write, **options)
+        spool.write(output)
+    return count, spool.name
+
+
+def format_size(size):
+    """Format a byte count for humans, e.g. 1536 -> '1.5K'."""
+    for unit in ('B', 'K', 'M', 'G', 'T'):
+        if abs(size) < 1024 or unit == 'T':
+            return f"{size:.0f}{unit}" if unit == 'B' else f"{size:.1f}{unit}"
+        size /= 1024
+
+
+def read_line_batches(file):
+    """Yield lists of the lines of a binary file, without their newlines, a batch at a time."""
+    return iter(lambda: [line[:-1] if line[-1:] == b'\n' else line for line in file.readlines(CHUNK_SIZE)], [])
+
+
+def read_lines(file):
+    """Return an iterator over the lines of a binary file without their newlines.
+
+    Lines are read and stripped in batches, which keeps the per-line cost
+    in C.
+    """
+    return itertools.chain.from_iterable(read_line_batches(file))
+
+
+def line_runs(batches, key=None):
+    """Yield (first line, count) for each run of equal lines in a sequence of line batches.
+
+    Run boundaries are found by comparing every line with the one before
+    it through map(operator.ne), in C, so only the runs cost Python work.
+    """
+    line = previous = None
+    count = 0
+    for batch in batches:
+        keys = batch if key is None else list(map(key, batch))
+        if count and keys[0] != previous:
+            yield line, count
+            count = 0
+        if not count:
+            line = batch[0]
+        position = 0
+        for start in itertools.compress(range(1, len(batch)), map(operator.ne, keys[1:], keys)):
+            yield line, count + start - position
+            line, count, position = batch[start], 0, start
+        count += len(batch) - position
+        previous = keys[-1]
+    if count:
+        yield line, count
+
+
+def write_lines(lines, output, batch=4096):
+    """Write lines to a binary file, adding newlines, a batch at a time."""
+    lines = iter(lines)
+    while True:
+        group = list(itertools.islice(lines, batch))
+        if not group:
+            return
+        output.write(b'\n'.join(group) + b'\n')
+
+
+def file_chunks(file, size=WC_CHUNK_SIZE):
+    """Yield a binary file's contents in slices of size bytes, through mmap for regular files."""
+    try:
+        info = os.fstat(file.fileno())
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        info = None
+    if info is not None and stat.S_ISREG(info.st_mode) and info.st_size:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if hasattr(data, 'madvise'):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+            for offset in range(0, len(data), size):
+                yield data[offset:offset + size]
+    else:
+        yield from iter(functools.partial(file.read, size), b'')
+
+
+def count_file(file, words=True):
+    """Return (lines, words, bytes) for a binary file; words are only counted when asked for."""
+    lines = word_count = size = 0
+    in_word = False
+    for chunk in file_chunks(file):
+        lines += chunk.count(b'\n')
+        size += len(chunk)
+        if words:
+            word_count += len(chunk.split())
+            # A word running across the slice boundary was counted twice
+            if in_word and not chunk[:1].isspace():
+                word_count -= 1
+            in_word = not chunk[-1:].isspace()
+    return lines, word_count, size
+
+
+def field_start(line, field, separator):
+    """Return where field (counting from 1) starts in line, or len(line) if it has fewer fields.
+
+    Without a separator, fields are runs of non-blanks and each one starts
+    with the blanks before it, as in sort.
+    """
+    position = 0
+    for _ in range(field - 1):
+        if separator:
+            position = line.find(separator, position)
+            if position == -1:
+                return len(line)
+            position += len(separator)
+        else:
+            match = SORT_FIELD.match(line, position)
+            if not match:
+                return len(line)
+            position = match.end()
+    return position
+
+
+def field_end(line, field, separator):
+    """Return where field (counting from 1) ends in line."""
+    start = field_start(line, field, separator)
+    if separator:
+        end = line.find(separator, start)
+        return len(line) if end == -1 else end
+    match = SORT_FIELD.match(line, start)
+    return match.end() if match else len(line)
+
+
+def sort_key(key_options):
+    """Return the key function for sort's -n, -f and -k options, or None to compare whole lines.
+
+    Keys are (field, line) pairs, so lines with equal fields are ordered by
+    their bytes, like sort's last-resort comparison.
+    """
+    numeric, fold, fields, separator = key_options
+    if not (numeric or fold or fields):
+        return None
+
+    def key(line):
+        text = line
+        if fields:
+            first, last = fields
+            start = field_start(line, first, separator)
+            text = line[start:] if last is None else line[start:max(start, field_end(line, last, separator))]
+        if numeric:
+            match = SORT_NUMBER.match(text)
+            text = float(match.group(1)) if match else 0.0
+        elif fold:
+            text = text.lower()
+        return text, line
+    return key
+
+
+def unique_lines(lines, key=None):
+    """Drop lines that compare equal to the line before them, by key field when key is given."""
+    if key is None:
+        return (line for line, _ in itertools.groupby(lines))
+    return (next(group) for _, group in itertools.groupby(lines, lambda line: key(line)[0]))
+
+
+def read_line_chunks(inputs, size):
+    """Yield chunks of roughly size bytes read from binary files, each ending with a newline.
+
+    A last line without a newline gets one, so it stays a line of its own
+    when the next file follows.
+    """
+    carry = b''
+    for file in inputs:
+        while True:
+            data = file.read(size)
+            if not data:
+                break
+            if carry:
+                data = carry + data
+            end = data.rfind(b'\n') + 1
+            carry = data[end:]
+            if end:
+                yield data[:end]
+        if carry:
+            carry += b'\n'
+    if carry:
+        yield carry
+
+
+def sort_chunk(data, key_options, reverse, unique):
+    """Sort a chunk of newline-terminated lines and return the list of lines."""
+    lines = data.split(b'\n')
+    lines.pop()
+    key = sort_key(key_options)
+    lines.sort(key=key, reverse=reverse)
+    return list(unique_lines(lines, key)) if unique else lines
+
+
+def sort_run(data, key_options, reverse, unique, directory):
+    """Sort a chunk into a new run file in directory and return the run's path."""
+    lines = sort_chunk(data, key_options, reverse, unique)
+    del data
+    fd, path = tempfile.mkstemp(suffix='.run', dir=directory)
+    with open(fd, 'wb') as run:
+        write_lines(lines, run)
+    return path
+
+
+def merge_runs(paths, key_options, reverse, unique, output):
+    """Merge sorted run files into output with a k-way heap merge."""
+    key = sort_key(key_options)
+    with ExitStack() as stack:
+        runs = [read_lines(stack.enter_context(open(path, 'rb', buffering=CHUNK_SIZE))) for path in paths]
+        merged = heapq.merge(*runs, key=key, reverse=reverse)
+        write_lines(unique_lines(merged, key) if unique else merged, output)
+
+
+def merge_run_files(paths, key_options, reverse, unique, directory):
+    """Merge run files into a new run in directory, delete them and return the new run's path."""
+    fd, path = tempfile.mkstemp(suffix='.run', dir=directory)
+    with open(fd, 'wb', buffering=CHUNK_SIZE * 4) as run:
+        merge_runs(paths, key_options, reverse, unique, run)
+    for merged in paths:
+        os.remove(merged)
+    return path
+
+
+def external_sort(inputs, output, key_options=(False, False, None, None), reverse=False, unique=False,
+                  buffer_size=SORT_BUFFER_SIZE, workers=SORT_WORKERS):
+    """Sort the lines of binary files into output, holding about buffer_size bytes in memory.
+
+    Input that fits in one chunk is sorted in memory. Larger input is cut
+    into chunks at line boundaries; each chunk is sorted into a temporary
+    run file on a process pool while the next ones are read, and the runs
+    are combined with heap merges, SORT_MERGE_WIDTH at a time, the last
+    merge streaming straight into output.
+    """
+    chunk_size = max(buffer_size // (4 * workers), 1024 * 1024)
+    chunks = read_line_chunks(inputs, chunk_size)
+    first = next(chunks, None)
+    second = next(chunks, None) if first is not None else None
+    if second is None:
+        if first is not None:
+            write_lines(sort_chunk(first, key_options, reverse, unique), output)
+        return
+    directory = tempfile.mkdtemp(prefix='shell-sort-')
+    try:
+        # sort also runs as a pipeline stage on a thread, and forking from a
+        # thread can copy locks that other threads hold; the workers come
+        # from a fork server (or are spawned) instead.
+        with ProcessPoolExecutor(max_workers=workers, mp_context=thread_safe_context()) as executor:
+            task = functools.partial(sort_run, key_options=key_options, reverse=reverse,
+                                     unique=unique, directory=directory)
+            runs = list(ordered_map(executor, task, ((chunk,) for chunk in itertools.chain((first, second), chunks)),
+                                    workers))
+            del first, second
+            merge = functools.partial(merge_run_files, key_options=key_options, reverse=reverse,
+                                      unique=unique, directory=directory)
+            while len(runs) > SORT_MERGE_WIDTH:
+                runs = list(executor.map(merge, [runs[i:i + SORT_MERGE_WIDTH]
+                                                 for i in range(0, len(runs), SORT_MERGE_WIDTH)]))
+        merge_runs(runs, key_options, reverse, unique, output)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def thread_safe_context():
+    """Return a multiprocessing context whose workers can safely be started from any thread."""
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def open_inputs(paths, stdin):
+    """Yield an open binary file for each path, '-' or no paths at all meaning stdin."""
+    for path in paths or ['-']:
+        if path == '-':
+            yield stdin
+        else:
+            with open(path, 'rb') as file:
+                yield file
+
+
+def sort_command(args, stdin, stdout, stderr):
+    """The sort builtin: sort [-r] [-n] [-f] [-u] [-k N[,M]] [-t SEP] [-S SIZE] [files...]."""
+    options = {'-r': False, '-n': False, '-f': False, '-u': False}
+    fields = separator = None
+    buffer_size = SORT_BUFFER_SIZE
+    while args and args[0].startswith('-') and args[0] != '-':
+        option = args.pop(0)
+        if option in ('-k', '-t', '-S') and args:
+            value = args.pop(0)
+            if option == '-k':
+                first, _, last = value.partition(',')
+                fields = (int(first.split('.')[0]), int(last.split('.')[0]) if last else None)
+            elif option == '-t':
+                separator = os.fsencode(value)
+            else:
+                buffer_size = parse_size(value)
+        elif set(option[1:]) <= set('rnfu'):
+            for flag in option[1:]:
+                options['-' + flag] = True
+        else:
+            raise ValueError("usage: sort [-r] [-n] [-f] [-u] [-k N[,M]] [-t SEP] [-S SIZE] [files...]")
+    key_options = (options['-n'], options['-f'], fields, separator)
+    # Files are opened as the merge reaches them, so a missing one is
+    # reported before any output is written.
+    for path in args:
+        if path != '-' and not os.path.isfile(path):
+            raise FileNotFoundError(f"{path}: No such file")
+    external_sort(open_inputs(args, stdin), stdout, key_options, options['-r'], options['-u'], buffer_size)
+    return 0
+
+
+def uniq_command(args, stdin, stdout, stderr):
+    """The uniq builtin: uniq [-c] [-d] [-u] [-i] [input]."""
+    flags = set()
+    while args and args[0].startswith('-') and args[0] != '-':
+        option = args.pop(0)
+        if not set(option[1:]) <= set('cdui'):
+            raise ValueError("usage: uniq [-c] [-d] [-u] [-i] [input]")
+        flags.update(option[1:])
+    if len(args) > 1:
+        raise ValueError("usage: uniq [-c] [-d] [-u] [-i] [input]")
+    for file in open_inputs(args, stdin):
+        runs = line_runs(read_line_batches(file), bytes.lower if 'i' in flags else None)
+        if 'd' in flags:
+            runs = ((line, count) for line, count in runs if count > 1)
+        if 'u' in flags:
+            runs = ((line, count) for line, count in runs if count == 1)
+        if 'c' in flags:
+            write_lines((b'%7d %s' % (count, line) for line, count in runs), stdout)
+        else:
+            write_lines((line for line, _ in runs), stdout)
+    return 0
+
+
+def wc_command(args, stdin, stdout, stderr):
+    """The wc builtin: wc [-l] [-w] [-c] [files...]."""
+    flags = set()
+    while args and args[0].startswith('-') and args[0] != '-':
+        option = args.pop(0)
+        if not set(option[1:]) <= set('lwc'):
+            raise ValueError("usage: wc [-l] [-w] [-c] [files...]")
+        flags.update(option[1:])
+    columns = [index for index, flag in enumerate('lwc') if flag in flags] or [0, 1, 2]
+    results = []
+    status = 0
+    for path in args or ['-']:
+        try:
+            if path == '-':
+                counts = count_file(stdin, words=1 in columns)
+            elif columns == [2] and os.path.isfile(path):
+                counts = (0, 0, os.path.getsize(path))
+            else:
+                with open(path, 'rb') as file:
+                    counts = count_file(file, words=1 in columns)
+            results.append((counts, path if args else ''))
+        except OSError as e:
+            stderr.write(os.fsencode(f"wc: {path}: {e.strerror}\n"))
+            status = 1
+    if len(results) > 1:
+        results.append((tuple(map(sum, zip(*(counts for counts, _ in results)))), 'total'))
+    # Pad like wc: to the digits of the total size, at least 7 when
+    # reading something other than files, and not at all for one number.
+    width = max((len(str(counts[2])) for counts, _ in results), default=1)
+    if not args or '-' in args:
+        width = max(width, 7)
+    if len(columns) == 1 and len(results) == 1:
+        width = 1
+    for counts, name in results:
+        line = ' '.join(f"{counts[column]:>{width}}" for column in columns)
+        stdout.write(os.fsencode(f"{line} {name}".rstrip() + '\n'))
+    return status
+
+
+STREAM_BUILTINS = {'sort': sort_command, 'uniq': uniq_command, 'wc': wc_command}
+
+# Builtins that write only through sys.stdout and sys.stderr and read no
+# input, so they can head a pipeline as a ShellStage. Others, such as ps or
+# uname, run programs that inherit the shell's own descriptors; in a
+# pipeline the program of that name is run instead.
+PIPELINE_BUILTINS = frozenset({
+    'alias', 'cat', 'date', 'du', 'dupes', 'find', 'getenv', 'grep', 'hash', 'head', 'help',
+    'history', 'jobs', 'ls', 'pipestatus', 'pwd', 'tail', 'whoami',
+})
+
+
+class StdoutWriter(io.RawIOBase):
+    """A raw binary stream onto a text stream such as sys.stdout, for when it has no descriptor of its own."""
+
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+
+    def writable(self):
+        """Report that the stream can be written to."""
+        return True
+
+    def write(self, data):
+        """Pass data on to the text stream and report it all written."""
+        write_output(bytes(data), self.stream)
+        return len(data)
+
+
+class BuiltinStage(threading.Thread):
+    """A stream builtin running as one stage of a pipeline, on a thread of the shell.
+
+    It looks like a Popen object to the pipeline code: wait() returns its
+    exit status. The shell's standard streams are taken when the stage is
+    created, as a ShellStage may redirect them while this one runs.
+    """
+
+    def __init__(self, run, argv, fds):
+        super().__init__(daemon=True)
+        self.run_builtin = run
+        self.argv = argv
+        self.fds = fds
+        self.streams = (sys.stdin, sys.stdout, sys.stderr)
+        self.status = None
+
+    def run(self):
+        """Run the builtin on the stage's descriptors."""
+        self.status = self.run_builtin(self.argv, *self.fds, streams=self.streams)
+
+    def wait(self):
+        """Wait for the builtin to finish and return its exit status."""
+        self.join()
+        return self.status
+
+
+class FailedStage:
+    """A pipeline stage that could not be started; wait() returns its status."""
+
+    def __init__(self, status):
+        self.status = status
+
+    def wait(self):
+        """Return the status the stage was given."""
+        return self.status
+
+
+class ShellStage:
+    """One of PIPELINE_BUILTINS as the first stage of a pipeline.
+
+    Such builtins print through sys.stdout and keep state in the shell,
+    so the stage runs on the shell's own thread after every other stage
+    has started, with sys.stdout and sys.stderr pointing at its output
+    descriptors.
+    """
+
+    def __init__(self, run, argv, fds):
+        self.run_builtin = run
+        self.argv = argv
+        self.fds = fds
+        self.status = None
+
+    def run(self):
+        """Run the builtin with its output redirected, closing the descriptors afterwards."""
+        try:
+            with ExitStack() as stack:
+                for fd, redirect in ((self.fds[0], redirect_stdout), (self.fds[1], redirect_stderr)):
+                    if fd is not None:
+                        stream = stack.enter_context(open(fd, 'w', errors='replace'))
+                        stack.enter_context(redirect(stream))
+                self.status = self.run_builtin(self.argv)
+        except BrokenPipeError:
+            self.status = 141
+
+    def wait(self):
+        """Return the builtin's exit status."""
+        return self.status
+
+
+def hash_file(path, algorithm='sha256', limit=None):
+    """Return (hex digest, error) for a file's contents, or for its first limit bytes.
+
+    Whole files are hashed straight from an mmap, so the data is never
+    copied into Python objects and hashlib releases the GIL throughout.
+    """
+    try:
+        digest = hashlib.new(algorithm)
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if limit is not None and limit < size:
+                digest.update(os.pread(file.fileno(), limit, 0))
+            elif size:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    if hasattr(data, 'madvise'):
+                        data.madvise(mmap.MADV_SEQUENTIAL)
+                    digest.update(data)
+            else:
+                # Files in /proc and the like report a size of zero
+                for block in iter(functools.partial(file.read, CHUNK_SIZE * 16), b''):
+                    digest.update(block)
+        return digest.hexdigest(), None
+    except (OSError, ValueError) as e:
+        return None, str(e)
+
+
+def hash_line(digest, path):
+    """Format a line the way sha256sum does, escaping backslashes and newlines in the name."""
+    if '\\' in path or '\n' in path:
+        return '\\' + digest + '  ' + path.replace('\\', '\\\\').replace('\n', '\\n')
+    return digest + '  ' + path
+
+
+def group_by_hash(executor, groups, limit=None):
+    """Split groups of paths into groups whose contents hash alike, dropping lone files."""
+    paths = [path for group in groups for path in group]
+    digests = executor.map(functools.partial(hash_file, algorithm=DUPES_ALGORITHM, limit=limit),
+                           paths, chunksize=16)
+    buckets = defaultdict(list)
+    group_of = {path: number for number, group in enumerate(groups) for path in group}
+    for path, (digest, error) in zip(paths, digests):
+        if error is None:
+            buckets[group_of[path], digest].append(path)
+    return [group for group in buckets.values() if len(group) > 1]
+
+
+def find_duplicates(roots, onerror=None, workers=HASH_WORKERS):
+    """Return (size, paths) for each set of identical non-empty files below roots.
+
+    Files are grouped by size first, then by a hash of their first
+    DUPES_PREFIX_SIZE bytes, and only files still alike after that are
+    hashed whole; hashing runs on a process pool. Paths that are already
+    hard links to one another count as one file.
+    """
+    sizes = defaultdict(list)
+    inodes = set()
+    for root in roots:
+        entries = walk_entries(root, onerror=onerror) if os.path.isdir(root) else [root]
+        for entry in entries:
+            try:
+                if isinstance(entry, str):
+                    path, info = entry, os.lstat(entry)
+                else:
+                    path, info = entry.path, entry.stat(follow_symlinks=False)
+            except OSError as e:
+                if onerror is not None:
+                    onerror(e)
+                continue
+            if stat.S_ISREG(info.st_mode) and info.st_size and (info.st_dev, info.st_ino) not in inodes:
+                inodes.add((info.st_dev, info.st_ino))
+                sizes[info.st_size].append(path)
+    candidates = [sorted(paths) for paths in sizes.values() if len(paths) > 1]
+    if not candidates:
+        return []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=thread_safe_context()) as executor:
+        groups = group_by_hash(executor, candidates, DUPES_PREFIX_SIZE)
+        small = [group for group in groups if os.path.getsize(group[0]) <= DUPES_PREFIX_SIZE]
+        large = [group for group in groups if os.path.getsize(group[0]) > DUPES_PREFIX_SIZE]
+        groups = small + group_by_hash(executor, large)
+    return sorted(((os.path.getsize(group[0]), sorted(group)) for group in groups), reverse=True)
+
+
+def link_duplicates(paths):
+    """Replace paths[1:] with hard links to paths[0] and return the bytes freed.
+
+    Each link is made under a temporary name and renamed over the copy,
+    so a failure never leaves a path missing.
+    """
+    freed = 0
+    keep = paths[0]
+    size = os.path.getsize(keep)
+    for path in paths[1:]:
+        temporary = f"{path}.{os.getpid()}.link"
+        os.link(keep, temporary)
+        try:
+            os.replace(temporary, path)
+        except OSError:
+            os.unlink(temporary)
+            raise
+        freed += size
+    return freed
+
+
+def copy_file(source, target, resume=False):
+    """Copy one file's data and metadata and return the number of bytes copied.
+
+    Data is moved with os.copy_file_range, which lets the kernel copy
+    in-kernel, reflink on filesystems that support it, or copy server-side
+    on NFS and SMB; shutil.copyfileobj is the fallback. With resume, a
+    target whose size and mtime already match is left alone and None is
+    returned. Copying a file onto itself raises shutil.SameFileError
+    before the target is opened, as truncating it would empty the source.
+    Named pipes, sockets and device nodes raise shutil.SpecialFileError
+    instead of being read, which could block forever.
+    """
+    info = os.stat(source)
+    if not stat.S_ISREG(info.st_mode):
+        kind = ('named pipe' if stat.S_ISFIFO(info.st_mode) else 'socket' if stat.S_ISSOCK(info.st_mode)
+                else 'device' if stat.S_ISCHR(info.st_mode) or stat.S_ISBLK(info.st_mode) else 'special file')
+        raise shutil.SpecialFileError(f"'{source}' is a {kind}")
+    try:
+        existing = os.stat(target)
+    except FileNotFoundError:
+        existing = None
+    if existing is not None:
+        if (existing.st_dev, existing.st_ino) == (info.st_dev, info.st_ino):
+            raise shutil.SameFileError(f"'{source}' and '{target}' are the same file")
+        if resume and existing.st_size == info.st_size and existing.st_mtime_ns == info.st_mtime_ns:
+            return None
+    with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+        copied = 0
+        try:
+            while True:
+                count = os.copy_file_range(source_file.fileno(), target_file.fileno(), COPY_RANGE_SIZE)
+                if count == 0:
+                    break
+                copied += count
+        except (AttributeError, OSError) as e:
+            if isinstance(e, OSError) and e.errno not in COPY_FALLBACK_ERRORS:
+                raise
+            source_file.seek(copied)
+            target_file.seek(copied)
+            shutil.copyfileobj(source_file, target_file, CHUNK_SIZE * 16)
+            copied = target_file.tell()
+    shutil.copystat(source, target)
+    return copied
+
+
+class ParallelCopier:
+    """Copy files and directory trees on a thread pool, keeping running totals.
+
+    Trees are walked with walk_entries; directories are created as they are
+    found and file copies are queued on the pool, with at most a few per
+    worker waiting so memory stays bounded for trees with millions of
+    files. Directory metadata is copied in finish(), after their contents.
+    """
+
+    def __init__(self, resume=False, workers=COPY_WORKERS):
+        self.resume = resume
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers * 4)
+        self.lock = threading.Lock()
+        self.files = self.bytes = self.skipped = 0
+        self.errors = []
+        self.directories = []
+        self.started = time.time()
+
+    def submit(self, source, target):
+        """Queue a copy of one file or symbolic link."""
+        self.slots.acquire()
+        try:
+            self.executor.submit(self.copy_one, source, target)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def transfer(self, source, target):
+        """Copy one file or link, returning the bytes written or None if it was skipped."""
+        if os.path.islink(source):
+            if os.path.lexists(target):
+                if os.path.samestat(os.lstat(source), os.lstat(target)):
+                    raise shutil.SameFileError(f"'{source}' and '{target}' are the same file")
+                os.remove(target)
+            os.symlink(os.readlink(source), target)
+            return 0
+        return copy_file(source, target, self.resume)
+
+    def copy_one(self, source, target):
+        """Run transfer() on a worker thread and add its result to the totals."""
+        try:
+            copied = self.transfer(source, target)
+            with self.lock:
+                if copied is None:
+                    self.skipped += 1
+                else:
+                    self.files += 1
+                    self.bytes += copied
+        except OSError as e:
+            with self.lock:
+                self.errors.append(f"'{source}': {e}")
+        finally:
+            self.slots.release()
+
+    def copy_tree(self, source, target):
+        """Recreate a directory tree below target, queueing its files."""
+        os.makedirs(target, exist_ok=True)
+        self.directories.append((source, target))
+        for entry in walk_entries(source, onerror=lambda e: self.errors.append(str(e))):
+            destination = os.path.join(target, os.path.relpath(entry.path, source))
+            if entry.is_dir(follow_symlinks=False):
+                os.makedirs(destination, exist_ok=True)
+                self.directories.append((entry.path, destination))
+            else:
+                self.submit(entry.path, destination)
+
+    def finish(self):
+        """Wait for queued copies and copy directory metadata, deepest first."""
+        self.executor.shutdown(wait=True)
+        for source, target in reversed(self.directories):
+            try:
+                shutil.copystat(source, target)
+            except OSError as e:
+                self.errors.append(f"'{source}': {e}")
+
+    def summary(self):
+        """Describe the progress so far."""
+        elapsed = max(time.time() - self.started, 1e-6)
+        return (f"{self.files} files, {format_size(self.bytes)} in {elapsed:.1f}s "
+                f"({format_size(self.bytes / elapsed)}/s), {self.skipped} skipped")
+
+
+DIRECTORY_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
+
+
+def empty_directory(fd, path, onremove=None):
+    """Delete everything inside the directory open as fd, depth first on this thread.
+
+    Every entry is opened or removed relative to its parent's descriptor,
+    and subdirectories are opened with O_NOFOLLOW, so replacing a directory
+    with a symbolic link while this runs cannot send it outside the tree.
+    Returns (entries removed, errors); path is only used in messages and
+    in calls to onremove, which is given the path of each removed entry.
+    """
+    removed = 0
+    errors = []
+    with os.scandir(fd) as iterator:
+        entries = list(iterator)
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                child = os.open(entry.name, DIRECTORY_FLAGS, dir_fd=fd)
+                try:
+                    count, child_errors = empty_directory(child, os.path.join(path, entry.name), onremove)
+                finally:
+                    os.close(child)
+                removed += count
+                errors.extend(child_errors)
+                os.rmdir(entry.name, dir_fd=fd)
+            else:
+                os.unlink(entry.name, dir_fd=fd)
+            removed += 1
+            if onremove is not None:
+                onremove(os.path.join(path, entry.name))
+        except OSError as e:
+            errors.append(f"'{os.path.join(path, entry.name)}': {e}")
+    return removed, errors
+
+
+class TreeRemover:
+    """Delete a directory tree on a thread pool, walking it by directory descriptors.
+
+    Each directory is cleared on the pool, and its subdirectories are
+    queued as descriptors opened relative to it with O_NOFOLLOW. It is
+    removed, relative to its parent's descriptor, once everything below
+    it is gone. Every queued directory holds a descriptor until then, so
+    at most REMOVE_OPEN_DIRECTORIES are queued at a time. Subdirectories
+    found beyond that are emptied depth first by the thread that found
+    them. onremove, if given, is called from the workers with the path of
+    every entry removed.
+    """
+
+    def __init__(self, workers=REMOVE_WORKERS, onremove=None):
+        self.workers = workers
+        self.onremove = onremove
+        self.slots = threading.BoundedSemaphore(REMOVE_OPEN_DIRECTORIES)
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.removed = 0
+        self.errors = []
+
+    def remove(self, root):
+        """Delete root and everything below it and return (entries removed, errors)."""
+        fd = os.open(root, DIRECTORY_FLAGS)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        with self.executor:
+            self.submit({'fd': fd, 'path': root, 'parent': None, 'pending': 1})
+            self.done.wait()
+        try:
+            os.rmdir(root)
+            self.removed += 1
+            self.removed_entry(root)
+        except OSError as e:
+            self.errors.append(f"'{root}': {e}")
+        return self.removed, self.errors
+
+    def removed_entry(self, path):
+        """Pass the path of a removed entry to onremove, if there is one."""
+        if self.onremove is not None:
+            self.onremove(path)
+
+    def submit(self, directory):
+        """Queue a directory, given as a record holding its open descriptor, to be cleared."""
+        self.executor.submit(self.clear, directory)
+
+    def clear(self, directory):
+        """Unlink the files of one directory and queue or empty its subdirectories."""
+        try:
+            removed, errors = self.clear_entries(directory)
+            with self.lock:
+                self.removed += removed
+                self.errors.extend(errors)
+        finally:
+            self.finish(directory)
+
+    def clear_entries(self, directory):
+        """Do the work of clear() and return (entries removed, errors)."""
+        fd = directory['fd']
+        removed = 0
+        errors = []
+        try:
+            with os.scandir(fd) as iterator:
+                entries = list(iterator)
+        except OSError as e:
+            return removed, [f"'{directory['path']}': {e}"]
+        for entry in entries:
+            path = os.path.join(directory['path'], entry.name)
+            try:
+                if not entry.is_dir(follow_symlinks=False):
+                    os.unlink(entry.name, dir_fd=fd)
+                    removed += 1
+                    self.removed_entry(path)
+                    continue
+                child = os.open(entry.name, DIRECTORY_FLAGS, dir_fd=fd)
+                if self.slots.acquire(blocking=False):
+                    with self.lock:
+                        directory['pending'] += 1
+                    self.submit({'fd': child, 'path': path, 'parent': directory, 'pending': 1})
+                    continue
+                try:
+                    count, child_errors = empty_directory(child, path, self.onremove)
+                finally:
+                    os.close(child)
+                removed += count
+                errors.extend(child_errors)
+                os.rmdir(entry.name, dir_fd=fd)
+                removed += 1
+                self.removed_entry(path)
+            except OSError as e:
+                errors.append(f"'{path}': {e}")
+        return removed, errors
+
+    def finish(self, directory):
+        """Count one part of a directory as done and remove it once nothing below it is left."""
+        while directory is not None:
+            with self.lock:
+                directory['pending'] -= 1
+                if directory['pending']:
+                    return
+            parent = directory['parent']
+            if parent is None:
+                os.close(directory['fd'])
+                self.done.set()
+                return
+            try:
+                os.rmdir(os.path.basename(directory['path']), dir_fd=parent['fd'])
+                removed, errors = 1, []
+                self.removed_entry(directory['path'])
+            except OSError as e:
+                removed, errors = 0, [f"'{directory['path']}': {e}"]
+            os.close(directory['fd'])
+            self.slots.release()
+            with self.lock:
+                self.removed += removed
+                self.errors.extend(errors)
+            directory = parent
+
+
+def remove_tree(root, workers=REMOVE_WORKERS, onremove=None):
+    """Delete a directory tree in parallel and return (entries removed, errors)."""
+    return TreeRemover(workers, onremove).remove(root)
+
+
+class DirectorySizeCache:
+    """Sizes of the files directly inside directories, kept in SQLite between du runs.
+
+    Entries are keyed by absolute directory path and mtime. Creating,
+    deleting or renaming an entry changes the mtime and invalidates the
+    entry; a file growing in place does not, which du --refresh is for.
+    Changes are committed in close().
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS directories (
+                path BLOB PRIMARY KEY,
+                mtime INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                files INTEGER NOT NULL,
+                subdirectories BLOB NOT NULL,
+                linked BLOB NOT NULL
+            )
+        """)
+
+    def get(self, path, mtime):
+        """Return the cached (size, files, subdirectories, linked) of path, or None if it is stale."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT size, files, subdirectories, linked FROM directories WHERE path = ? AND mtime = ?",
+                (os.fsencode(os.path.abspath(path)), mtime)).fetchone()
+        if row is None:
+            return None
+        size, files, subdirectories, linked = row
+        names = [os.fsdecode(name) for name in subdirectories.split(b'\0')] if subdirectories else []
+        return size, files, names, array('Q', linked)
+
+    def put(self, path, mtime, size, files, subdirectories, linked):
+        """Store what size_directory found in path at the given mtime."""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?, ?)",
+                (os.fsencode(os.path.abspath(path)), mtime, size, files,
+                 b'\0'.join(os.fsencode(name) for name in subdirectories), linked.tobytes()))
+
+    def close(self):
+        """Commit the changes and close the database."""
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+def size_directory(path, device, cache, refresh, results):
+    """Measure the files directly inside one directory for disk_usage.
+
+    Puts (path, bytes, files, subdirectories, linked, scanned, error) on
+    results. bytes counts the directory itself and its files with a single
+    link; linked holds (device, inode, bytes) triples for files with more,
+    so disk_usage can count each of them once. A directory on another
+    device than device (when it is not None) is reported empty. With
+    refresh the cache is written but not read.
+    """
+    try:
+        info = os.lstat(path)
+        if device is not None and info.st_dev != device:
+            results.put((path, 0, 0, [], array('Q'), False, None))
+            return
+        found = cache.get(path, info.st_mtime_ns) if cache and not refresh else None
+        scanned = found is None
+        if scanned:
+            size = files = 0
+            subdirectories = []
+            linked = array('Q')
+            with os.scandir(path) as iterator:
+                for entry in iterator:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.name)
+                        continue
+                    entry_info = entry.stat(follow_symlinks=False)
+                    files += 1
+                    if entry_info.st_nlink > 1:
+                        linked.extend((entry_info.st_dev, entry_info.st_ino, entry_info.st_blocks * 512))
+                    else:
+                        size += entry_info.st_blocks * 512
+            found = (size, files, subdirectories, linked)
+            if cache:
+                cache.put(path, info.st_mtime_ns, *found)
+        size, files, subdirectories, linked = found
+        results.put((path, size + info.st_blocks * 512, files, subdirectories, linked, scanned, None))
+    except OSError as e:
+        results.put((path, 0, 0, [], array('Q'), True, e))
+
+
+class DiskUsage:
+    """The result of disk_usage: per-directory totals and counts for a tree."""
+
+    def __init__(self):
+        self.totals = {}
+        self.files = self.directories = self.scanned = 0
+        self.errors = []
+
+    def largest(self, count, max_depth=None, root=None):
+        """Return the count largest (bytes, path) subtrees, optionally no deeper than max_depth below root."""
+        paths = self.totals
+        if max_depth is not None:
+            base = root.rstrip(os.sep).count(os.sep)
+            paths = (path for path in self.totals if path.rstrip(os.sep).count(os.sep) - base <= max_depth)
+        return heapq.nlargest(count, ((self.totals[path], path) for path in paths))
+
+
+def disk_usage(root, cache=None, one_file_system=False, refresh=False, workers=FIND_WORKERS):
+    """Add up the disk space used below root, listing directories in parallel.
+
+    Directories are measured on a thread pool with size_directory as they
+    are found; unchanged ones are answered from cache without listing them.
+    Files with several hard links are counted once, like du. Subtree
+    totals are summed deepest first once the walk is done.
+    """
+    usage = DiskUsage()
+    parents = {}
+    seen = set()
+    results = queue.SimpleQueue()
+    device = os.lstat(root).st_dev if one_file_system else None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        executor.submit(size_directory, root, device, cache, refresh, results)
+        outstanding = 1
+        while outstanding:
+            path, size, files, subdirectories, linked, scanned, error = results.get()
+            outstanding -= 1
+            if error is not None:
+                usage.errors.append(f"'{path}': {error}")
+            for i in range(0, len(linked), 3):
+                inode = (linked[i], linked[i + 1])
+                if inode not in seen:
+                    seen.add(inode)
+                    size += linked[i + 2]
+            usage.totals[path] = size
+            usage.files += files
+            usage.directories += 1
+            usage.scanned += scanned
+            for name in subdirectories:
+                subdirectory = os.path.join(path, name)
+                parents[subdirectory] = path
+                executor.submit(size_directory, subdirectory, device, cache, refresh, results)
+                outstanding += 1
+    for path in sorted(parents, key=lambda path: path.count(os.sep), reverse=True):
+        usage.totals[parents[path]] += usage.totals[path]
+    return usage
+
+
+def block_signature(fd, size, block_size=SYNC_BLOCK_SIZE):
+    """Return the (weak, strong) checksums of each block of a file.
+
+    weak is an array of Adler-32 values and strong the concatenated 16-byte
+    BLAKE2b digests, the same two-level scheme rsync uses.
+    """
+    weak = array('I')
+    strong = []
+    for offset in range(0, size, block_size):
+        block = os.pread(fd, block_size, offset)
+        weak.append(zlib.adler32(block))
+        strong.append(hashlib.blake2b(block, digest_size=16).digest())
+    return weak, b''.join(strong)
+
+
+class ChecksumCache:
+    """Block signatures of files, kept in SQLite between sync runs.
+
+    Entries are keyed by path, size, mtime, ctime and inode, so any write
+    to a file invalidates its entry. Changes are committed in close().
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS signatures (
+                path TEXT PRIMARY KEY,
+                identity TEXT NOT NULL,
+                weak BLOB NOT NULL,
+                strong BLOB NOT NULL
+            )
+        """)
+
+    @staticmethod
+    def identity(info, block_size):
+        """Return the string that ties a cached signature to one version of a file."""
+        return f"{info.st_size}:{info.st_mtime_ns}:{info.st_ctime_ns}:{info.st_ino}:{block_size}"
+
+    def get(self, path, info, block_size):
+        """Return the cached (weak, strong) signature of path, or None if it is stale."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT weak, strong FROM signatures WHERE path = ? AND identity = ?",
+                (os.path.abspath(path), self.identity(info, block_size))).fetchone()
+        if row is None:
+            return None
+        weak = array('I')
+        weak.frombytes(row[0])
+        return weak, row[1]
+
+    def put(self, path, info, block_size, weak, strong):
+        """Store the signature of path as it is described by info."""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO signatures VALUES (?, ?, ?, ?)",
+                (os.path.abspath(path), self.identity(info, block_size), weak.tobytes(), strong))
+
+    def close(self):
+        """Commit the changes and close the database."""
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+def sync_file_blocks(source, target, cache=None, block_size=SYNC_BLOCK_SIZE):
+    """Update target in place to match source, writing only the blocks that differ.
+
+    The target's block signature comes from the cache when it is current,
+    otherwise it is computed by reading the target. Each source block is
+    compared by its Adler-32 sum first; the BLAKE2b digest is only needed
+    to confirm a weak match, or to refresh the cache. Returns the number
+    of bytes written.
+
+    Unlike rsync, blocks are only compared at the same offset: there is no
+    rolling search for data that has moved. Both files are local, so the
+    whole source is read either way and only writes are saved. But an
+    insertion or deletion shifts every block after it, and those are all
+    rewritten, as much as a plain copy of the rest of the file.
+    """
+    size = os.stat(source).st_size
+    with open(source, 'rb') as source_file, open(target, 'r+b') as target_file:
+        target_info = os.fstat(target_file.fileno())
+        signature = cache.get(target, target_info, block_size) if cache else None
+        if signature is None:
+            signature = block_signature(target_file.fileno(), target_info.st_size, block_size)
+        weak, strong = signature
+        new_weak = array('I')
+        new_strong = []
+        written = 0
+        for index, offset in enumerate(range(0, size, block_size)):
+            block = os.pread(source_file.fileno(), block_size, offset)
+            block_weak = zlib.adler32(block)
+            same = index < len(weak) and weak[index] == block_weak
+            digest = None
+            if same or cache:
+                digest = hashlib.blake2b(block, digest_size=16).digest()
+                same = same and strong[index * 16:index * 16 + 16] == digest
+            if not same:
+                os.pwrite(target_file.fileno(), block, offset)
+                written += len(block)
+            new_weak.append(block_weak)
+            new_strong.append(digest)
+        target_file.truncate(size)
+    shutil.copystat(source, target)
+    if cache:
+        cache.put(target, os.stat(target), block_size, new_weak, b''.join(new_strong))
+    return written
+
+
+class TreeSyncer(ParallelCopier):
+    """A ParallelCopier that only transfers what changed, like rsync.
+
+    Files whose size and mtime match are skipped. Large files that changed
+    are patched block by block with sync_file_blocks, which saves most when
+    data is changed in place rather than inserted; everything else is
+    copied whole. Files are handled on the pool, so hashing runs in
+    parallel across files.
+    """
+
+    def __init__(self, cache=None, workers=COPY_WORKERS):
+        super().__init__(resume=True, workers=workers)
+        self.cache = cache
+        self.patched = 0
+
+    def transfer(self, source, target):
+        """Copy one file, patching only changed blocks of a large existing target."""
+        if os.path.islink(source):
+            return super().transfer(source, target)
+        info = os.stat(source)
+        try:
+            existing = os.stat(target)
+        except FileNotFoundError:
+            existing = None
+        if existing is None or not stat.S_ISREG(existing.st_mode) or info.st_size < SYNC_DELTA_MIN:
+            return copy_file(source, target, resume=True)
+        if existing.st_size == info.st_size and existing.st_mtime_ns == info.st_mtime_ns:
+            return None
+        with self.lock:
+            self.patched += 1
+        return sync_file_blocks(source, target, self.cache)
+
+
+def archive_format(name):
+    """Return 'tar', 'gz', 'xz' or 'zip' for an archive file name, or None."""
+    lowered = name.lower()
+    for suffix, kind in ARCHIVE_FORMATS:
+        if lowered.endswith(suffix):
+            return kind
+    return None
+
+
+class BlockCompressor:
+    """A write-only file that compresses fixed-size blocks in parallel, like pigz.
+
+    Every block is compressed on its own into a complete gzip member (or xz
+    stream) and the results are written in order; gunzip, xz and Python's
+    gzip and lzma modules read the concatenation back as one stream. zlib
+    and lzma release the GIL while they work, so a thread pool keeps every
+    core busy without copying blocks to other processes. At most two
+    blocks per worker are held in memory.
+    """
+
+    def __init__(self, fileobj, compress, block_size=COMPRESS_BLOCK_SIZE, workers=COMPRESS_WORKERS):
+        self.fileobj = fileobj
+        self.compress = compress
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.limit = workers * 2
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.member_sizes = array('Q')
+
+    def write(self, data):
+        """Buffer data and hand every complete block to the pool."""
+        if not self.buffer and len(data) == self.block_size:
+            self.submit(bytes(data))
+            return len(data)
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def submit(self, block):
+        """Queue a block for compression, writing out finished ones once too many are pending."""
+        self.pending.append(self.executor.submit(self.compress, block))
+        while len(self.pending) > self.limit:
+            self.write_next()
+
+    def write_next(self):
+        """Wait for the oldest pending block and write its compressed form."""
+        member = self.pending.popleft().result()
+        self.fileobj.write(member)
+        self.member_sizes.append(len(member))
+
+    def flush(self):
+        """Do nothing; blocks are only complete once close() is called."""
+
+    def close(self):
+        """Compress what is buffered and write out every pending block."""
+        try:
+            if self.buffer or not (self.member_sizes or self.pending):
+                self.submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self.write_next()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+
+
+def gzip_compressor(fileobj, level=COMPRESS_LEVEL, workers=COMPRESS_WORKERS):
+    """Return a BlockCompressor writing multi-member gzip to fileobj."""
+    return BlockCompressor(fileobj, functools.partial(gzip.compress, compresslevel=level, mtime=0),
+                           workers=workers)
+
+
+def ordered_map(executor, function, items, limit):
+    """Yield function(*item) for each item in order, running at most limit calls ahead.
+
+    Unlike executor.map, items are submitted as results are consumed, so
+    memory stays bounded however many items there are.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(function, *item))
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def compress_file(source, target, level=COMPRESS_LEVEL, index=False, workers=COMPRESS_WORKERS):
+    """Compress a file to multi-member gzip on all cores and return its original size.
+
+    With index, a sidecar named target + GZIP_INDEX_SUFFIX records the size
+    of every member, so decompress can inflate members in parallel or
+    pull out a byte range by inflating only the members that hold it.
+    """
+    size = 0
+    with open(source, 'rb') as input_file, open(target, 'wb') as output_file:
+        writer = gzip_compressor(output_file, level, workers)
+        try:
+            while True:
+                block = input_file.read(COMPRESS_BLOCK_SIZE)
+                if not block:
+                    break
+                writer.write(block)
+                size += len(block)
+        finally:
+            writer.close()
+    if index:
+        with open(target + GZIP_INDEX_SUFFIX, 'wb') as index_file:
+            index_file.write(GZIP_INDEX_HEADER.pack(GZIP_INDEX_MAGIC, COMPRESS_BLOCK_SIZE, size))
+            writer.member_sizes.tofile(index_file)
+    shutil.copystat(source, target)
+    return size
+
+
+def read_gzip_index(path):
+    """Return (block size, uncompressed size, member offsets) from a gzip file's index.
+
+    The offsets include the end of the last member. None is returned when
+    there is no index, or when it no longer describes the file.
+    """
+    try:
+        with open(path + GZIP_INDEX_SUFFIX, 'rb') as index_file:
+            magic, block_size, size = GZIP_INDEX_HEADER.unpack(index_file.read(GZIP_INDEX_HEADER.size))
+            member_sizes = array('Q', index_file.read())
+    except (OSError, struct.error, ValueError):
+        return None
+    offsets = array('Q', itertools.accumulate(member_sizes, initial=0))
+    expected_members = max(1, -(-size // block_size)) if block_size else 0
+    if (magic != GZIP_INDEX_MAGIC or len(member_sizes) != expected_members
+            or offsets[-1] != os.path.getsize(path)):
+        return None
+    return block_size, size, offsets
+
+
+def inflate_member(fd, offset, size):
+    """Decompress the gzip member stored at offset in an open file."""
+    return gzip.decompress(os.pread(fd, size, offset))
+
+
+def decompress_file(source, target, workers=COMPRESS_WORKERS):
+    """Decompress a gzip file and return the decompressed size.
+
+    When the file has an index its members are inflated on a thread pool;
+    otherwise it is streamed through gzip, which reads any gzip file.
+    """
+    index = read_gzip_index(source)
+    size = 0
+    with open(source, 'rb') as input_file, open(target, 'wb') as output_file:
+        if index is None:
+            with gzip.GzipFile(fileobj=input_file) as stream:
+                while True:
+                    data = stream.read(CHUNK_SIZE * 16)
+                    if not data:
+                        break
+                    output_file.write(data)
+                    size += len(data)
+        else:
+            offsets = index[2]
+            members = ((input_file.fileno(), offsets[i], offsets[i + 1] - offsets[i])
+                       for i in range(len(offsets) - 1))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for data in ordered_map(executor, inflate_member, members, workers * 2):
+                    output_file.write(data)
+                    size += len(data)
+    shutil.copystat(source, target)
+    return size
+
+
+def decompress_range(source, start, length, write, workers=COMPRESS_WORKERS):
+    """Pass the decompressed bytes start to start + length of a gzip file to write.
+
+    With an index only the members covering the range are read and
+    inflated; without one the file is inflated from the beginning.
+    """
+    index = read_gzip_index(source)
+    with open(source, 'rb') as input_file:
+        if index is None:
+            with gzip.GzipFile(fileobj=input_file) as stream:
+                stream.seek(start)
+                while length > 0:
+                    data = stream.read(min(length, CHUNK_SIZE * 16))
+                    if not data:
+                        break
+                    write(data)
+                    length -= len(data)
+            return
+        block_size, size, offsets = index
+        end = min(start + length, size)
+        if start >= end:
+            return
+        first, last = start // block_size, (end - 1) // block_size
+        members = ((input_file.fileno(), offsets[i], offsets[i + 1] - offsets[i]) for i in range(first, last + 1))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for number, data in enumerate(ordered_map(executor, inflate_member, members, workers * 2), first):
+                base = number * block_size
+                write(data[max(start - base, 0):end - base])
+
+
+def open_tar_source(path, kind):
+    """Open a tar archive's decompressed byte stream.
+
+    gzip.open and lzma.open read every member or stream of a file written
+    by BlockCompressor, which tarfile's own streaming modes do not.
+    """
+    if kind == 'gz':
+        return gzip.open(path, 'rb')
+    if kind == 'xz':
+        return lzma.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def archive_paths(path):
+    """Yield path and, for a directory, everything below it in sorted order."""
+    yield path
+    if os.path.isdir(path) and not os.path.islink(path):
+        for directory, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames + [d for d in dirnames if os.path.islink(os.path.join(directory, d))]):
+                yield os.path.join(directory, name)
+            for name in dirnames:
+                if not os.path.islink(os.path.join(directory, name)):
+                    yield os.path.join(directory, name)
+
+
+def create_archive(name, kind, paths):
+    """Write paths into a new archive and return the number of entries stored.
+
+    The order is sorted, so the same tree always produces the same archive.
+    The archive is written under a temporary name and renamed into place
+    when it is complete, so a failure leaves no partial archive behind and
+    any previous one untouched. The archive, old or new, is skipped if it
+    lies inside one of the trees.
+    """
+    temporary = f"{name}.{os.getpid()}.tmp"
+    try:
+        count = write_archive(temporary, kind, paths, skip=[name])
+        os.replace(temporary, name)
+    except BaseException:
+        try:
+            os.unlink(temporary)
+        except OSError:
+            pass
+        raise
+    return count
+
+
+def write_archive(name, kind, paths, skip=()):
+    """Write paths into the archive file name, leaving out the files in skip, and return the entry count."""
+    count = 0
+    with open(name, 'wb') as raw:
+        info = os.fstat(raw.fileno())
+        own = {(info.st_dev, info.st_ino)}
+        for path in skip:
+            if os.path.exists(path):
+                info = os.stat(path)
+                own.add((info.st_dev, info.st_ino))
+
+        def entries():
+            for path in paths:
+                for entry in archive_paths(path):
+                    info = os.lstat(entry)
+                    if (info.st_dev, info.st_ino) not in own:
+                        yield entry
+
+        if kind == 'zip':
+            with zipfile.ZipFile(raw, 'w', zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL) as archive:
+                for entry in entries():
+                    archive.write(entry)
+                    count += 1
+            return count
+        if kind == 'gz':
+            output = gzip_compressor(raw)
+        elif kind == 'xz':
+            output = BlockCompressor(raw, lzma.compress, block_size=XZ_BLOCK_SIZE)
+        else:
+            output = raw
+        try:
+            with tarfile.open(fileobj=output, mode='w|', format=tarfile.PAX_FORMAT) as archive:
+                for entry in entries():
+                    archive.add(entry, recursive=False)
+                    count += 1
+        finally:
+            if output is not raw:
+                output.close()
+    return count
+
+
+def list_archive(path, kind):
+    """Yield (name, size, mtime) for each member of an archive without extracting anything."""
+    if kind == 'zip':
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                yield info.filename, info.file_size, time.mktime(info.date_time + (0, 0, -1))
+        return
+    with open_tar_source(path, kind) as source, tarfile.open(fileobj=source, mode='r|') as archive:
+        for member in archive:
+            yield member.name + ('/' if member.isdir() else ''), member.size, member.mtime
+
+
+def archive_member_selected(name, patterns):
+    """Whether an archive member matches a pattern or lies below a matching directory."""
+    if not patterns:
+        return True
+    name = name.rstrip('/')
+    return any(fnmatch.fnmatchcase(name, pattern) or name.startswith(pattern.rstrip('/') + '/')
+               for pattern in patterns)
+
+
+def zip_member_path(destination, name):
+    """Where ZipFile.extract puts a member: '..', '.' and absolute parts are dropped."""
+    parts = [part for part in name.split('/') if part not in ('', '.', '..')]
+    return os.path.join(destination, *parts)
+
+
+def extract_zip_members(path, names, destination):
+    """Extract some members of a zip archive through a private handle, for extract_archive."""
+    with zipfile.ZipFile(path) as archive:
+        for name in names:
+            archive.extract(name, destination)
+
+
+def extract_tar_members(path, members, destination):
+    """Copy regular members straight out of an uncompressed tar, for extract_archive."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        for member in members:
+            target = os.path.join(destination, member.name)
+            if os.path.lexists(target) and not os.path.isdir(target):
+                os.unlink(target)
+            out = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                offset, remaining = member.offset_data, member.size
+                while remaining:
+                    try:
+                        count = os.copy_file_range(fd, out, remaining, offset)
+                    except OSError as e:
+                        if e.errno not in COPY_FALLBACK_ERRORS:
+                            raise
+                        count = os.write(out, os.pread(fd, min(remaining, CHUNK_SIZE * 16), offset))
+                    if count == 0:
+                        raise tarfile.ReadError(f"unexpected end of data in {member.name}")
+                    offset += count
+                    remaining -= count
+            finally:
+                os.close(out)
+            if member.mode is not None:
+                os.chmod(target, member.mode)
+            os.utime(target, (member.mtime, member.mtime))
+    finally:
+        os.close(fd)
+
+
+def extract_archive(path, kind, destination, patterns=(), workers=ARCHIVE_WORKERS):
+    """Extract the members of an archive that match patterns and return how many there were.
+
+    Members are checked with tarfile's 'data' filter, or ZipFile's path
+    cleaning, so nothing lands outside destination. Zip archives and
+    uncompressed tars are random access, so their files are written on a
+    thread pool, the tar ones with os.copy_file_range straight from the
+    archive. A compressed tar is one stream and is extracted as it is read.
+    Directory metadata is applied last, as tar does.
+    """
+    os.makedirs(destination, exist_ok=True)
+    if kind == 'zip':
+        with zipfile.ZipFile(path) as archive:
+            names = [name for name in archive.namelist() if archive_member_selected(name, patterns)]
+        for name in names:
+            target = zip_member_path(destination, name)
+            os.makedirs(target if name.endswith('/') else os.path.dirname(target), exist_ok=True)
+        files = [name for name in names if not name.endswith('/')]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(extract_zip_members, itertools.repeat(path),
+                              [files[i::workers] for i in range(workers)], itertools.repeat(destination)))
+        return len(names)
+
+    directories = []
+
+    def extract(archive, member):
+        if member.isdir():
+            archive.extract(member, destination, set_attrs=False, filter='data')
+            directories.append(member)
+        else:
+            archive.extract(member, destination, filter='data')
+
+    if kind == 'tar':
+        with tarfile.open(path, 'r:') as archive:
+            # Later members with the same name replace earlier ones, as in tar
+            selected = {}
+            for member in archive:
+                if archive_member_selected(member.name, patterns):
+                    selected.pop(member.name, None)
+                    selected[member.name] = member
+            files = []
+            for member in selected.values():
+                if member.isreg() and not member.issparse():
+                    files.append(tarfile.data_filter(member, destination))
+                elif member.isdir():
+                    extract(archive, member)
+            for member in files:
+                os.makedirs(os.path.dirname(os.path.join(destination, member.name)), exist_ok=True)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(extract_tar_members, itertools.repeat(path),
+                                  [files[i::workers] for i in range(workers)], itertools.repeat(destination)))
+            for member in selected.values():
+                if not member.isdir() and not (member.isreg() and not member.issparse()):
+                    extract(archive, member)
+            count = len(selected)
+    else:
+        count = 0
+        with open_tar_source(path, kind) as source, tarfile.open(fileobj=source, mode='r|') as archive:
+            for member in archive:
+                if archive_member_selected(member.name, patterns):
+                    extract(archive, member)
+                    count += 1
+    for member in sorted(directories, key=lambda member: member.name, reverse=True):
+        member = tarfile.data_filter(member, destination)
+        target = os.path.join(destination, member.name)
+        os.utime(target, (member.mtime, member.mtime))
+        if member.mode is not None:
+            os.chmod(target, member.mode)
+    return count
+
+
+def parse_destination(destination):
+    """Split '[user@]host[:port]' (or '[user@][v6address]:port') into (user, host, port)."""
+    user, _, address = destination.rpartition('@')
+    host, port = address, 22
+    if address.startswith('['):
+        host, _, rest = address[1:].partition(']')
+        if rest.startswith(':'):
+            port = int(rest[1:])
+    elif address.count(':') == 1:
+        host, port = address.split(':')
+        port = int(port)
+    return user or getpass.getuser(), host, port
+
+
+def destination_key(destination):
+    """Return the pool key 'user@host:port' for a destination."""
+    return "{}@{}:{}".format(*parse_destination(destination))
+
+
+def transport_alive(client):
+    """Whether an SSHClient's transport is still connected."""
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
+
+
+class SSHPool:
+    """Authenticated SSH connections kept open and shared by the remote builtins.
+
+    Connections are paramiko SSHClients keyed by user@host:port, and every
+    command opens a new channel on the existing transport instead of doing
+    a fresh handshake. Transports send keepalives; a background thread
+    closes connections that have been idle for idle_timeout seconds, and
+    dead ones are replaced on their next use. Passwords are kept apart
+    from the connections, so an evicted connection can be re-established
+    without asking again. Only one connection attempt runs per key at a
+    time, while different hosts connect in parallel.
+    """
+
+    def __init__(self, keepalive=SSH_KEEPALIVE, idle_timeout=SSH_IDLE_TIMEOUT, timeout=SSH_CONNECT_TIMEOUT):
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.passwords = {}
+        self.connecting = defaultdict(threading.Lock)
+        self.reaper = None
+
+    def acquire(self, destination, password=None, timeout=None):
+        """Return the connection record for destination with its use count raised, connecting if needed.
+
+        A password given here is remembered, so the connection can be
+        re-established after it is evicted. timeout bounds the wait for
+        another attempt on the same key plus the connection itself; it
+        cannot exceed the pool's own connect timeout.
+        """
+        user, host, port = parse_destination(destination)
+        key = destination_key(destination)
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            connecting = self.connecting[key]
+            if password is not None:
+                self.passwords[key] = password
+            password = self.passwords.get(key)
+        if not connecting.acquire(timeout=max(timeout, 0)):
+            raise TimeoutError(f"timed out waiting to connect to {key}")
+        try:
+            with self.lock:
+                connection = self.connections.get(key)
+                if connection is not None and transport_alive(connection['client']):
+                    connection['users'] += 1
+                    return connection
+            if connection is not None:
+                self.close(key)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"timed out waiting to connect to {key}")
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.connect(host, port=port, username=user, password=password, timeout=remaining,
+                           banner_timeout=remaining, auth_timeout=remaining)
+            client.get_transport().set_keepalive(self.keepalive)
+            connection = {'key': key, 'client': client, 'users': 1, 'last_used': time.monotonic()}
+            with self.lock:
+                self.connections[key] = connection
+                if self.reaper is None:
+                    self.reaper = threading.Thread(target=self.reap, daemon=True)
+                    self.reaper.start()
+            return connection
+        finally:
+            connecting.release()
+
+    def release(self, connection):
+        """Give back a connection lent out by acquire()."""
+        with self.lock:
+            connection['users'] -= 1
+            connection['last_used'] = time.monotonic()
+
+    def connect(self, destination, password=None):
+        """Make sure a connection to destination is open and return its key."""
+        connection = self.acquire(destination, password)
+        self.release(connection)
+        return connection['key']
+
+    @contextmanager
+    def client(self, destination, password=None, timeout=None):
+        """Lend out the SSHClient for destination; it is not evicted while it is lent."""
+        connection = self.acquire(destination, password, timeout)
+        try:
+            yield connection['client']
+        finally:
+            self.release(connection)
+
+    def reap(self):
+        """Close idle and dead connections every keepalive interval."""
+        while True:
+            time.sleep(self.keepalive)
+            now = time.monotonic()
+            with self.lock:
+                stale = [self.connections.pop(key) for key, connection in list(self.connections.items())
+                         if not connection['users'] and (now - connection['last_used'] > self.idle_timeout
+                                                         or not transport_alive(connection['client']))]
+            for connection in stale:
+                connection['client'].close()
+
+    def close(self, key, forget=False):
+        """Close one connection, if it is open; forget also drops its password."""
+        with self.lock:
+            connection = self.connections.pop(key, None)
+            if forget:
+                self.passwords.pop(key, None)
+        if connection is not None:
+            connection['client'].close()
+        return connection is not None
+
+    def close_all(self, forget=False):
+        """Close every connection; forget also drops the remembered passwords."""
+        with self.lock:
+            connections, self.connections = self.connections, {}
+            if forget:
+                self.passwords.clear()
+        for connection in connections.values():
+            connection['client'].close()
+
+    def describe(self):
+        """Return (key, idle seconds, channels in use) for each open connection."""
+        now = time.monotonic()
+        with self.lock:
+            return [(key, now - connection['last_used'], connection['users'])
+                    for key, connection in sorted(self.connections.items())]
+
+
+def run_remote_command(client, command, write_stdout, write_stderr, timeout=None):
+    """Run a command on a new channel of client, passing its output on as it arrives.
+
+    stdout and stderr are read separately whenever select() reports the
+    channel readable, so memory use is bounded by the SSH channel window
+    whatever the amount of output. Returns the exit status, or -1 if the
+    server sent none. Raises TimeoutError, after closing the channel, if
+    the command runs longer than timeout seconds.
+    """
+    channel = client.get_transport().open_session(timeout=timeout)
+    try:
+        channel.exec_command(command)
+        channel.shutdown_write()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            while channel.recv_ready():
+                write_stdout(channel.recv(CHUNK_SIZE))
+            while channel.recv_stderr_ready():
+                write_stderr(channel.recv_stderr(CHUNK_SIZE))
+            if channel.exit_status_ready() and not (channel.recv_ready() or channel.recv_stderr_ready()):
+                return channel.recv_exit_status()
+            wait = 1.0 if deadline is None else min(deadline - time.monotonic(), 1.0)
+            if wait <= 0:
+                raise TimeoutError(f"timed out after {timeout:g}s")
+            select.select([channel], [], [], wait)
+    finally:
+        channel.close()
+
+
+class PrefixedLines:
+    """A byte sink that writes whole lines to a text stream, each with a prefix.
+
+    A partial last line is held back until its newline arrives, unless it
+    grows past CHUNK_SIZE. lock serialises writers sharing the stream.
+    """
+
+    def __init__(self, prefix, stream, lock):
+        self.prefix = prefix
+        self.stream = stream
+        self.lock = lock
+        self.pending = b''
+
+    def write(self, data):
+        """Emit the complete lines in data and hold back any partial last line."""
+        *lines, self.pending = (self.pending + data).split(b'\n')
+        if len(self.pending) > CHUNK_SIZE:
+            lines.append(self.pending)
+            self.pending = b''
+        self.emit(lines)
+
+    def emit(self, lines):
+        """Write lines to the stream, each with the prefix, in one locked write."""
+        if lines:
+            text = ''.join(f"{self.prefix}{line.decode('utf-8', errors='replace')}\n" for line in lines)
+            with self.lock:
+                self.stream.write(text)
+                self.stream.flush()
+
+    def close(self):
+        """Emit a held-back partial last line."""
+        if self.pending:
+            self.emit([self.pending])
+            self.pending = b''
+
+
+def read_host_groups(path):
+    """Read host groups from a file of 'name = host host ...' lines.
+
+    Hosts are [user@]host[:port]; '@name' includes another group, and
+    '#' starts a comment. A missing file means no groups.
+    """
+    groups = {}
+    try:
+        with open(path) as file:
+            for number, line in enumerate(file, 1):
+                line = line.split('#', 1)[0].strip()
+                if not line:
+                    continue
+                name, separator, hosts = line.partition('=')
+                if not separator or not name.strip():
+                    raise ValueError(f"{path}:{number}: expected 'name = hosts...'")
+                groups[name.strip()] = hosts.split()
+    except FileNotFoundError:
+        pass
+    return groups
+
+
+def expand_host_group(groups, name, seen=()):
+    """Return the hosts of a group, following '@group' references, without duplicates."""
+    if name in seen:
+        raise ValueError(f"host group '{name}' includes itself")
+    hosts = []
+    for host in groups[name]:
+        members = expand_host_group(groups, host[1:], seen + (name,)) if host.startswith('@') else [host]
+        hosts.extend(member for member in members if member not in hosts)
+    return hosts
+
+
+class SFTPSessions:
+    """Hand each thread its own SFTP session, all on one pooled SSH transport.
+
+    A session is a channel, so opening one costs a round trip rather than
+    a handshake, and separate sessions keep concurrent transfers from
+    queueing behind one another's requests.
+    """
+
+    def __init__(self, client, window_size=SFTP_WINDOW_SIZE):
+        self.transport = client.get_transport()
+        self.window_size = window_size
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.sessions = []
+
+    def get(self):
+        """Return the calling thread's SFTP session, opening it on first use."""
+        sftp = getattr(self.local, 'sftp', None)
+        if sftp is None:
+            sftp = paramiko.SFTPClient.from_transport(self.transport, window_size=self.window_size,
+                                                      max_packet_size=SFTP_PACKET_SIZE)
+            self.local.sftp = sftp
+            with self.lock:
+                self.sessions.append(sftp)
+        return sftp
+
+    def close(self):
+        """Close every session opened so far; the SSH transport stays open."""
+        with self.lock:
+            sessions, self.sessions = self.sessions, []
+        for sftp in sessions:
+            sftp.close()
+
+
+def remote_file_error(error, path):
+    """Attach path to an SFTP error, which paramiko raises without a file name."""
+    if isinstance(error, OSError) and not error.filename:
+        error.filename = path
+    return error
+
+
+def plan_get(sftp, sources, target, recursive=False, onerror=None):
+    """Return (remote, local, attributes) for each remote file to download, largest first.
+
+    Like cp, sources go into target when it is a directory and otherwise
+    become it. Local directories are created while walking; symbolic links
+    to files are followed, links to directories are not.
+    """
+    into = os.path.isdir(target)
+    if len(sources) > 1 and not into:
+        raise NotADirectoryError(errno.ENOTDIR, "Target is not a directory", target)
+    jobs = []
+    for source in sources:
+        local = os.path.join(target, posixpath.basename(source.rstrip('/'))) if into else target
+        try:
+            attributes = sftp.stat(source)
+            if not stat.S_ISDIR(attributes.st_mode):
+                jobs.append((source, local, attributes))
+                continue
+            if not recursive:
+                raise IsADirectoryError(errno.EISDIR, "Is a directory (use -r)", source)
+        except OSError as e:
+            if onerror is not None:
+                onerror(remote_file_error(e, source))
+            continue
+        directories = [(source, local)]
+        while directories:
+            remote_directory, local_directory = directories.pop()
+            try:
+                os.makedirs(local_directory, exist_ok=True)
+                entries = sftp.listdir_attr(remote_directory)
+            except OSError as e:
+                if onerror is not None:
+                    onerror(remote_file_error(e, remote_directory))
+                continue
+            for entry in entries:
+                remote = posixpath.join(remote_directory, entry.filename)
+                local = os.path.join(local_directory, entry.filename)
+                try:
+                    if stat.S_ISLNK(entry.st_mode):
+                        entry = sftp.stat(remote)
+                        if stat.S_ISDIR(entry.st_mode):
+                            continue
+                    elif stat.S_ISDIR(entry.st_mode):
+                        directories.append((remote, local))
+                        continue
+                except OSError as e:
+                    if onerror is not None:
+                        onerror(remote_file_error(e, remote))
+                    continue
+                if stat.S_ISREG(entry.st_mode):
+                    jobs.append((remote, local, entry))
+    jobs.sort(key=lambda job: job[2].st_size, reverse=True)
+    return jobs
+
+
+def plan_put(sftp, sources, target, recursive=False, onerror=None):
+    """Return (local, remote, stat result) for each local file to upload, largest first.
+
+    The counterpart of plan_get: remote directories are created while
+    walking the local trees.
+    """
+    try:
+        into = stat.S_ISDIR(sftp.stat(target).st_mode)
+    except FileNotFoundError:
+        into = False
+    if len(sources) > 1 and not into:
+        raise NotADirectoryError(errno.ENOTDIR, "Target is not a directory", target)
+    jobs = []
+    for source in sources:
+        remote = posixpath.join(target, os.path.basename(source.rstrip(os.sep))) if into else target
+        try:
+            info = os.stat(source)
+            if not stat.S_ISDIR(info.st_mode):
+                jobs.append((source, remote, info))
+                continue
+            if not recursive:
+                raise IsADirectoryError(errno.EISDIR, "Is a directory (use -r)", source)
+        except OSError as e:
+            if onerror is not None:
+                onerror(e)
+            continue
+        for directory, subdirectories, files in os.walk(source, onerror=onerror):
+            relative = os.path.relpath(directory, source)
+            remote_directory = remote if relative == '.' else posixpath.join(remote, *relative.split(os.sep))
+            try:
+                sftp.mkdir(remote_directory)
+            except OSError as e:
+                try:
+                    exists = stat.S_ISDIR(sftp.stat(remote_directory).st_mode)
+                except OSError:
+                    exists = False
+                if not exists:
+                    if onerror is not None:
+                        onerror(remote_file_error(e, remote_directory))
+                    subdirectories.clear()
+                    continue
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    info = os.stat(path)
+                except OSError as e:
+                    if onerror is not None:
+                        onerror(e)
+                    continue
+                if stat.S_ISREG(info.st_mode):
+                    jobs.append((path, posixpath.join(remote_directory, name), info))
+    jobs.sort(key=lambda job: job[2].st_size, reverse=True)
+    return jobs
+
+
+def read_pipelined(sftp, remote, offset, size, requests=SFTP_REQUESTS):
+    """Yield the bytes of a remote file from offset up to size with many reads in flight.
+
+    paramiko's prefetch fetches one segment of `requests` reads at a time,
+    and two handles on the file take turns. The next segment is therefore
+    already in flight while one is consumed, and at most two segments are
+    buffered. A single handle cannot be handed its next segment before the
+    current one is finished, and paramiko's own request limit can declare
+    a prefetch finished early and drop to one read per round trip.
+    """
+    segment = requests * paramiko.SFTPFile.MAX_REQUEST_SIZE
+    with sftp.open(remote, 'rb') as first, sftp.open(remote, 'rb') as second:
+        handles = [first, second]
+        for handle, start in zip(handles, (offset, offset + segment)):
+            if start < size:
+                handle.seek(start)
+                handle.prefetch(min(start + segment, size))
+        position = offset
+        while position < size:
+            handle = handles[0]
+            end = min(position + segment, size)
+            while position < end:
+                data = handle.read(min(CHUNK_SIZE, end - position))
+                if not data:
+                    return
+                position += len(data)
+                yield data
+            following = position + segment
+            if following < size:
+                handle.seek(following)
+                handle.prefetch(min(following + segment, size))
+            handles.reverse()
+
+
+def sftp_get_file(sftp, remote, local, attributes, resume=False, requests=SFTP_REQUESTS):
+    """Download one file with reads pipelined; return (offset, bytes transferred).
+
+    With resume, a local file shorter than the remote one is taken to be
+    a partial download and continued from its end.
+    """
+    offset = 0
+    if resume:
+        try:
+            offset = os.path.getsize(local)
+        except FileNotFoundError:
+            pass
+        if offset > attributes.st_size:
+            offset = 0
+    if offset < attributes.st_size or not resume:
+        with open(local, 'r+b' if offset else 'wb') as target:
+            target.seek(offset)
+            for data in read_pipelined(sftp, remote, offset, attributes.st_size, requests):
+                target.write(data)
+    os.utime(local, (attributes.st_atime, attributes.st_mtime))
+    os.chmod(local, stat.S_IMODE(attributes.st_mode))
+    return offset, attributes.st_size - offset
+
+
+def sftp_put_file(sftp, local, remote, info, resume=False):
+    """Upload one file with pipelined writes; return (offset, bytes transferred).
+
+    Writes are not acknowledged one by one, so the SSH channel window is
+    what limits the data in flight. resume works as in sftp_get_file.
+    """
+    offset = 0
+    if resume:
+        try:
+            offset = sftp.stat(remote).st_size
+        except FileNotFoundError:
+            pass
+        if offset > info.st_size:
+            offset = 0
+    if offset < info.st_size or not resume:
+        with open(local, 'rb') as source, sftp.open(remote, 'r+b' if offset else 'wb') as target:
+            target.set_pipelined(True)
+            source.seek(offset)
+            target.seek(offset)
+            for data in iter(lambda: source.read(CHUNK_SIZE), b''):
+                target.write(data)
+    sftp.utime(remote, (info.st_atime, info.st_mtime))
+    sftp.chmod(remote, stat.S_IMODE(info.st_mode))
+    return offset, info.st_size - offset
+
+
+EXPANSION_PATTERN = re.compile(r"""
+    ['"]                                            # quote characters
+  | \\.                                            # escaped character
+  | \$(?:
+        \{(?P<braced>[A-Za-z_][A-Za-z0-9_]*)(?::-(?P<default>[^}]*))?\}
+      | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+      | (?P<special>[?$])
+    )
+""", re.VERBOSE | re.DOTALL)
+
+
+def expand_variables(line, last_status=0):
+    """Expand $VAR, ${VAR}, ${VAR:-default}, $? and $$ in a single pass.
+
+    Only the names that appear in the line are looked up. Text inside
+    single quotes and backslash-escaped characters are left untouched;
+    unset variables expand to an empty string.
+    """
+    parts = []
+    position = 0
+    in_double_quotes = False
+    match = EXPANSION_PATTERN.search(line)
+    while match:
+        text = match.group()
+        end = match.end()
+        if text == "'" and not in_double_quotes:
+            closing = line.find("'", end)
+            end = len(line) if closing == -1 else closing + 1
+            parts.append(line[position:end])
+        elif text == '"':
+            in_double_quotes = not in_double_quotes
+            parts.append(line[position:end])
+        elif text[0] != '$':
+            parts.append(line[position:end])
+        else:
+            parts.append(line[position:match.start()])
+            if match.group('special') == '?':
+                parts.append(str(last_status))
+            elif match.group('special') == '$':
+                parts.append(str(os.getpid()))
+            elif match.group('braced'):
+                value = os.environ.get(match.group('braced'), '')
+                if not value and match.group('default') is not None:
+                    value = match.group('default')
+                parts.append(value)
+            else:
+                parts.append(os.environ.get(match.group('name'), ''))
+        position = end
+        match = EXPANSION_PATTERN.search(line, position)
+    parts.append(line[position:])
+    return ''.join(parts)
+
+
+OPERATORS = ('<<<', '&>>', '>>', '>&', '<&', '&>', '|', '&', '>', '<')
+
+
+def tokenize_command_line(line):
+    """Split a command line into words and unquoted operators.
+
+    Returns a list of (kind, value) pairs where kind is 'word' or 'op'.
+    Quoted or escaped operator characters stay part of their word, and an
+    unquoted number directly before '<' or '>' becomes part of the operator
+    (e.g. '2>' or '2>&').
+    """
+    tokens = []
+    word = []
+    in_word = False
+    quoted = False
+    i = 0
+    while i < len(line):
+        char = line[i]
+        if char in ' \t\n':
+            if in_word:
+                tokens.append(('word', ''.join(word)))
+            word, in_word, quoted = [], False, False
+        elif char == '\\':
+            if i + 1 < len(line):
+                i += 1
+                word.append(line[i])
+            in_word = quoted = True
+        elif char == "'":
+            end = line.find("'", i + 1)
+            if end == -1:
+                raise ValueError("No closing quotation")
+            word.append(line[i + 1:end])
+            i = end
+            in_word = quoted = True
+        elif char == '"':
+            i += 1
+            while i < len(line) and line[i] != '"':
+                if line[i] == '\\' and i + 1 < len(line) and line[i + 1] in '"\\$`':
+                    i += 1
+                word.append(line[i])
+                i += 1
+            if i >= len(line):
+                raise ValueError("No closing quotation")
+            in_word = quoted = True
+        elif char in '|&<>':
+            fd = ''
+            if in_word and not quoted and char in '<>' and ''.join(word).isdigit():
+                fd = ''.join(word)
+            elif in_word:
+                tokens.append(('word', ''.join(word)))
+            word, in_word, quoted = [], False, False
+            operator = next(op for op in OPERATORS if line.startswith(op, i))
+            tokens.append(('op', fd + operator))
+            i += len(operator)
+            continue
+        else:
+            word.append(char)
+            in_word = True
+        i += 1
+    if in_word:
+        tokens.append(('word', ''.join(word)))
+    return tokens
+
+
+def parse_command_line(line):
+    """Parse a command line into pipeline stages.
+
+    Returns (stages, background). Each stage is a pair (argv, redirections)
+    where redirections is a list of (fd, operator, target) tuples to be
+    applied left to right, e.g. '2>&1' becomes (2, '>&', '1').
+    """
+    tokens = tokenize_command_line(line)
+    background = bool(tokens) and tokens[-1] == ('op', '&')
+    if background:
+        tokens.pop()
+    stages = []
+    argv, redirections = [], []
+    index = 0
+    while index < len(tokens):
+        kind, value = tokens[index]
+        index += 1
+        if kind == 'word':
+            argv.append(value)
+            continue
+        if value == '|':
+            if not argv:
+                raise ValueError("syntax error near '|'")
+            stages.append((argv, redirections))
+            argv, redirections = [], []
+            continue
+        if value == '&' or index == len(tokens) or tokens[index][0] != 'word':
+            raise ValueError(f"syntax error near '{value}'")
+        target = tokens[index][1]
+        index += 1
+        fd = value.rstrip('<>&')
+        operator = value[len(fd):]
+        if operator in ('&>', '&>>'):
+            redirections.append((1, operator[1:], target))
+            redirections.append((2, '>&', '1'))
+        else:
+            redirections.append((int(fd) if fd else int(operator[0] == '>'), operator, target))
+    if argv:
+        stages.append((argv, redirections))
+    elif stages or redirections:
+        raise ValueError("syntax error: missing command")
+    return stages, background
+
+
+def apply_redirections(redirections, fds):
+    """Open the targets of redirections and install them in fds.
+
+    fds maps 0, 1 and 2 to the descriptor the child should receive, or None
+    to inherit the shell's own. Files are opened once and passed to the
+    child as raw descriptors, so the data never passes through the shell.
+    Returns the descriptors the caller must close once the child is spawned.
+    """
+    opened = []
+    try:
+        for fd, operator, target in redirections:
+            if fd not in fds:
+                raise ValueError(f"unsupported file descriptor: {fd}")
+            if operator in ('>&', '<&'):
+                if not target.isdigit() or int(target) not in fds:
+                    raise ValueError(f"bad file descriptor: {target}")
+                source = fds[int(target)]
+                fds[fd] = int(target) if source is None else source
+            elif operator == '<<<':
+                read_fd, write_fd = os.pipe()
+                opened.append(read_fd)
+                pipe = os.fdopen(write_fd, 'wb')
+                threading.Thread(target=feed_stdin, args=(pipe, to_bytes(target + '\n')), daemon=True).start()
+                fds[fd] = read_fd
+            else:
+                flags = {
+                    '<': os.O_RDONLY,
+                    '>': os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                    '>>': os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                }[operator]
+                fds[fd] = os.open(target, flags, 0o666)
+                opened.append(fds[fd])
+    except Exception:
+        for opened_fd in opened:
+            os.close(opened_fd)
+        raise
+    return opened
+
+
+STOP_SIGNALS = (signal.SIGSTOP, signal.SIGTSTP, signal.SIGTTIN, signal.SIGTTOU)
+
+
+def parse_signal(name):
+    """Return the signal for '9', 'KILL' or 'SIGKILL'."""
+    if name.isdigit():
+        return signal.Signals(int(name))
+    name = name.upper()
+    return signal.Signals[name if name.startswith('SIG') else 'SIG' + name]
+
+
+def format_rusage(rusage, elapsed):
+    """Format wall-clock time and a child's resource usage for job reports."""
+    return (f"{elapsed:.2f}s real, {rusage.ru_utime:.2f}s user, {rusage.ru_stime:.2f}s sys, "
+            f"{format_size(rusage.ru_maxrss * 1024)} max RSS")
+
+
+class Job:
+    """A background command: its process group, output spool file and, once it ends, status and resource usage."""
+
+    def __init__(self, number, process, command, spool):
+        self.number = number
+        self.process = process
+        self.pid = self.pgid = process.pid
+        self.command = command
+        self.spool = spool
+        self.started = time.monotonic()
+        self.stopped = None
+        self.state = 'Running'
+        self.status = None
+        self.rusage = None
+        self.elapsed = None
+        self.pidfd = None
+        self.shown = 0
+
+    def describe(self):
+        """Return the job's state as jobs shows it: Running, Stopped, Done, Exit N or a signal name."""
+        if self.state != 'Done':
+            return self.state
+        if self.status is None:
+            return 'Unknown'
+        if self.status == 0:
+            return 'Done'
+        if self.status > 0:
+            return f"Exit {self.status}"
+        return signal.Signals(-self.status).name
+
+    def usage(self):
+        """Return the job's resource usage, or only its running time while it has not been reaped."""
+        if self.rusage is None:
+            elapsed = self.elapsed if self.elapsed is not None else time.monotonic() - self.started
+            return f"{elapsed:.2f}s real"
+        return format_rusage(self.rusage, self.elapsed)
+
+    def exit_status(self):
+        """Return the status the shell reports for a finished job: 128 + N for signal N, 127 if unknown."""
+        if self.status is None:
+            return 127
+        return self.status if self.status >= 0 else 128 - self.status
+
+
+class JobTable:
+    """Background jobs, numbered for %n and indexed by pid and process group.
+
+    Every job runs in its own session with stdin from /dev/null and stdout
+    and stderr going to a spool file of its own, so no job can block on a
+    pipe that nobody reads, however many run at once. A watcher thread
+    reaps jobs as they exit by polling one pidfd per job; where the kernel
+    has no pidfds it wakes instead on a self-pipe written by the SIGCHLD
+    handler and checks every job. Only job pids are waited for, so
+    foreground commands still get their own exit statuses. Jobs that have
+    ended stay in the table until collect() or forget() hands them out.
+    """
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.jobs = {}
+        self.pids = {}
+        self.groups = {}
+        self.finished = []
+        self.spool_dir = None
+        self.pidfds = hasattr(os, 'pidfd_open')
+        self.unwatched = []
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+        os.set_blocking(self.wake_write, False)
+        self.sigchld = False
+        self.watcher = None
+
+    def start(self, argv):
+        """Start argv as a background job and return it."""
+        with self.lock:
+            if self.spool_dir is None:
+                self.spool_dir = tempfile.mkdtemp(prefix='custom_shell_jobs_')
+            number = max(self.jobs, default=0) + 1
+            fd, spool = tempfile.mkstemp(prefix=f"{number}-", suffix='.out', dir=self.spool_dir)
+            try:
+                process = subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=fd, stderr=subprocess.STDOUT,
+                                           start_new_session=True)
+            except OSError:
+                os.remove(spool)
+                raise
+            finally:
+                os.close(fd)
+            job = Job(number, process, ' '.join(argv), spool)
+            self.jobs[number] = self.pids[job.pid] = self.groups[job.pgid] = job
+            if self.pidfds:
+                try:
+                    job.pidfd = os.pidfd_open(job.pid)
+                    self.unwatched.append(job)
+                except OSError:
+                    # Kernels before 5.3 have no pidfds; fall back to SIGCHLD.
+                    self.pidfds = False
+            if not self.pidfds and not self.sigchld:
+                signal.signal(signal.SIGCHLD, self.wake)
+                self.sigchld = True
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=self.watch, name='job watcher', daemon=True)
+                self.watcher.start()
+        self.wake()
+        return job
+
+    def wake(self, *args):
+        """Wake the watcher thread; also the SIGCHLD handler."""
+        try:
+            os.write(self.wake_write, b'\0')
+        except BlockingIOError:
+            pass
+
+    def watch(self):
+        """Reap jobs as they end; runs on the watcher thread, which owns the poll set and the pidfds."""
+        poller = select.poll()
+        poller.register(self.wake_read, select.POLLIN)
+        watched = {}
+        while True:
+            for fd, events in poller.poll():
+                if fd != self.wake_read:
+                    # A pidfd stays readable once its process has exited,
+                    # even if the job was reaped elsewhere in the meantime.
+                    poller.unregister(fd)
+                    with self.lock:
+                        self.update(watched.pop(fd))
+                    os.close(fd)
+                    continue
+                try:
+                    while os.read(self.wake_read, CHUNK_SIZE):
+                        pass
+                except BlockingIOError:
+                    pass
+                with self.lock:
+                    for job in self.unwatched:
+                        watched[job.pidfd] = job
+                        poller.register(job.pidfd, select.POLLIN)
+                    self.unwatched = []
+                    for job in list(self.jobs.values()):
+                        if job.pidfd is None:
+                            self.update(job)
+
+    def update(self, job):
+        """Collect any changes in a job's state without blocking; the caller holds the lock."""
+        while job.state != 'Done':
+            try:
+                pid, status, rusage = os.wait4(job.pid, os.WNOHANG | os.WUNTRACED | os.WCONTINUED)
+            except ChildProcessError:
+                # Reaped by someone else; its status is lost.
+                pid, status, rusage = job.pid, None, None
+            if pid == 0:
+                return
+            if status is not None and os.WIFSTOPPED(status):
+                job.state, job.stopped = 'Stopped', time.monotonic()
+            elif status is not None and os.WIFCONTINUED(status):
+                job.state = 'Running'
+            else:
+                job.status = None if status is None else os.waitstatus_to_exitcode(status)
+                # Stops Popen from waiting for the pid itself.
+                job.process.returncode = job.exit_status()
+                job.rusage = rusage
+                job.elapsed = time.monotonic() - job.started
+                job.state = 'Done'
+                self.finished.append(job)
+                self.lock.notify_all()
+
+    def refresh(self):
+        """Pick up stops and continues, which pidfds do not report."""
+        with self.lock:
+            for job in list(self.jobs.values()):
+                self.update(job)
+
+    def current(self, previous=False):
+        """Return the current job (%+) or the one before it (%-).
+
+        The most recently stopped job comes first, then the newest running ones.
+        """
+        with self.lock:
+            jobs = sorted(self.jobs.values(),
+                          key=lambda job: (job.state == 'Stopped', job.stopped or 0, job.number), reverse=True)
+        if len(jobs) > previous:
+            return jobs[previous]
+        raise LookupError("no current job" if not previous else "no previous job")
+
+    def find(self, spec):
+        """Return the job named by %n, %%, %+, %- or a bare job number."""
+        spec = spec.strip()
+        if spec in ('', '%', '%%', '%+'):
+            return self.current()
+        if spec == '%-':
+            return self.current(previous=True)
+        number = spec[1:] if spec.startswith('%') else spec
+        with self.lock:
+            job = self.jobs.get(int(number)) if number.isdigit() else None
+        if job is None:
+            raise LookupError(f"{spec}: no such job")
+        return job
+
+    def signal(self, job, signum):
+        """Send a signal to a job's whole process group and note stops and continues."""
+        with self.lock:
+            if job.state == 'Done':
+                raise ProcessLookupError(f"[{job.number}] has already finished")
+            os.killpg(job.pgid, signum)
+            if signum in STOP_SIGNALS:
+                job.state, job.stopped = 'Stopped', time.monotonic()
+            elif signum == signal.SIGCONT:
+                job.state = 'Running'
+
+    def wait(self, jobs, timeout=None):
+        """Wait until none of jobs is running; return whether that happened before the timeout."""
+        with self.lock:
+            return self.lock.wait_for(lambda: all(job.state != 'Running' for job in jobs), timeout)
+
+    def forget(self, job):
+        """Drop a finished job from the table."""
+        with self.lock:
+            self.jobs.pop(job.number, None)
+            self.pids.pop(job.pid, None)
+            self.groups.pop(job.pgid, None)
+            if job in self.finished:
+                self.finished.remove(job)
+
+    def collect(self):
+        """Return the jobs that have finished since the last call and drop them from the table."""
+        with self.lock:
+            finished, self.finished = self.finished, []
+        for job in finished:
+            self.forget(job)
+        return sorted(finished, key=lambda job: job.number)
+
+    def running(self):
+        """Return the jobs that have not finished, stopped ones included."""
+        with self.lock:
+            return [job for job in self.jobs.values() if job.state != 'Done']
+
+    def listing(self):
+        """Return every job in the table in job number order."""
+        with self.lock:
+            return sorted(self.jobs.values(), key=lambda job: job.number)
+
+    def close(self):
+        """Remove the spool files; jobs that are still running carry on without them."""
+        if self.spool_dir is not None:
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
 
 
 class CustomShell(cmd.Cmd):
@@ -21,22 +3727,117 @@ class CustomShell(cmd.Cmd):
 
     def __init__(self):
         super().__init__()
-        self.command_history = []
+        self.command_history = deque(maxlen=HISTORY_LIMIT)
         self.aliases = defaultdict(str)
-        self.background_jobs = {}
+        self.jobs = JobTable()
+        self.removals = queue.SimpleQueue()
+        self.last_status = 0
+        self.command_cwd = None
+        self.pipestatus = []
         self.prompt = self.get_custom_prompt()
         self.history_file = os.path.expanduser("~/.custom_shell_history")
+        self.history_index = self.open_history_index()
+        self.history_writer = HistoryWriter(self.history_file, self.history_index)
+        atexit.register(self.history_writer.flush)
         self.init_history()
-        signal.signal(signal.SIGCHLD, self.handle_child_exit)
+        self.index_dir = os.path.expanduser("~/.custom_shell_index")
+        self.sync_cache_file = os.path.expanduser("~/.custom_shell_sync_cache.db")
+        self.du_cache_file = os.path.expanduser("~/.custom_shell_du_cache.db")
+        self.file_indexes = self.load_file_indexes()
+        self.listings = ListingCache()
+        self.ssh_pool = SSHPool()
+        self.remote_destination = None
+        self.hosts_file = os.path.expanduser("~/.custom_shell_hosts")
+        atexit.register(self.ssh_pool.close_all)
+        atexit.register(self.jobs.close)
 
     def init_history(self):
         """Initialize command history and load previous history if available."""
-        readline.set_history_length(1000)
-        if os.path.exists(self.history_file):
+        readline.set_history_length(HISTORY_LIMIT)
+        try:
+            # Only the tail is loaded, so startup cost does not grow with
+            # the size of a history file shared by many sessions.
+            for line in read_tail_lines(self.history_file, HISTORY_LIMIT):
+                readline.add_history(line)
+                self.command_history.append(line)
+        except FileNotFoundError:
+            pass
+
+    def open_history_index(self):
+        """Open the history search index, or return None if it is unavailable."""
+        try:
+            return HistoryIndex(self.history_file + ".db", legacy_file=self.history_file)
+        except sqlite3.Error as e:
+            print(f"History search disabled: {e}")
+            return None
+
+    def load_file_indexes(self):
+        """Return a dict of root -> FileIndex for every index that has been built."""
+        indexes = {}
+        for dirs_file in glob.glob(os.path.join(self.index_dir, '*.dirs')):
             try:
-                readline.read_history_file(self.history_file)
-            except FileNotFoundError:
-                pass
+                with open(dirs_file, 'rb') as file:
+                    root = os.fsdecode(file.readline().rstrip(b'\n'))
+            except OSError:
+                continue
+            indexes[root] = FileIndex(self.index_dir, root)
+        return indexes
+
+    def index_for(self, directory):
+        """Return the FileIndex covering a directory, or None."""
+        path = os.path.abspath(directory)
+        while True:
+            if path in self.file_indexes:
+                return self.file_indexes[path]
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+    def do_index(self, arg):
+        """Manage file indexes used by find and ls: index build <dir> | update [dir] | list | drop <dir>."""
+        try:
+            args = shlex.split(arg)
+            usage = "Usage: index build <dir> | index update [dir] | index list | index drop <dir>"
+            if not args:
+                print(usage)
+            elif args[0] == 'list':
+                for root, index in sorted(self.file_indexes.items()):
+                    age = time.time() - os.path.getmtime(index.file('.dirx'))
+                    print(f"{root}  ({os.path.getsize(index.file('.paths'))} bytes, updated {int(age)}s ago)")
+            elif args[0] in ('build', 'update'):
+                if len(args) > 1:
+                    roots = [os.path.abspath(args[1])]
+                elif args[0] == 'update':
+                    roots = sorted(self.file_indexes)
+                else:
+                    print(usage)
+                    return
+                for root in roots:
+                    if not os.path.isdir(root):
+                        print(f"'{root}' is not a valid directory.")
+                        continue
+                    if args[0] == 'update' and root not in self.file_indexes:
+                        print(f"'{root}' is not indexed. Use 'index build {root}'.")
+                        continue
+                    os.makedirs(self.index_dir, exist_ok=True)
+                    index = self.file_indexes.get(root) or FileIndex(self.index_dir, root)
+                    started = time.time()
+                    entries, directories, rescanned = index.update(rebuild=args[0] == 'build')
+                    self.file_indexes[root] = index
+                    print(f"Indexed {entries} entries in {directories} directories under '{root}' "
+                          f"({rescanned} rescanned) in {time.time() - started:.2f}s.")
+            elif args[0] == 'drop' and len(args) == 2:
+                index = self.file_indexes.pop(os.path.abspath(args[1]), None)
+                if index is None:
+                    print(f"'{args[1]}' is not indexed.")
+                else:
+                    index.remove()
+                    print(f"Index for '{index.root}' removed.")
+            else:
+                print(usage)
+        except Exception as e:
+            print(f"Error: {e}")
 
     def do_mkdir(self, arg):
         """Create directories."""
@@ -48,60 +3849,194 @@ class CustomShell(cmd.Cmd):
             print(f"Error creating directory: {e}")
 
     def do_rm(self, arg):
-            """Remove files or directories."""
-            try:
-                item_name = arg
-                if os.path.isfile(item_name):
-                    os.remove(item_name)
-                    print(f"File '{item_name}' removed successfully.")
-                elif os.path.isdir(item_name):
-                    shutil.rmtree(item_name)
-                    print(f"Directory '{item_name}' and its contents removed successfully.")
+        """Remove files or directories: rm [-rRfv] [--async] <paths/globs...>."""
+        try:
+            args = shlex.split(arg)
+            options = set()
+            names = []
+            for position, word in enumerate(args):
+                if word == '--':
+                    names.extend(args[position + 1:])
+                    break
+                if word == '--async':
+                    options.add(word)
+                elif re.fullmatch(r'-[rRfv]+', word):
+                    # Flags may be combined, as in -rf or -fr.
+                    options.update(word[1:])
+                elif word.startswith('-') and len(word) > 1:
+                    print(f"rm: invalid option '{word}'")
+                    print("Usage: rm [-rRfv] [--async] <paths/globs...>")
+                    return
                 else:
-                    print(f"'{item_name}' not found.")
-            except Exception as e:
-                print(f"Error removing '{item_name}': {e}")
+                    names.append(word)
+            paths = expand_globs(names)
+            if not paths:
+                print("Usage: rm [-rRfv] [--async] <paths/globs...>")
+                return
 
+            verbose = 'v' in options
+            lock = threading.Lock()
+
+            def report(path):
+                with lock:
+                    print(f"removed '{path}'")
+
+            for item_name in paths:
+                try:
+                    if os.path.islink(item_name) or os.path.isfile(item_name):
+                        os.remove(item_name)
+                        print(f"removed '{item_name}'" if verbose else f"File '{item_name}' removed successfully.")
+                    elif os.path.isdir(item_name):
+                        if not options & {'r', 'R'}:
+                            print(f"rm: cannot remove '{item_name}': Is a directory (use -r)")
+                            continue
+                        if '--async' in options:
+                            self.remove_in_background(item_name, verbose)
+                            print(f"Directory '{item_name}' moved aside; its contents are being removed in the background.")
+                            continue
+                        removed, errors = remove_tree(item_name, onremove=report if verbose else None)
+                        for error in errors:
+                            print(f"Error removing {error}")
+                        if not errors:
+                            print(f"Directory '{item_name}' and its contents removed successfully ({removed} entries).")
+                    elif 'f' not in options:
+                        print(f"'{item_name}' not found.")
+                except Exception as e:
+                    print(f"Error removing '{item_name}': {e}")
+        except Exception as e:
+            print(f"Error removing: {e}")
+
+    def remove_in_background(self, path, verbose=False):
+        """Rename a directory into a hidden trash directory beside it and delete it on a thread.
+
+        The rename is immediate, so the name is free at once. The thread is
+        not a daemon, so the shell waits for outstanding removals on exit.
+        Its outcome is queued for report_removals() to print at the next
+        prompt: any errors, and with verbose the number of entries removed.
+        """
+        parent = os.path.dirname(os.path.abspath(path))
+        trash = tempfile.mkdtemp(prefix='.custom_shell_trash-', dir=parent)
+        os.rename(path, os.path.join(trash, os.path.basename(os.path.abspath(path))))
+
+        def remove():
+            try:
+                removed, errors = remove_tree(trash)
+                # The trash directory itself is not one of path's entries.
+                removed -= not os.path.lexists(trash)
+            except OSError as e:
+                removed, errors = 0, [f"'{trash}': {e}"]
+            self.removals.put((path, removed, errors, verbose))
+
+        threading.Thread(target=remove, name=f"rm {path}").start()
+
+    def report_removals(self):
+        """Print the outcome of background removals that have finished since the last prompt."""
+        while True:
+            try:
+                path, removed, errors, verbose = self.removals.get_nowait()
+            except queue.Empty:
+                return
+            for error in errors:
+                print(f"rm: error removing {error}")
+            if errors or verbose:
+                print(f"rm: background removal of '{path}' finished: {removed} entries removed, "
+                      f"{len(errors)} error{'s' if len(errors) != 1 else ''}.")
 
     def save_history(self):
-        """Save command history to a file."""
-        readline.write_history_file(self.history_file)
+        """Write any pending history entries to the history file."""
+        self.history_writer.flush()
 
     def postcmd(self, stop, line):
         """Store the command in history after execution."""
-        readline.add_history(line)
-        self.command_history.append(line)
-        self.save_history()
+        # readline records interactive input itself; only the ring and the
+        # history file need the line here.
+        if line.strip():
+            self.command_history.append(line)
+            self.history_writer.add(line, self.command_cwd, self.last_status)
+        self.report_jobs(self.jobs.collect())
+        self.report_removals()
         return stop
 
+    def report_jobs(self, jobs):
+        """Print one line per finished job with its status, resource usage and spooled output."""
+        for job in jobs:
+            try:
+                output = f"; output in {job.spool}" if os.path.getsize(job.spool) > job.shown else ''
+            except OSError:
+                output = ''
+            print(f"[{job.number}]  {job.describe():<12}{job.command}  ({job.usage()}{output})")
+
     def run_command(self, args, input_data=None, output_file=None):
-        """Run a command with input/output redirection."""
-        try:
-            stdin = subprocess.PIPE if input_data else None
-            stdout = subprocess.PIPE if output_file else None
-            stderr = subprocess.PIPE
-            with open(output_file, 'w') if output_file else None as out_file:
-                process = subprocess.Popen(args, stdin=stdin, stdout=out_file, stderr=stderr, text=True)
-                stdout, stderr = process.communicate(input=input_data)
-                if process.returncode == 0:
-                    print(stdout)
-                else:
-                    print(f"Command exited with status {process.returncode}")
+        """Run a command with input/output redirection.
+
+        The child inherits the terminal's descriptors, so its output is never
+        buffered by the shell. An output file is opened once and handed to
+        the child as its stdout. If sys.stdout is not backed by a descriptor
+        (e.g. it has been replaced by a StringIO), the output is captured in
+        bounded chunks instead.
+        """
+        out_fd = None
+        try:
+            if output_file:
+                out_fd = os.open(output_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            sys.stdout.flush()
+            if out_fd is None and not has_fileno(sys.stdout):
+                encoding = getattr(sys.stdout, 'encoding', None) or 'utf-8'
+                for chunk in self.stream_command(args, input_data, encoding=encoding):
+                    sys.stdout.write(chunk)
+            else:
+                stdin = subprocess.PIPE if input_data is not None else None
+                process = subprocess.Popen(args, stdin=stdin, stdout=out_fd)
+                if out_fd is not None:
+                    os.close(out_fd)
+                    out_fd = None
+                process.communicate(input=to_bytes(input_data))
+                self.last_status = process.returncode
+            self.pipestatus = [self.last_status]
+            if self.last_status != 0:
+                print(f"Command exited with status {self.last_status}")
+        except FileNotFoundError as e:
+            self.last_status = 127
+            print(f"Error: {e}")
         except Exception as e:
+            self.last_status = 1
             print(f"Error: {e}")
-
-    def do_runscript(self, arg):
-        """Execute a script file."""
+        finally:
+            if out_fd is not None:
+                os.close(out_fd)
+
+    def stream_command(self, args, input_data=None, encoding=None, chunk_size=CHUNK_SIZE):
+        """Run a command and yield its stdout in chunks of at most chunk_size.
+
+        Chunks are bytes unless an encoding is given, in which case they are
+        decoded incrementally so multi-byte characters split across chunk
+        boundaries are preserved. The exit status is stored in last_status
+        once the output has been consumed.
+        """
+        stdin = subprocess.PIPE if input_data is not None else None
+        process = subprocess.Popen(args, stdin=stdin, stdout=subprocess.PIPE, bufsize=0)
+        if input_data is not None:
+            # Feed stdin from a thread so a large input cannot deadlock
+            # against a child that is blocked writing its output.
+            threading.Thread(target=feed_stdin, args=(process.stdin, to_bytes(input_data)), daemon=True).start()
+        decoder = codecs.getincrementaldecoder(encoding)(errors='replace') if encoding else None
         try:
-            with open(arg, 'r') as script_file:
-                script_contents = script_file.read()
-                script_lines = script_contents.split('\n')
-                for line in script_lines:
-                    self.onecmd(line)
-        except FileNotFoundError:
-            print(f"Script file not found: {arg}")
-        except Exception as e:
-            print(f"Error executing script: {e}")
+            while True:
+                chunk = process.stdout.read(chunk_size)
+                if not chunk:
+                    break
+                if decoder:
+                    chunk = decoder.decode(chunk)
+                    if not chunk:
+                        continue
+                yield chunk
+            if decoder:
+                tail = decoder.decode(b'', final=True)
+                if tail:
+                    yield tail
+        finally:
+            process.stdout.close()
+            self.last_status = process.wait()
 
     def do_setenv(self, arg):
         """Set an environment variable."""
@@ -125,92 +4060,297 @@ class CustomShell(cmd.Cmd):
 
 
     def do_mv(self, arg):
-        """Move or rename files and directories."""
+        """Move or rename files and directories: mv <sources/globs...> <destination>."""
+        source = arg
         try:
-            args = arg.split()
-            if len(args) != 2:
-                print("Usage: mv <source> <destination>")
+            args = shlex.split(arg)
+            if len(args) < 2:
+                print("Usage: mv <sources...> <destination>")
                 return
 
-            source, destination = args
-            if os.path.exists(source):
-                if os.path.isfile(source):
-                    shutil.move(source, destination)
-                    print(f"File '{source}' moved to '{destination}'.")
-                elif os.path.isdir(source):
-                    shutil.move(source, destination)
-                    print(f"Directory '{source}' moved to '{destination}'.")
-                else:
-                    print(f"'{source}' is not a valid file or directory.")
-            else:
-                print(f"'{source}' not found.")
+            *sources, destination = args
+            sources = expand_globs(sources)
+            if len(sources) > 1 and not os.path.isdir(destination):
+                print(f"'{destination}' is not a directory.")
+                return
+            for source in sources:
+                if not os.path.lexists(source):
+                    print(f"'{source}' not found.")
+                    continue
+                target = destination
+                if os.path.isdir(destination):
+                    target = os.path.join(destination, os.path.basename(source.rstrip(os.sep)))
+                kind = 'Directory' if os.path.isdir(source) and not os.path.islink(source) else 'File'
+                try:
+                    os.rename(source, target)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    if not self.move_across_devices(source, target):
+                        continue
+                print(f"{kind} '{source}' moved to '{target}'.")
         except Exception as e:
             print(f"Error moving '{source}': {e}")
 
+    def move_across_devices(self, source, target):
+        """Move between filesystems with the parallel copier and a parallel delete.
+
+        The source is only removed if every entry was copied. Returns True
+        on success.
+        """
+        copier = ParallelCopier()
+        if os.path.isdir(source) and not os.path.islink(source):
+            self.run_copier(copier, False, lambda: copier.copy_tree(source, target))
+        else:
+            self.run_copier(copier, False, lambda: copier.submit(source, target))
+        for error in copier.errors:
+            print(f"Error copying {error}")
+        if copier.errors:
+            print(f"'{source}' was not removed because the copy was incomplete.")
+            return False
+        if os.path.isdir(source) and not os.path.islink(source):
+            _, errors = remove_tree(source)
+            for error in errors:
+                print(f"Error removing {error}")
+        else:
+            os.remove(source)
+        return True
+
     def do_cp(self, arg):
-        """Copy files and directories."""
+        """Copy files and directories: cp [--resume] [--progress] <sources...> <destination>."""
         try:
-            args = arg.split()
+            args = shlex.split(arg)
+            options = {word for word in args if word in ('--resume', '--progress', '-r', '-R')}
+            args = [word for word in args if word not in options]
+            if len(args) < 2:
+                print("Usage: cp [--resume] [--progress] <sources...> <destination>")
+                return
+
+            *sources, destination = args
+            sources = expand_globs(sources)
+            if len(sources) > 1 and not os.path.isdir(destination):
+                print(f"'{destination}' is not a directory.")
+                return
+            copier = ParallelCopier(resume='--resume' in options)
+            self.run_copier(copier, '--progress' in options, lambda: self.copy_sources(copier, sources, destination))
+            for error in copier.errors:
+                print(f"Error copying {error}")
+            print(f"Copied {copier.summary()}.")
+        except Exception as e:
+            print(f"Error copying: {e}")
+
+    def copy_sources(self, copier, sources, destination):
+        """Queue each source on a ParallelCopier, copying into destination if it is a directory."""
+        for source in sources:
+            if not os.path.lexists(source):
+                print(f"'{source}' not found.")
+                continue
+            target = destination
+            if os.path.isdir(destination):
+                target = os.path.join(destination, os.path.basename(source.rstrip(os.sep)))
+            if os.path.isdir(source) and not os.path.islink(source):
+                if os.path.abspath(target).startswith(os.path.abspath(source) + os.sep):
+                    print(f"Cannot copy '{source}' into itself.")
+                    continue
+                copier.copy_tree(source, target)
+            else:
+                copier.submit(source, target)
+
+    def run_copier(self, copier, progress, queue_work):
+        """Run queue_work, wait for the copier to finish and optionally show progress every second."""
+        done = threading.Event()
+
+        def report():
+            while not done.wait(1.0):
+                print(f"\r{copier.summary()}   ", end='', flush=True)
+
+        reporter = threading.Thread(target=report, daemon=True) if progress else None
+        if reporter:
+            reporter.start()
+        try:
+            queue_work()
+        finally:
+            copier.finish()
+            done.set()
+            if reporter:
+                reporter.join()
+                print()
+
+    def do_sync(self, arg):
+        """Copy only what changed from a source to a destination: sync [--cache] [--progress] <source> <destination>."""
+        try:
+            args = shlex.split(arg)
+            options = {word for word in args if word in ('--cache', '--progress')}
+            args = [word for word in args if word not in options]
             if len(args) != 2:
-                print("Usage: cp <source> <destination>")
+                print("Usage: sync [--cache] [--progress] <source> <destination>")
                 return
 
             source, destination = args
-            if os.path.exists(source):
-                if os.path.isfile(source):
-                    shutil.copy(source, destination)
-                    print(f"File '{source}' copied to '{destination}'.")
-                elif os.path.isdir(source):
-                    shutil.copytree(source, destination)
-                    print(f"Directory '{source}' copied to '{destination}'.")
-                else:
-                    print(f"'{source}' is not a valid file or directory.")
-            else:
+            if not os.path.lexists(source):
                 print(f"'{source}' not found.")
+                return
+            cache = ChecksumCache(self.sync_cache_file) if '--cache' in options else None
+            syncer = TreeSyncer(cache)
+            try:
+                if os.path.isdir(source) and not os.path.islink(source):
+                    # Like 'rsync src/ dst': the destination mirrors the source.
+                    self.run_copier(syncer, '--progress' in options, lambda: syncer.copy_tree(source, destination))
+                else:
+                    if os.path.isdir(destination):
+                        destination = os.path.join(destination, os.path.basename(source))
+                    self.run_copier(syncer, '--progress' in options, lambda: syncer.submit(source, destination))
+            finally:
+                if cache:
+                    cache.close()
+            for error in syncer.errors:
+                print(f"Error syncing {error}")
+            print(f"Synced {syncer.summary()}, {syncer.patched} patched in place.")
         except Exception as e:
-            print(f"Error copying '{source}': {e}")
-              
+            print(f"Error syncing: {e}")
+
     def do_find(self, arg):
-        """Search for files and directories."""
+        """Search for files and directories: find <directory> [name] [-name GLOB] [-iname GLOB] [-regex RE] [-type f|d|l] [-size [+-]N[kMG]] [-mtime [+-]DAYS] [-maxdepth N] [-prune GLOB] [-limit N]."""
+        directory = arg
         try:
-            args = arg.split()
-            if len(args) != 2:
-                print("Usage: find <directory> <name>")
+            args = shlex.split(arg)
+            if not args:
+                print("Usage: find <directory> [name] [-name GLOB] [-iname GLOB] [-regex RE] [-type f|d|l] "
+                      "[-size [+-]N[kMG]] [-mtime [+-]DAYS] [-maxdepth N] [-prune GLOB] [-limit N]")
                 return
 
-            directory, name = args
-            if os.path.exists(directory) and os.path.isdir(directory):
-                found = []
-                for root, _, files in os.walk(directory):
-                    for file in files:
-                        if name in file:
-                            found.append(os.path.join(root, file))
-                if found:
-                    print("Found files:")
-                    for item in found:
-                        print(item)
+            directory = args[0]
+            options = {}
+            words = iter(args[1:])
+            for word in words:
+                if word in FIND_OPTIONS:
+                    options[word[1:]] = next(words)
+                elif word.startswith('-'):
+                    print(f"Unknown find option: {word}")
+                    return
                 else:
-                    print(f"No files matching '{name}' found in '{directory}'.")
-            else:
+                    options['contains'] = word
+            if len(args) == 2 and 'contains' in options:
+                # The original 'find <directory> <name>' form lists files only.
+                options['files_only'] = True
+            if not os.path.isdir(directory):
                 print(f"'{directory}' is not a valid directory.")
+                return
+
+            matches = build_find_filter(options)
+            prune = None
+            if 'prune' in options:
+                prune = lambda entry: fnmatch.fnmatch(entry.name, options['prune'])
+            max_depth = int(options['maxdepth']) if 'maxdepth' in options else None
+            limit = int(options['limit']) if 'limit' in options else None
+            if (max_depth or 0) < 0 or (limit or 0) < 0:
+                raise ValueError("-maxdepth and -limit must not be negative")
+
+            found = 0
+            index = self.index_for(directory)
+            query = index_query_pattern(os.path.abspath(directory), options) if index else None
+            if query is not None and not index.stale(directory):
+                # Answered from the file index; paths are shown relative to
+                # the directory as it was given.
+                absolute = os.path.abspath(directory)
+                found_paths = (directory + path[len(absolute):] for path in index.search(*query))
+                path_matches = index_result_filter(options)
+                entries = (path for path in found_paths if path_matches(path))
+            else:
+                entries = (entry.path for entry in walk_entries(
+                    directory, max_depth, prune, onerror=lambda e: print(f"find: {e}")) if matches(entry))
+            try:
+                for path in entries:
+                    if found == limit:
+                        break
+                    print(path)
+                    found += 1
+            finally:
+                entries.close()
+            if not found and limit != 0:
+                if 'contains' in options:
+                    print(f"No files matching '{options['contains']}' found in '{directory}'.")
+                else:
+                    print(f"Nothing found in '{directory}'.")
+        except StopIteration:
+            print("Missing value for find option.")
+        except (ValueError, re.error) as e:
+            print(f"Invalid find option: {e}")
         except Exception as e:
             print(f"Error searching in '{directory}': {e}")
+
     def do_cat(self, arg):
-        """Display the contents of a text file."""
+        """Display the contents of one or more files."""
         try:
             if not arg:
-                print("Usage: cat <file>")
+                print("Usage: cat <files...>")
                 return
 
-            if os.path.isfile(arg):
-                with open(arg, 'r') as file:
-                    content = file.read()
-                    print(content)
-            else:
-                print(f"'{arg}' is not a valid file.")
+            for path in expand_globs(shlex.split(arg)):
+                if not os.path.isfile(path):
+                    print(f"'{path}' is not a valid file.")
+                    continue
+                with open(path, 'rb') as file:
+                    send_to_stdout(file.fileno())
         except Exception as e:
             print(f"Error displaying '{arg}': {e}")
 
+    def do_head(self, arg):
+        """Display the first lines of files: head [-n N] <files...>."""
+        self.show_file_lines(arg, 'head')
+
+    def do_tail(self, arg):
+        """Display the last lines of files: tail [-f] [-n N] <files...>."""
+        self.show_file_lines(arg, 'tail')
+
+    def do_follow(self, arg):
+        """Follow files as they grow, like tail -F: follow [-n N] <files...>."""
+        self.show_file_lines(arg, 'follow')
+
+    def show_file_lines(self, arg, command):
+        """Implement head, tail and follow: print the first or last N lines of each file."""
+        try:
+            args = shlex.split(arg)
+            count = 10
+            follow = command == 'follow'
+            while args and re.fullmatch(r'-(n|f|\d+)', args[0]):
+                option = args.pop(0)
+                if option == '-f' and command == 'tail':
+                    follow = True
+                elif option == '-n' and args:
+                    count = int(args.pop(0))
+                elif option[1:].isdigit():
+                    count = int(option[1:])
+                else:
+                    raise ValueError(option)
+            if not args:
+                print(f"Usage: {command} [-n N] <files...>")
+                return
+
+            paths = expand_globs(args)
+            if follow:
+                follow_files(paths, count)
+                return
+            for number, path in enumerate(paths):
+                if not os.path.isfile(path):
+                    print(f"'{path}' is not a valid file.")
+                    continue
+                if len(paths) > 1:
+                    if number:
+                        print()
+                    print(f"==> {path} <==")
+                with open(path, 'rb') as file:
+                    if command == 'tail':
+                        send_to_stdout(file.fileno(), tail_offset(file, count))
+                    else:
+                        send_to_stdout(file.fileno(), 0, head_length(file, count))
+        except KeyboardInterrupt:
+            print()
+        except ValueError:
+            print(f"Invalid option. Use '{command} -n <number> <files...>'.")
+        except Exception as e:
+            print(f"Error: {e}")
+
     def do_nano(self, arg):
             """Open a basic text editor (nano) to edit a text file."""
             try:
@@ -246,27 +4386,31 @@ class CustomShell(cmd.Cmd):
                 script_lines = script_contents.split('\n')
                 for line in script_lines:
                     # Execute each line as a command.
-                    self.onecmd(line)
+                    self.onecmd(self.precmd(line))
         except Exception as e:
             print(f"Error executing script '{arg}': {e}")
 
     def do_connect(self, arg):
-        """Connect to a remote server via SSH."""
+        """Connect to a remote server via SSH: connect [user@]host[:port] [password], or connect to list connections."""
         try:
-            # Parse connection details (e.g., hostname, username, password)
-            hostname, username, password = arg.split()
-            
-            # Create an SSH client instance
-            ssh_client = paramiko.SSHClient()
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            
-            # Connect to the remote server
-            ssh_client.connect(hostname, username=username, password=password)
-            
-            # Store the SSH client for later use (e.g., executing remote commands)
-            self.remote_client = ssh_client
-            
-            print(f"Connected to {hostname}")
+            args = shlex.split(arg)
+            if not args:
+                for key, idle, users in self.ssh_pool.describe():
+                    marker = '*' if key == self.remote_destination else ' '
+                    print(f"{marker} {key}  idle {idle:.0f}s, {users} in use")
+                return
+            if len(args) == 3 and '@' not in args[0]:
+                # The original form: connect <hostname> <username> <password>
+                hostname, username, password = args
+                destination = f"{username}@{hostname}"
+            elif len(args) <= 2:
+                destination, password = args[0], (args[1] if len(args) == 2 else None)
+            else:
+                print("Usage: connect [user@]host[:port] [password]")
+                return
+
+            self.remote_destination = self.ssh_pool.connect(destination, password)
+            print(f"Connected to {self.remote_destination}")
         except Exception as e:
             print(f"Error connecting to remote server: {e}")
 
@@ -274,64 +4418,325 @@ class CustomShell(cmd.Cmd):
         """Execute a command on the remote server."""
         try:
             # Check if a remote connection is established
-            if hasattr(self, 'remote_client'):
-                stdin, stdout, stderr = self.remote_client.exec_command(arg)
-                # Print the output of the remote command
-                print(stdout.read().decode('utf-8'))
+            if self.remote_destination is not None:
+                self.run_remote(self.remote_destination, arg)
             else:
                 print("Not connected to a remote server. Use 'connect' to establish a connection.")
         except Exception as e:
             print(f"Error executing remote command: {e}")
+            self.last_status = 1
+
+    def run_remote(self, destination, command):
+        """Run a command on a pooled connection, streaming its output, and keep its exit status.
+
+        Remote stdout and stderr go to the local stdout and stderr as they
+        arrive. Ctrl-C closes the channel and sets the status to 130.
+        """
+        with self.ssh_pool.client(destination) as client:
+            try:
+                self.last_status = run_remote_command(
+                    client, command, write_output, functools.partial(write_output, stream=sys.stderr))
+            except KeyboardInterrupt:
+                print()
+                self.last_status = 130
+        self.pipestatus = [self.last_status]
+        if self.last_status != 0:
+            print(f"Command exited with status {self.last_status}")
 
     def do_disconnect(self, arg):
-        """Disconnect from the remote server."""
+        """Disconnect from a remote server: disconnect [[user@]host[:port] | all]."""
         try:
-            if hasattr(self, 'remote_client'):
-                self.remote_client.close()
-                del self.remote_client
-                print("Disconnected from the remote server.")
+            if arg.strip() == 'all':
+                self.ssh_pool.close_all(forget=True)
+                self.remote_destination = None
+                print("Disconnected from all remote servers.")
+                return
+            key = destination_key(arg.strip()) if arg.strip() else self.remote_destination
+            if key is not None and self.ssh_pool.close(key, forget=True):
+                if key == self.remote_destination:
+                    self.remote_destination = None
+                print(f"Disconnected from {key}.")
             else:
                 print("Not connected to a remote server.")
         except Exception as e:
             print(f"Error disconnecting from remote server: {e}")
 
-    def do_archive(self, arg):
-        """Create or extract archives (tar or zip)."""
+    def do_pexec(self, arg):
+        """Run a command on every host of a group at once: pexec [-j N] [-t SECONDS] [-c] <hostgroup> <command>."""
+        try:
+            concurrency, timeout, collapse = PEXEC_CONCURRENCY, PEXEC_TIMEOUT, False
+            # Only the options are parsed; the command goes to the remote shell exactly as typed.
+            while True:
+                match = re.match(r'\s*(?:(-c)|-j\s*(\d+)|-t\s*(\d+(?:\.\d*)?))\s', arg)
+                if not match:
+                    break
+                if match.group(1):
+                    collapse = True
+                elif match.group(2):
+                    concurrency = int(match.group(2))
+                else:
+                    timeout = float(match.group(3))
+                arg = arg[match.end():]
+            words = arg.split(None, 1)
+            if len(words) < 2 or concurrency < 1:
+                print("Usage: pexec [-j N] [-t SECONDS] [-c] <hostgroup> <command>")
+                print(f"Host groups are 'name = [user@]host[:port] ... @group' lines in {self.hosts_file};")
+                print("a comma-separated list of hosts works in place of a group name.")
+                return
+            group, command = words
+
+            groups = read_host_groups(self.hosts_file)
+            hosts = expand_host_group(groups, group) if group in groups else group.split(',')
+            lock = threading.Lock()
+
+            def run(host):
+                if collapse:
+                    output = tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE)
+                    sinks = (output, output)
+                else:
+                    output = None
+                    sinks = (PrefixedLines(f"{host}: ", sys.stdout, lock),
+                             PrefixedLines(f"{host}: ", sys.stderr, lock))
+                deadline = time.monotonic() + timeout
+                try:
+                    # The deadline covers connecting as well as the command.
+                    with self.ssh_pool.client(host, timeout=timeout) as client:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise TimeoutError(f"timed out after {timeout:g}s")
+                        status = run_remote_command(client, command, sinks[0].write, sinks[1].write, remaining)
+                except TimeoutError:
+                    status = f"timed out after {timeout:g}s"
+                except Exception as e:
+                    # paramiko reports banner and auth timeouts as SSHException.
+                    status = f"timed out after {timeout:g}s" if time.monotonic() >= deadline else f"error: {e}"
+                if not collapse:
+                    for sink in sinks:
+                        sink.close()
+                return host, status, output
+
+            results = []
+            with ThreadPoolExecutor(max_workers=min(concurrency, len(hosts))) as executor:
+                for host, status, output in executor.map(run, hosts):
+                    results.append((host, status, output))
+
+            if collapse:
+                outputs = OrderedDict()
+                for host, status, output in results:
+                    output.seek(0)
+                    digest = hashlib.sha256()
+                    for chunk in iter(lambda: output.read(CHUNK_SIZE), b''):
+                        digest.update(chunk)
+                    outputs.setdefault((digest.digest(), status), []).append((host, output))
+                for (digest, status), members in outputs.items():
+                    names = ', '.join(host for host, output in members)
+                    print(f"==> {names} ({len(members)} host{'s' if len(members) != 1 else ''}, "
+                          f"{'exit ' + str(status) if isinstance(status, int) else status}) <==")
+                    output = members[0][1]
+                    output.seek(0)
+                    chunk = b''
+                    for chunk in iter(lambda: output.read(CHUNK_SIZE), b''):
+                        sys.stdout.write(chunk.decode('utf-8', errors='replace'))
+                    if chunk and not chunk.endswith(b'\n'):
+                        sys.stdout.write('\n')
+                    sys.stdout.flush()
+                    for host, output in members:
+                        output.close()
+
+            statuses = defaultdict(list)
+            for host, status, output in results:
+                statuses[status].append(host)
+            succeeded = len(statuses.get(0, ()))
+            print(f"pexec: {len(hosts)} hosts, {succeeded} succeeded, {len(hosts) - succeeded} failed")
+            for status, members in sorted(statuses.items(), key=lambda item: (not isinstance(item[0], int), str(item[0]))):
+                if status != 0:
+                    label = f"exit {status}" if isinstance(status, int) else status
+                    print(f"  {label}: {', '.join(members)}")
+            self.last_status = 0 if succeeded == len(hosts) else 1
+        except Exception as e:
+            print(f"Error: {e}")
+            self.last_status = 1
+
+    def do_get(self, arg):
+        """Download files over SFTP from the connected host: get [-r] [-c] [-j N] <remote paths...> [local target]."""
+        self.sftp_transfer('get', arg)
+
+    def do_put(self, arg):
+        """Upload files over SFTP to the connected host: put [-r] [-c] [-j N] <local paths...> [remote target]."""
+        self.sftp_transfer('put', arg)
+
+    def sftp_transfer(self, direction, arg):
+        """Copy files to or from the connected host, several at a time, each on its own SFTP session.
+
+        -r copies directories recursively, -c resumes partial copies from
+        where they stopped, and -j sets how many files are copied at once.
+        """
         try:
             args = shlex.split(arg)
+            recursive = resume = False
+            workers = SFTP_WORKERS
+            while args and re.fullmatch(r'-[rc]+|-j\d*', args[0]):
+                option = args.pop(0)
+                if option.startswith('-j'):
+                    workers = int(option[2:] or args.pop(0))
+                else:
+                    recursive = recursive or 'r' in option
+                    resume = resume or 'c' in option
+            if not args or workers < 1:
+                side = 'remote' if direction == 'get' else 'local'
+                print(f"Usage: {direction} [-r] [-c] [-j N] <{side} paths...> [target]")
+                return
+            if self.remote_destination is None:
+                print("Not connected to a remote server. Use 'connect' to establish a connection.")
+                return
 
-            if not args:
-                print("Usage: archive [create/extract] <archive> <files/dirs>")
+            sources, target = (args[:-1], args[-1]) if len(args) > 1 else (args, '.')
+            if direction == 'get':
+                plan, copy = plan_get, sftp_get_file
+            else:
+                plan, copy = plan_put, sftp_put_file
+                sources = expand_globs(sources)
+            failed = []
+
+            def report(error):
+                failed.append(error)
+                print(f"Error: {error}")
+
+            with self.ssh_pool.client(self.remote_destination) as client:
+                sessions = SFTPSessions(client)
+                try:
+                    jobs = plan(sessions.get(), sources, target, recursive, report)
+
+                    def run(job):
+                        try:
+                            return copy(sessions.get(), *job, resume=resume), None
+                        except (OSError, paramiko.SSHException) as e:
+                            return None, remote_file_error(e, job[0] if direction == 'get' else job[1])
+
+                    started = time.time()
+                    total = resumed = complete = 0
+                    with ThreadPoolExecutor(max_workers=workers) as executor:
+                        for result, error in executor.map(run, jobs):
+                            if error is not None:
+                                report(error)
+                                continue
+                            offset, transferred = result
+                            total += transferred
+                            if offset and transferred:
+                                resumed += 1
+                            elif offset:
+                                complete += 1
+                finally:
+                    sessions.close()
+
+            elapsed = max(time.time() - started, 1e-6)
+            summary = (f"{'Downloaded' if direction == 'get' else 'Uploaded'} "
+                       f"{len(jobs)} file{'s' if len(jobs) != 1 else ''} ({format_size(total)}) "
+                       f"in {elapsed:.1f}s ({format_size(total / elapsed)}/s)")
+            notes = [f"{resumed} resumed"] * bool(resumed) + [f"{complete} already complete"] * bool(complete)
+            notes += [f"{len(failed)} failed"] * bool(failed)
+            print(summary + (f"; {', '.join(notes)}" if notes else ''))
+            self.last_status = 1 if failed else 0
+        except Exception as e:
+            print(f"Error: {e}")
+            self.last_status = 1
+
+    def do_archive(self, arg):
+        """Create, list or extract .tar, .tar.gz, .tar.xz and .zip archives."""
+        try:
+            args = shlex.split(arg)
+            destination = '.'
+            if '-C' in args:
+                position = args.index('-C')
+                destination = args[position + 1] if position + 1 < len(args) else None
+                del args[position:position + 2]
+
+            if (destination is None or len(args) < 2 or args[0] not in ('create', 'list', 'extract')
+                    or (args[0] == 'create' and len(args) < 3)):
+                print("Usage: archive create <archive> <files/dirs...>")
+                print("       archive list <archive>")
+                print("       archive extract <archive> [members/patterns...] [-C directory]")
                 return
 
-            operation = args[0]
-            archive_name = args[1]
-            files_to_archive = args[2:]
+            operation, archive_name, names = args[0], args[1], args[2:]
+            kind = archive_format(archive_name)
+            if kind is None:
+                print("Unsupported archive format. Use .tar, .tar.gz, .tar.xz or .zip")
+                return
 
+            started = time.time()
             if operation == 'create':
-                # Create an archive
-                if archive_name.endswith('.tar'):
-                    command = ['tar', 'czvf', archive_name] + files_to_archive
-                elif archive_name.endswith('.zip'):
-                    command = ['zip', '-r', archive_name] + files_to_archive
+                count = create_archive(archive_name, kind, names)
+                print(f"Archived {count} entries into {archive_name} "
+                      f"({format_size(os.path.getsize(archive_name))}) in {time.time() - started:.1f}s")
+            elif operation == 'list':
+                for name, size, mtime in list_archive(archive_name, kind):
+                    modified = time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime))
+                    print(f"{format_size(size):>8}  {modified}  {name}")
+            else:
+                count = extract_archive(archive_name, kind, destination, names)
+                print(f"Extracted {count} entries into {destination} in {time.time() - started:.1f}s")
+        except Exception as e:
+            print(f"Error: {e}")
+
+    def do_compress(self, arg):
+        """Compress files to gzip on all cores: compress [-1..-9] [--index] <files...>."""
+        try:
+            args = shlex.split(arg)
+            level = COMPRESS_LEVEL
+            index = False
+            while args and re.fullmatch(r'-[1-9]|--index', args[0]):
+                option = args.pop(0)
+                if option == '--index':
+                    index = True
                 else:
-                    print("Unsupported archive format. Use .tar or .zip")
-                    return
-            elif operation == 'extract':
-                # Extract an archive
-                if archive_name.endswith('.tar'):
-                    command = ['tar', 'xzvf', archive_name]
-                elif archive_name.endswith('.zip'):
-                    command = ['unzip', archive_name]
+                    level = int(option[1:])
+
+            if not args:
+                print("Usage: compress [-1..-9] [--index] <files...>")
+                return
+
+            for path in expand_globs(args):
+                target = path + '.gz'
+                if not os.path.isfile(path):
+                    print(f"'{path}' is not a valid file.")
+                elif os.path.exists(target):
+                    print(f"'{target}' already exists.")
                 else:
-                    print("Unsupported archive format. Use .tar or .zip")
-                    return
-            else:
-                print("Usage: archive [create/extract] <archive> <files/dirs>")
+                    started = time.time()
+                    size = compress_file(path, target, level, index)
+                    elapsed = max(time.time() - started, 1e-6)
+                    compressed = os.path.getsize(target)
+                    print(f"{path}: {format_size(size)} -> {format_size(compressed)} "
+                          f"({compressed / max(size, 1):.1%}) in {elapsed:.1f}s ({format_size(size / elapsed)}/s)")
+        except Exception as e:
+            print(f"Error: {e}")
+
+    def do_decompress(self, arg):
+        """Decompress gzip files: decompress <files.gz...> or decompress --range OFFSET:LENGTH <file.gz>."""
+        try:
+            args = shlex.split(arg)
+            if len(args) == 3 and args[0] == '--range':
+                start, length = (parse_size(part) for part in args[1].split(':'))
+                decompress_range(args[2], start, length, write_output)
+                return
+
+            if not args or args[0].startswith('--'):
+                print("Usage: decompress <files.gz...>")
+                print("       decompress --range OFFSET:LENGTH <file.gz>")
                 return
 
-            subprocess.run(command, text=True)
-            print(f"Command executed: {' '.join(command)}")
+            for path in expand_globs(args):
+                target = path[:-3] if path.endswith('.gz') else path + '.out'
+                if not os.path.isfile(path):
+                    print(f"'{path}' is not a valid file.")
+                elif os.path.exists(target):
+                    print(f"'{target}' already exists.")
+                else:
+                    started = time.time()
+                    size = decompress_file(path, target)
+                    elapsed = max(time.time() - started, 1e-6)
+                    print(f"{path}: {format_size(size)} in {elapsed:.1f}s ({format_size(size / elapsed)}/s)")
         except Exception as e:
             print(f"Error: {e}")
 
@@ -357,32 +4762,6 @@ class CustomShell(cmd.Cmd):
 
 
 
-    def run_piped_commands(self, args):
-        """Run piped commands."""
-        try:
-            # Split the commands based on the pipe character.
-            commands = args.split('|')
-            output = None
-
-            for cmd in commands:
-                cmd = cmd.strip()
-                cmd_args = shlex.split(cmd)
-                if output:
-                    # Use the previous command's output as input.
-                    result = subprocess.run(cmd_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, input=output)
-                else:
-                    # No previous output, start with standard input.
-                    result = subprocess.run(cmd_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-                # Update the output for the next command.
-                output = result.stdout
-
-            print(output)
-        except Exception as e:
-            print(f"Error running piped commands: {e}")
-
-    
-
     def do_useradd(self, arg):
         """Add a new user to the system."""
         try:
@@ -481,39 +4860,6 @@ class CustomShell(cmd.Cmd):
 
 
 
-    def run_piped_commands(self, args):
-            """Run piped commands."""
-            try:
-                commands = args
-                output = None
-                for cmd in commands:
-                    cmd = cmd.strip()
-                    cmd_args = shlex.split(cmd)
-                    if '|' in cmd_args:
-                        # Handle command pipelines
-                        left_pipe, right_pipe = cmd_args.index('|'), cmd_args.index('|') + 1
-                        left_cmd = cmd_args[:left_pipe]
-                        right_cmd = cmd_args[right_pipe:]
-
-                        # Execute the left command and capture its output
-                        left_result = subprocess.run(left_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, input=output)
-                        output = left_result.stdout
-
-                        # Execute the right command with the output of the left command as input
-                        right_result = subprocess.run(right_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, input=output)
-                        output = right_result.stdout
-                    else:
-                        # Execute single command
-                        if output:
-                            result = subprocess.run(cmd_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, input=output)
-                        else:
-                            result = subprocess.run(cmd_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-                        output = result.stdout
-
-                print(output)
-            except Exception as e:
-                print(f"Error: {e}")
-
     def do_runscript(self, arg):
         """Execute a script file."""
         try:
@@ -522,7 +4868,7 @@ class CustomShell(cmd.Cmd):
                 script_lines = script_contents.split('\n')
                 for line in script_lines:
                     # Execute each line of the script
-                    self.onecmd(line)
+                    self.onecmd(self.precmd(line))
         except FileNotFoundError:
             print(f"Script file not found: {arg}")
         except Exception as e:
@@ -534,17 +4880,23 @@ class CustomShell(cmd.Cmd):
 
     def precmd(self, line):
         """Expand environment variables before executing a command."""
-        for name, value in os.environ.items():
-            line = line.replace(f"${name}", value)
+        line = expand_variables(line, self.last_status)
+        # Builtins that never set a status must not inherit the previous
+        # command's, and history records where the command was started.
+        self.last_status = 0
+        try:
+            self.command_cwd = os.getcwd()
+        except OSError:
+            self.command_cwd = None
         return line
 
     def do_replay(self, arg):
         """Replay previous commands."""
         try:
-            if arg.isdigit():
+            if arg.isdigit() and int(arg) > 0:
                 num_commands = int(arg)
-                for cmd_idx in range(-num_commands, 0):
-                    self.onecmd(self.command_history[cmd_idx])
+                for cmd_line in list(self.command_history)[-num_commands:]:
+                    self.onecmd(cmd_line)
             else:
                 print("Invalid usage. Use 'replay <num_commands>' to replay the last <num_commands> commands.")
         except ValueError:
@@ -560,6 +4912,57 @@ class CustomShell(cmd.Cmd):
         except Exception as e:
             print(f"Error recording session: {e}")
 
+    def do_history(self, arg):
+        """Show history, or search it: history search [--cwd DIR] [--status N] [--limit N] <pattern>."""
+        try:
+            args = shlex.split(arg)
+            if not args:
+                for number, cmd_line in enumerate(self.command_history, 1):
+                    print(f"{number:5}  {cmd_line}")
+                return
+            usage = "Usage: history [search [--cwd DIR] [--status N] [--limit N] <pattern> | recall <pattern>]"
+            if args[0] not in ('search', 'recall') or self.history_index is None:
+                print(usage if self.history_index is not None else "History search is not available.")
+                return
+            filters = {}
+            words = []
+            rest = iter(args[1:])
+            for word in rest:
+                if word in ('--cwd', '--status', '--limit'):
+                    filters[word[2:]] = next(rest)
+                else:
+                    words.append(word)
+            self.save_history()
+            cwd = os.path.abspath(filters['cwd']) if 'cwd' in filters else None
+            status = int(filters['status']) if 'status' in filters else None
+            limit = 1 if args[0] == 'recall' else int(filters.get('limit', HISTORY_SEARCH_LIMIT))
+            results = self.history_index.search(' '.join(words), cwd, status, limit)
+            if args[0] == 'recall':
+                if results:
+                    # Like Ctrl-R: the match is placed on the next prompt for editing.
+                    self.recall_command(results[0][0])
+                else:
+                    print(f"No history entry matches '{' '.join(words)}'.")
+                return
+            for command, timestamp, entry_cwd, entry_status in reversed(results):
+                when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)) if timestamp else '-'
+                status_text = '-' if entry_status is None else entry_status
+                print(f"{when}  [{status_text}]  {entry_cwd or '-'}  {command}")
+        except StopIteration:
+            print("Missing value for history search option.")
+        except ValueError as e:
+            print(f"Invalid history search option: {e}")
+        except Exception as e:
+            print(f"Error searching history: {e}")
+
+    def recall_command(self, command):
+        """Pre-fill the next prompt with a command from history."""
+        def insert():
+            readline.insert_text(command)
+            readline.redisplay()
+            readline.set_pre_input_hook(None)
+        readline.set_pre_input_hook(insert)
+
     def do_help(self, arg):
         """Customize the help message."""
         if arg:
@@ -568,13 +4971,26 @@ class CustomShell(cmd.Cmd):
             print("Custom Shell - Available Commands:")
             print("  exit            Exit the shell")
             print("  cd <directory>  Change the current working directory")
-            print("  ls [directory]  List files and directories in the current or specified directory")
+            print("  ls [-latSrR] [paths]  List files and directories in the current or specified directory")
             print("  tmpfile         Create and work with temporary files")
             print("  whoami          Display the current user's username")
             print("  clear           Clear the screen")
             print("  replay <num_commands>  Replay the last <num_commands> commands")
             print("  record <file>   Record the session to a file")
-            print("  grep <pattern> <file>  Search for a pattern in a file")
+            print("  history search <pattern>  Search the full command history")
+            print("  index build <directory>  Index a directory tree for fast find and ls")
+            print("  cat <files...>  Display files (head/tail -n N for the first or last lines)")
+            print("  sync <source> <destination>  Copy only what changed between two trees")
+            print("  archive create|list|extract <archive> ...  Work with .tar, .tar.gz, .tar.xz and .zip")
+            print("  du [-n N] [-d DEPTH] [directories...]  Show the largest subtrees")
+            print("  hash [-a ALGORITHM] <files...>  Print sha256sum-style checksums (dupes [--link] <dirs...>)")
+            print("  sort/uniq/wc    Sort, collapse and count lines of any size, also inside pipelines")
+            print("  compress [--index] <files...>  Gzip files on all cores (decompress [--range OFF:LEN])")
+            print("  pexec [-j N] [-t SECONDS] [-c] <hostgroup> <command>  Run a command on many hosts at once")
+            print("  get/put [-r] [-c] [-j N] <paths...> [target]  Copy files over SFTP to or from the connected host")
+            print("  jobs [-l], fg/bg/wait [%n], kill [-SIG] %n  Control commands started with &")
+            print("  follow <files...>  Follow files as they grow (also tail -f)")
+            print("  grep [-icnvlF] <pattern> <files...>  Search files and directories for a pattern")
             print("  date            Display the current date and time")
             print("  ... (Other commands from previous parts)")
 
@@ -617,29 +5033,146 @@ class CustomShell(cmd.Cmd):
                 script_contents = script_file.read()
                 script_lines = script_contents.split('\n')
                 for line in script_lines:
-                    self.onecmd(line)
+                    self.onecmd(self.precmd(line))
         except FileNotFoundError:
             print(f"Batch script file not found: {arg}")
         except Exception as e:
             print(f"Error executing batch script: {e}")
 
     def do_grep(self, arg):
-        """Search for a pattern in files."""
+        """Search for a pattern in files: grep [-i] [-c] [-n] [-v] [-l] [-F] <pattern> <files/dirs/globs...>."""
         try:
             args = shlex.split(arg)
+            flags = set()
+            while args and args[0].startswith('-') and len(args[0]) > 1 and set(args[0][1:]) <= set('icnvlF'):
+                flags.update(args.pop(0)[1:])
             if len(args) < 2:
-                print("Usage: grep <pattern> <file>")
+                print("Usage: grep [-i] [-c] [-n] [-v] [-l] [-F] <pattern> <files/dirs/globs...>")
                 return
-            pattern = args[0]
-            file_name = args[1]
-            if not os.path.isfile(file_name):
-                print(f"File not found: {file_name}")
+
+            pattern = re.escape(args[0]) if 'F' in flags else args[0]
+            regex_flags = re.MULTILINE | (re.IGNORECASE if 'i' in flags else 0)
+            re.compile(os.fsencode(pattern), regex_flags)
+            files = []
+            show_names = False
+            missing = False
+            for path in expand_globs(args[1:]):
+                if os.path.isdir(path):
+                    show_names = True
+                    files.extend(sorted(entry.path for entry in walk_entries(path)
+                                        if entry.is_file(follow_symlinks=False)))
+                elif os.path.isfile(path):
+                    files.append(path)
+                else:
+                    print(f"File not found: {path}")
+                    missing = True
+            show_names = show_names or len(files) > 1
+
+            mode = 'files' if 'l' in flags else 'count' if 'c' in flags else 'lines'
+            options = dict(pattern=os.fsencode(pattern), flags=regex_flags, invert='v' in flags,
+                           line_numbers='n' in flags, mode=mode, show_name=show_names)
+            matched = False
+            if len(files) > 1 and GREP_WORKERS > 1:
+                # Files are searched in a process pool; map() keeps the
+                # results in argument order while later files are scanned.
+                # Each worker spools its output to a file that is copied
+                # to stdout in chunks once the files before it are done.
+                # Job and pipeline threads may be running, so the workers
+                # are not forked from the shell.
+                with tempfile.TemporaryDirectory(prefix='custom_shell_grep_') as spool_dir, \
+                        ProcessPoolExecutor(max_workers=GREP_WORKERS, mp_context=thread_safe_context()) as executor:
+                    search = functools.partial(grep_file_to_spool, spool_dir=spool_dir, **options)
+                    results = executor.map(search, files, chunksize=4)
+                    for path, (count, spool) in zip(files, results):
+                        with open(spool, 'rb') as output:
+                            for data in iter(lambda: output.read(CHUNK_SIZE), b''):
+                                write_output(data)
+                        os.remove(spool)
+                        matched = self.report_grep_result(path, count, b'', mode, show_names) or matched
+            else:
+                for path in files:
+                    count, output = grep_file(path, write=write_output, **options)
+                    matched = self.report_grep_result(path, count, output, mode, show_names) or matched
+            # Like grep, a missing file is an error even if other files matched.
+            self.last_status = 2 if missing else 0 if matched else 1
+        except re.error as e:
+            self.last_status = 2
+            print(f"Invalid pattern: {e}")
+        except Exception as e:
+            self.last_status = 2
+            print(f"Error: {e}")
+
+    def report_grep_result(self, path, count, output, mode, show_names):
+        """Print the result of grep_file for one file and return True if it matched."""
+        if mode == 'count':
+            print(f"{path}:{count}" if show_names else count)
+        elif mode == 'files':
+            if count:
+                print(path)
+        else:
+            write_output(output)
+        return count > 0
+
+    def do_hash(self, arg):
+        """Print checksums like sha256sum: hash [-a sha256|sha1|sha512|md5|blake2b] <files/dirs/globs...>."""
+        try:
+            args = shlex.split(arg)
+            algorithm = 'sha256'
+            if len(args) > 1 and args[0] == '-a':
+                algorithm = args[1]
+                args = args[2:]
+            if not args or algorithm not in HASH_ALGORITHMS:
+                print("Usage: hash [-a sha256|sha1|sha512|md5|blake2b] <files/dirs/globs...>")
                 return
-            with open(file_name, 'r') as file:
-                lines = file.readlines()
-                matching_lines = [line for line in lines if pattern in line]
-                for matching_line in matching_lines:
-                    print(matching_line, end='')
+
+            files = []
+            for path in expand_globs(args):
+                if os.path.isdir(path):
+                    files.extend(sorted(entry.path for entry in walk_entries(path)
+                                        if entry.is_file(follow_symlinks=False)))
+                else:
+                    files.append(path)
+
+            failed = False
+            digest_file = functools.partial(hash_file, algorithm=algorithm)
+            with ProcessPoolExecutor(max_workers=HASH_WORKERS, mp_context=thread_safe_context()) as executor:
+                results = executor.map(digest_file, files, chunksize=8) if len(files) > 1 else map(digest_file, files)
+                for path, (digest, error) in zip(files, results):
+                    if error is None:
+                        print(hash_line(digest, path))
+                    else:
+                        failed = True
+                        print(f"Error hashing '{path}': {error}")
+            self.last_status = 1 if failed else 0
+        except Exception as e:
+            print(f"Error: {e}")
+
+    def do_dupes(self, arg):
+        """Find identical files: dupes [--link] <directories/files...>."""
+        try:
+            args = shlex.split(arg)
+            link = '--link' in args
+            args = [word for word in args if word != '--link']
+            if not args:
+                print("Usage: dupes [--link] <directories/files...>")
+                return
+
+            started = time.time()
+            duplicates = find_duplicates(expand_globs(args), onerror=lambda e: print(f"Error reading {e}"))
+            wasted = freed = 0
+            for size, paths in duplicates:
+                wasted += size * (len(paths) - 1)
+                print(f"{len(paths)} files of {format_size(size)}:")
+                for path in paths:
+                    print(f"  {path}")
+                if link:
+                    try:
+                        freed += link_duplicates(paths)
+                    except OSError as e:
+                        print(f"Error linking duplicates of '{paths[0]}': {e}")
+            print(f"{len(duplicates)} duplicate sets, {format_size(wasted)} reclaimable"
+                  + (f", {format_size(freed)} freed by hard links" if link else "")
+                  + f" in {time.time() - started:.1f}s")
         except Exception as e:
             print(f"Error: {e}")
 
@@ -694,33 +5227,232 @@ class CustomShell(cmd.Cmd):
             print(f"Error changing directory: {e}")
 
     def do_ls(self, arg):
-        """List files and directories in the current directory or by pattern."""
+        """List directory contents: ls [-l] [-a] [-t] [-S] [-r] [-R] [files/dirs/globs...]."""
         try:
-            if arg:
-                files = glob.glob(arg)
-            else:
-                files = os.listdir()
-            for item in files:
-                print(item)
+            args = shlex.split(arg)
+            flags = set()
+            while args and args[0].startswith('-') and len(args[0]) > 1:
+                option = args.pop(0)
+                if not set(option[1:]) <= set('latSrR'):
+                    print("Usage: ls [-l] [-a] [-t] [-S] [-r] [-R] [files/dirs/globs...]")
+                    return
+                flags.update(option[1:])
+
+            paths = []
+            for word in args or ['.']:
+                if glob.has_magic(word):
+                    matches = self.glob_from_index(word)
+                    if matches is None:
+                        matches = glob.glob(word)
+                    paths.extend(sorted(matches) or [word])
+                else:
+                    paths.append(word)
+
+            files, directories = [], []
+            self.last_status = 0
+            for path in paths:
+                if os.path.isdir(path) and not ('l' in flags and os.path.islink(path)):
+                    directories.append(path)
+                elif os.path.lexists(path):
+                    files.append((path, path, None))
+                else:
+                    print(f"ls: cannot access '{path}': No such file or directory")
+                    self.last_status = 2
+            for line in self.format_listing(self.prepare_listing(files, flags), flags):
+                print(line)
+            headers = len(files) + len(directories) > 1 or 'R' in flags
+            for number, directory in enumerate(directories):
+                if files or number:
+                    print()
+                self.list_directory(directory, flags, headers)
         except Exception as e:
             print(f"Error listing directory: {e}")
 
+    def list_directory(self, directory, flags, header):
+        """Print one directory for ls, and its subdirectories with -R."""
+        if header:
+            print(f"{directory}:")
+        try:
+            entries = self.listings.get(directory)
+        except OSError as e:
+            print(f"ls: cannot open directory '{directory}': {e.strerror}")
+            self.last_status = 2
+            return
+        items = self.prepare_listing([(entry.name, os.path.join(directory, entry.name), entry) for entry in entries
+                                      if 'a' in flags or not entry.name.startswith('.')], flags)
+        for line in self.format_listing(items, flags, total=True):
+            print(line)
+        if 'R' in flags:
+            for name, path, entry, _ in items:
+                if entry.is_dir(follow_symlinks=False):
+                    print()
+                    self.list_directory(path, flags, header)
+
+    def prepare_listing(self, items, flags):
+        """Turn (name, path, entry) items into sorted (name, path, entry, stat) items for ls.
+
+        Entries are only stat()ed when -l, -t or -S needs their metadata;
+        otherwise stat is None. The order is by name, or newest or largest
+        first with -t or -S, reversed by -r.
+        """
+        if flags & {'l', 't', 'S'}:
+            described = []
+            for name, path, entry in items:
+                try:
+                    described.append((name, path, entry, os.lstat(path)))
+                except OSError:
+                    pass
+        else:
+            described = [(name, path, entry, None) for name, path, entry in items]
+        described.sort(key=lambda item: item[0])
+        if 't' in flags or 'S' in flags:
+            field = 'st_mtime_ns' if 't' in flags else 'st_size'
+            described.sort(key=lambda item: getattr(item[3], field), reverse=True)
+        return described[::-1] if 'r' in flags else described
+
+    def format_listing(self, items, flags, total=False):
+        """Return the lines ls prints for items from prepare_listing.
+
+        Short listings are laid out in columns when stdout is a terminal.
+        """
+        if 'l' in flags:
+            lines = format_long([(name, path, info) for name, path, _, info in items])
+            if total:
+                lines.insert(0, f"total {sum(item[3].st_blocks for item in items) // 2}")
+            return lines
+        names = [item[0] for item in items]
+        if has_fileno(sys.stdout) and sys.stdout.isatty():
+            return format_columns(names, shutil.get_terminal_size().columns)
+        return names
+
+    def completedefault(self, text, line, begidx, endidx):
+        """Complete file names for any command, from the ls listing cache."""
+        word = line[:endidx].rpartition(' ')[2]
+        directory, prefix = os.path.split(word)
+        try:
+            entries = self.listings.get(directory or '.')
+        except OSError:
+            return []
+        matches = []
+        for entry in entries:
+            if entry.name.startswith(prefix) and (prefix.startswith('.') or not entry.name.startswith('.')):
+                candidate = os.path.join(directory, entry.name) + ('/' if entry.is_dir() else '')
+                matches.append(candidate[len(word) - len(text):])
+        return sorted(matches)
+
+    def glob_from_index(self, pattern):
+        """Expand a glob whose wildcards are all in the last component from a file index.
+
+        Returns None when no index covers the directory, so the caller can
+        fall back to glob.glob.
+        """
+        directory, name = os.path.split(pattern)
+        if not glob.has_magic(name) or glob.has_magic(directory):
+            return None
+        index = self.index_for(directory or '.')
+        children = index.children(directory or '.') if index else None
+        if children is None:
+            return None
+        return [os.path.join(directory, child) for child, _ in children
+                if fnmatch.fnmatch(child, name) and (name.startswith('.') or not child.startswith('.'))]
+
     def default(self, line):
         """Run a system command."""
         try:
-            args = shlex.split(line)
-            if '&' in args:
-                args.remove('&')
-                self.run_command_background(args)
-            elif '|' in args:
-                self.run_piped_commands(args)
+            stages, background = parse_command_line(line)
+            if not stages:
+                return
+            if background:
+                if len(stages) > 1 or stages[0][1]:
+                    print("Background pipelines and redirections are not supported.")
+                    return
+                self.run_command_background(self.expand_alias(stages[0][0]))
+            elif len(stages) > 1 or stages[0][1]:
+                self.run_piped_commands(stages)
             else:
-                if args[0] in self.aliases:
-                    args[0] = self.aliases[args[0]]
-                self.run_command(args)
+                self.run_command(self.expand_alias(stages[0][0]))
         except Exception as e:
             print(f"Error: {e}")
 
+    def onecmd(self, line):
+        """Run a line, sending every pipeline and redirection to default().
+
+        cmd.Cmd would otherwise hand 'sort big | uniq -c' to do_sort with
+        '| uniq -c' as its argument. Builtins that take a remote command
+        line get the whole line untouched, pipes included.
+        """
+        if line.split(None, 1)[:1] in (['pexec'], ['remote_exec'], ['ssh']):
+            return super().onecmd(line)
+        try:
+            stages, background = parse_command_line(line)
+        except ValueError:
+            stages, background = [], False
+        if not background and (len(stages) > 1 or (stages and stages[0][1])):
+            self.lastcmd = line
+            return self.default(line)
+        return super().onecmd(line)
+
+    def run_stream_builtin(self, argv, stdin_fd=None, stdout_fd=None, stderr_fd=None, streams=None):
+        """Run sort, uniq or wc on raw descriptors and return its exit status.
+
+        None stands for the shell's own stdin, stdout or stderr, or for
+        the matching entry of streams when that is given. Descriptors
+        passed in belong to the builtin and are closed when it finishes.
+        A reader that goes away early ends the builtin with status 141, as
+        SIGPIPE would.
+        """
+        def stream(fd, mode, standard):
+            if fd is not None:
+                return open(fd, mode, buffering=CHUNK_SIZE * 4)
+            if has_fileno(standard):
+                if 'w' in mode:
+                    standard.flush()
+                return open(standard.fileno(), mode, buffering=CHUNK_SIZE * 4, closefd=False)
+            return io.BufferedWriter(StdoutWriter(standard), CHUNK_SIZE * 4) if 'w' in mode else standard.buffer
+
+        standard_in, standard_out, standard_err = streams or (sys.stdin, sys.stdout, sys.stderr)
+        try:
+            with ExitStack() as stack:
+                stdin = stack.enter_context(stream(stdin_fd, 'rb', standard_in))
+                stdout = stack.enter_context(stream(stdout_fd, 'wb', standard_out))
+                stderr = stack.enter_context(stream(stderr_fd, 'wb', standard_err))
+                try:
+                    return STREAM_BUILTINS[argv[0]](list(argv[1:]), stdin, stdout, stderr)
+                except BrokenPipeError:
+                    raise
+                except (OSError, ValueError) as e:
+                    stderr.write(os.fsencode(f"{argv[0]}: {e}\n"))
+                    return 2 if isinstance(e, ValueError) else 1
+        except BrokenPipeError:
+            return 141
+
+    def do_sort(self, arg):
+        """Sort lines, spilling to disk for large input: sort [-r] [-n] [-f] [-u] [-k N[,M]] [-t SEP] [-S SIZE] [files...]."""
+        try:
+            self.last_status = self.run_stream_builtin(['sort'] + shlex.split(arg))
+        except Exception as e:
+            print(f"Error: {e}")
+
+    def do_uniq(self, arg):
+        """Collapse repeated lines: uniq [-c] [-d] [-u] [-i] [input]."""
+        try:
+            self.last_status = self.run_stream_builtin(['uniq'] + shlex.split(arg))
+        except Exception as e:
+            print(f"Error: {e}")
+
+    def do_wc(self, arg):
+        """Count lines, words and bytes: wc [-l] [-w] [-c] [files...]."""
+        try:
+            self.last_status = self.run_stream_builtin(['wc'] + shlex.split(arg))
+        except Exception as e:
+            print(f"Error: {e}")
+
+    def expand_alias(self, args):
+        """Replace the command name with its alias definition, if any."""
+        if args and args[0] in self.aliases:
+            return shlex.split(self.aliases[args[0]]) + args[1:]
+        return args
+
     def do_alias(self, arg):
         """Define a command alias."""
         try:
@@ -738,49 +5470,204 @@ class CustomShell(cmd.Cmd):
         else:
             print(f"Alias '{arg}' not found.")
 
-    def do_bg(self, arg):
-        """List and manage background jobs."""
-        if arg == '':
-            self.list_background_jobs()
-        else:
-            args = shlex.split(arg)
-            if len(args) == 1 and args[0].isdigit():
-                job_id = int(args[0])
-                self.resume_background_job(job_id)
+    def do_jobs(self, arg):
+        """List background jobs: jobs [-l]. -l adds pids, resource usage and spool files."""
+        self.jobs.refresh()
+        current = previous = None
+        try:
+            current = self.jobs.current()
+            previous = self.jobs.current(previous=True)
+        except LookupError:
+            pass
+        for job in self.jobs.listing():
+            mark = '+' if job is current else '-' if job is previous else ' '
+            if arg.strip() == '-l':
+                print(f"[{job.number}]{mark} {job.pid:>7} {job.describe():<12}{job.command}")
+                print(f"          {job.usage()}; output in {job.spool}")
             else:
-                print("Invalid usage. Use 'bg' to list background jobs or 'bg <job_id>' to resume a job.")
+                print(f"[{job.number}]{mark}  {job.describe():<12}{job.command}")
+        self.jobs.collect()
 
-    def list_background_jobs(self):
-        """List background jobs."""
-        for job_id, cmd in self.background_jobs.items():
-            print(f"[{job_id}] {cmd}")
+    def do_fg(self, arg):
+        """Bring a job to the foreground: fg [%n]. Its spooled output is shown as it is written.
 
-    def run_command_background(self, args):
-        """Run a command in the background."""
+        Ctrl-C is passed on to the job and Ctrl-Z stops it again.
+        """
         try:
-            process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            job_id = len(self.background_jobs) + 1
-            self.background_jobs[job_id] = ' '.join(args)
-            print(f"Background job {job_id} started.")
+            job = self.jobs.find(arg)
+            print(job.command)
+            if job.state == 'Stopped':
+                self.jobs.signal(job, signal.SIGCONT)
+            stopped = []
+
+            def stop(signum, frame):
+                self.jobs.signal(job, signal.SIGSTOP)
+                stopped.append(signum)
+
+            previous = signal.signal(signal.SIGTSTP, stop)
+            try:
+                with open(job.spool, 'rb') as spool:
+                    spool.seek(job.shown)
+                    while True:
+                        try:
+                            # Drain the spool after seeing the job end, so its last output is not lost.
+                            done = job.state == 'Done'
+                            data = spool.read(CHUNK_SIZE)
+                            if data:
+                                write_output(data)
+                                job.shown += len(data)
+                            elif done or stopped:
+                                break
+                            else:
+                                self.jobs.wait([job], timeout=0.1)
+                        except KeyboardInterrupt:
+                            self.jobs.signal(job, signal.SIGINT)
+            finally:
+                signal.signal(signal.SIGTSTP, previous)
+
+            if stopped:
+                print(f"\n[{job.number}]+  Stopped     {job.command}")
+                self.last_status = 128 + signal.SIGTSTP
+                return
+            self.jobs.forget(job)
+            self.last_status = job.exit_status()
+            if self.last_status != 0:
+                print(f"Command exited with status {self.last_status}")
+        except (LookupError, ProcessLookupError) as e:
+            print(f"fg: {e}")
+            self.last_status = 1
         except Exception as e:
             print(f"Error: {e}")
+            self.last_status = 1
 
-    def run_piped_commands(self, args):
-        """Run piped commands."""
+    def do_bg(self, arg):
+        """Resume stopped jobs in the background: bg [%n ...]."""
         try:
-            commands = args
-            output = None
-            for cmd in commands:
-                cmd = cmd.strip()
-                cmd_args = shlex.split(cmd)
-                if output:
-                    result = subprocess.run(cmd_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, input=output)
-                else:
-                    result = subprocess.run(cmd_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-                output = result.stdout
-            print(output)
+            for spec in shlex.split(arg) or ['%+']:
+                job = self.jobs.find(spec)
+                if job.state == 'Stopped':
+                    self.jobs.signal(job, signal.SIGCONT)
+                print(f"[{job.number}]  {job.command} &")
+            self.last_status = 0
+        except (LookupError, ProcessLookupError) as e:
+            print(f"bg: {e}")
+            self.last_status = 1
         except Exception as e:
             print(f"Error: {e}")
+            self.last_status = 1
+
+    def do_wait(self, arg):
+        """Wait for background jobs to finish: wait [%n ...]. With no argument, waits for all running jobs."""
+        try:
+            specs = shlex.split(arg)
+            jobs = [self.jobs.find(spec) for spec in specs] if specs else self.jobs.running()
+            try:
+                self.jobs.wait(jobs)
+            except KeyboardInterrupt:
+                print()
+                self.last_status = 130
+                return
+            self.report_jobs(self.jobs.collect())
+            # Like the shell's wait, the status is that of the last job named.
+            self.last_status = jobs[-1].exit_status() if jobs and jobs[-1].state == 'Done' else 0
+        except (LookupError, ProcessLookupError) as e:
+            print(f"wait: {e}")
+            self.last_status = 127
+        except Exception as e:
+            print(f"Error: {e}")
+            self.last_status = 1
+
+    def run_command_background(self, args):
+        """Run a command in the background as a job whose output is spooled to a file."""
+        try:
+            job = self.jobs.start(args)
+            print(f"[{job.number}] {job.pid}")
+            self.last_status = 0
+        except FileNotFoundError as e:
+            self.last_status = 127
+            print(f"Error: {e}")
+        except Exception as e:
+            print(f"Error: {e}")
+            self.last_status = 1
+
+    def run_piped_commands(self, stages):
+        """Run a pipeline with every stage connected by OS pipes.
+
+        stages is a list of (argv, redirections) pairs as returned by
+        parse_command_line. All stages are started before any of them is
+        waited on, so data streams through kernel pipe buffers instead of
+        being collected in the shell. The last stage writes straight to the
+        terminal unless it is redirected. sort, uniq and wc run as builtin
+        stages inside the shell, on the same pipes. PIPELINE_BUILTINS read
+        no input, so they only run at the head of a pipeline whose stdin is
+        not redirected, as a ShellStage once everything else has started;
+        anywhere else the program of that name is run instead. A stage
+        that cannot be started gets status 127 (126 if it is not
+        executable, 1 for a failed redirection) in pipestatus.
+        """
+        processes = []
+        read_fd = None
+        try:
+            for index, (argv, redirections) in enumerate(stages):
+                fds = {0: read_fd, 1: None, 2: None}
+                owned = [] if read_fd is None else [read_fd]
+                read_fd = None
+                try:
+                    if index < len(stages) - 1:
+                        read_fd, fds[1] = os.pipe()
+                        owned.append(fds[1])
+                    owned.extend(apply_redirections(redirections, fds))
+                    argv = self.expand_alias(argv)
+                    if argv[0] in STREAM_BUILTINS:
+                        # The builtin runs on a thread with its own copies of
+                        # the descriptors, which it closes when it is done.
+                        stage = BuiltinStage(self.run_stream_builtin, argv,
+                                             [None if fd is None else os.dup(fd) for fd in (fds[0], fds[1], fds[2])])
+                        stage.start()
+                        processes.append(stage)
+                    elif (index == 0 and argv[0] in PIPELINE_BUILTINS
+                          and not any(fd == 0 for fd, _, _ in redirections)):
+                        processes.append(ShellStage(self.run_builtin_stage, argv,
+                                                    [None if fd is None else os.dup(fd) for fd in (fds[1], fds[2])]))
+                    else:
+                        processes.append(subprocess.Popen(argv, stdin=fds[0], stdout=fds[1], stderr=fds[2]))
+                except Exception as e:
+                    # Like bash, the rest of the pipeline still runs; this
+                    # stage's neighbours see its pipe ends closed.
+                    print(f"Error: {e}")
+                    status = 127 if isinstance(e, FileNotFoundError) else 126 if isinstance(e, PermissionError) else 1
+                    processes.append(FailedStage(status))
+                finally:
+                    # Only the children keep the pipe ends, so a writer gets
+                    # SIGPIPE if its reader exits early.
+                    for fd in owned:
+                        os.close(fd)
+        except Exception as e:
+            print(f"Error: {e}")
+            if read_fd is not None:
+                os.close(read_fd)
+        finally:
+            for process in processes:
+                if isinstance(process, ShellStage):
+                    process.run()
+            self.pipestatus = [process.wait() for process in processes]
+
+        if len(processes) == len(stages):
+            self.last_status = self.pipestatus[-1]
+            if self.last_status != 0:
+                print(f"Command exited with status {self.last_status}")
+        else:
+            self.last_status = 127
+
+    def run_builtin_stage(self, argv):
+        """Run a builtin named in a pipeline stage and return its exit status."""
+        self.last_status = 0
+        getattr(self, 'do_' + argv[0])(shlex.join(argv[1:]))
+        return self.last_status
+
+    def do_pipestatus(self, arg):
+        """Show the exit status of every stage of the last pipeline."""
+        print(' '.join(str(status) for status in self.pipestatus))
 
     def do_ping(self, arg):
         """Ping a host to check network connectivity."""
@@ -852,6 +5739,46 @@ class CustomShell(cmd.Cmd):
         except Exception as e:
             print(f"Error: {e}")
     
+    def do_du(self, arg):
+        """Show the largest subtrees: du [-n N] [-d DEPTH] [-s] [-x] [--refresh] [directories...]."""
+        try:
+            args = shlex.split(arg)
+            top, max_depth = DU_TOP, None
+            summary = one_file_system = refresh = False
+            while args and args[0].startswith('-'):
+                option = args.pop(0)
+                if option == '-n' and args:
+                    top = int(args.pop(0))
+                elif option == '-d' and args:
+                    max_depth = int(args.pop(0))
+                elif option in ('-s', '-x', '--refresh'):
+                    summary = summary or option == '-s'
+                    one_file_system = one_file_system or option == '-x'
+                    refresh = refresh or option == '--refresh'
+                else:
+                    print("Usage: du [-n N] [-d DEPTH] [-s] [-x] [--refresh] [directories...]")
+                    return
+
+            cache = DirectorySizeCache(self.du_cache_file)
+            try:
+                for root in expand_globs(args) or ['.']:
+                    if not os.path.isdir(root):
+                        print(f"'{root}' is not a valid directory.")
+                        continue
+                    started = time.time()
+                    usage = disk_usage(root, cache, one_file_system, refresh)
+                    for error in usage.errors:
+                        print(f"Error reading {error}")
+                    if not summary:
+                        for size, path in usage.largest(top, max_depth, root):
+                            print(f"{format_size(size):>8}  {path}")
+                    print(f"{format_size(usage.totals[root]):>8}  {root} total: {usage.files} files, "
+                          f"{usage.directories} directories, {usage.scanned} listed in {time.time() - started:.1f}s")
+            finally:
+                cache.close()
+        except Exception as e:
+            print(f"Error: {e}")
+
     def do_ps(self, arg):
         """List running processes using 'ps'."""
         try:
@@ -860,16 +5787,42 @@ class CustomShell(cmd.Cmd):
             print(f"Error: {e}")
 
     def do_kill(self, arg):
-        """Terminate a process using 'kill'."""
+        """Send a signal to jobs or processes: kill [-SIGNAL | -s SIGNAL] <%n | pid>..., or kill -l."""
         try:
-            if not arg:
-                print("Usage: kill <process_id>")
+            args = shlex.split(arg)
+            if args == ['-l']:
+                print(' '.join(sig.name[3:] for sig in sorted(signal.Signals, key=int)))
+                return
+            signum = signal.SIGTERM
+            if len(args) > 1 and args[0] == '-s':
+                signum = parse_signal(args[1])
+                args = args[2:]
+            elif args and args[0].startswith('-'):
+                signum = parse_signal(args.pop(0)[1:])
+            if not args:
+                print("Usage: kill [-SIGNAL | -s SIGNAL] <%job | pid>...")
                 return
 
-            process_id = arg.strip()
-            os.system(f'kill {process_id}')
+            failed = False
+            for target in args:
+                try:
+                    if target.startswith('%'):
+                        self.jobs.signal(self.jobs.find(target), signum)
+                    else:
+                        os.kill(int(target), signum)
+                except LookupError as e:
+                    print(f"kill: {e}")
+                    failed = True
+                except (ValueError, OSError) as e:
+                    print(f"kill: {target}: {e}")
+                    failed = True
+            self.last_status = 1 if failed else 0
+        except (KeyError, ValueError) as e:
+            print(f"kill: invalid signal: {e}")
+            self.last_status = 1
         except Exception as e:
             print(f"Error: {e}")
+            self.last_status = 1
 
     def do_who(self, arg):
         """Display information about logged-in users using 'who'."""
@@ -928,34 +5881,18 @@ class CustomShell(cmd.Cmd):
     def do_ssh(self, arg):
         """Connect to a remote host via SSH."""
         try:
-            # Parse the SSH command-line arguments
-            args = shlex.split(arg)
+            # The command goes to the remote shell exactly as typed
+            args = arg.split(None, 1)
 
             if len(args) < 2:
-                print("Usage: ssh <user@hostname> <command>")
+                print("Usage: ssh <[user@]hostname[:port]> <command>")
                 return
 
-            host = args[0]
-            command = ' '.join(args[1:])
-
-            # Create an SSH client
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-            # Connect to the remote host
-            ssh.connect(host)
-
-            # Execute the remote command
-            stdin, stdout, stderr = ssh.exec_command(command)
-            output = stdout.read().decode('utf-8')
-
-            # Print the remote command's output
-            print(output)
-
-            # Close the SSH connection
-            ssh.close()
+            host, command = args
+            self.run_remote(host, command)
         except Exception as e:
             print(f"Error: {e}")
+            self.last_status = 1
 
     def do_git(self, arg):
         """Run Git commands."""
@@ -1090,31 +6027,5 @@ class CustomShell(cmd.Cmd):
         except Exception as e:
             print(f"Error: {e}")
 
-
- 
-
-
-
-
-
-    def handle_child_exit(self, signum, frame):
-        """Handle child process exit for background jobs."""
-        try:
-            while True:
-                pid, status = os.waitpid(-1, os.WNOHANG)
-                if pid == 0:
-                    break
-                job_id = None
-                for jid, cmd in self.background_jobs.items():
-                    if cmd.startswith(' '.join(frame.f_locals['args'])):
-                        job_id = jid
-                        break
-                if job_id is not None:
-                    del self.background_jobs[job_id]
-                    print(f"Background job {job_id} finished with status {status}")
-
-        except ChildProcessError:
-            pass
-
 if __name__ == "__main__":
     CustomShell().cmdloop()
@@ -0,0 +1,75 @@
+import os
+import socket
+import sys
+import threading
+import time
+
+import paramiko
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import shell  # noqa: E402
+
+PASSWORD = 'secret'
+
+
+@pytest.fixture
+def custom_shell(tmp_path, monkeypatch):
+    """A CustomShell whose home directory and working directory are inside tmp_path."""
+    home = tmp_path / 'home'
+    home.mkdir()
+    monkeypatch.setenv('HOME', str(home))
+    monkeypatch.chdir(tmp_path)
+    return shell.CustomShell()
+
+
+class PasswordServer(paramiko.ServerInterface):
+    """Accepts one password and runs 'echo'-like exec requests."""
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL if password == PASSWORD else paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        def reply():
+            # Give paramiko time to acknowledge the request before the channel closes.
+            time.sleep(0.05)
+            channel.sendall(command + b'\n')
+            channel.sendall_stderr(b'to stderr\n')
+            channel.send_exit_status(3)
+            channel.close()
+        threading.Thread(target=reply, daemon=True).start()
+        return True
+
+
+@pytest.fixture(scope='module')
+def ssh_server():
+    """An SSH server on a local port that records every transport it accepts."""
+    host_key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+    transports = []
+
+    def serve():
+        while True:
+            try:
+                client, _ = listener.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(host_key)
+            transport.start_server(server=PasswordServer())
+            transports.append(transport)
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield f"tester@127.0.0.1:{listener.getsockname()[1]}", transports
+    listener.close()
+    for transport in transports:
+        transport.close()
@@ -0,0 +1,41 @@
+import os
+import tarfile
+
+import pytest
+
+import shell
+
+
+@pytest.fixture
+def tree(tmp_path):
+    os.makedirs(tmp_path / 'tree' / 'sub')
+    (tmp_path / 'tree' / 'one.txt').write_text('one')
+    (tmp_path / 'tree' / 'sub' / 'two.txt').write_text('two')
+    return tmp_path / 'tree'
+
+
+def test_create_replaces_the_archive_only_when_complete(custom_shell, tree, tmp_path, capsys, monkeypatch):
+    custom_shell.onecmd('archive create tree/backup.tar.gz tree')
+    with tarfile.open(tree / 'backup.tar.gz') as archive:
+        names = archive.getnames()
+    assert names == ['tree', 'tree/one.txt', 'tree/sub', 'tree/sub/two.txt']
+    original = (tree / 'backup.tar.gz').read_bytes()
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(shell.tarfile.TarFile, 'add', fail)
+    custom_shell.onecmd('archive create tree/backup.tar.gz tree')
+
+    assert 'Error: disk full' in capsys.readouterr().out
+    assert (tree / 'backup.tar.gz').read_bytes() == original
+    assert sorted(os.listdir(tree)) == ['backup.tar.gz', 'one.txt', 'sub']
+
+
+def test_extract_without_directory_after_c_prints_usage(custom_shell, tree, capsys):
+    custom_shell.onecmd('archive create x.tar tree')
+    capsys.readouterr()
+
+    custom_shell.onecmd('archive extract x.tar -C')
+
+    assert capsys.readouterr().out.startswith('Usage: archive')
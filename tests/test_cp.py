@@ -0,0 +1,51 @@
+import os
+import shutil
+
+import pytest
+
+import shell
+
+
+def test_copy_file_onto_itself_keeps_the_data(tmp_path):
+    source = tmp_path / 'a.txt'
+    source.write_bytes(b'data' * 1000)
+    with pytest.raises(shutil.SameFileError):
+        shell.copy_file(str(source), str(source))
+    assert source.read_bytes() == b'data' * 1000
+
+
+def test_copy_file_returns_bytes_copied(tmp_path):
+    source = tmp_path / 'a.txt'
+    source.write_bytes(b'x' * 300000)
+    assert shell.copy_file(str(source), str(tmp_path / 'b.txt')) == 300000
+    assert (tmp_path / 'b.txt').read_bytes() == b'x' * 300000
+
+
+@pytest.mark.parametrize('destination', ['a.txt', '.'])
+def test_cp_same_file_is_skipped(custom_shell, tmp_path, capsys, destination):
+    (tmp_path / 'a.txt').write_text('hello\n')
+    custom_shell.do_cp(f'a.txt {destination}')
+    assert (tmp_path / 'a.txt').read_text() == 'hello\n'
+    output = capsys.readouterr().out
+    assert 'are the same file' in output
+    assert 'Copied 0 files' in output
+
+
+def test_cp_symlink_onto_itself_keeps_the_link(custom_shell, tmp_path):
+    (tmp_path / 'a.txt').write_text('hello\n')
+    os.symlink('a.txt', tmp_path / 'link')
+    custom_shell.do_cp('link link')
+    assert os.readlink(tmp_path / 'link') == 'a.txt'
+
+
+def test_cp_reports_special_files_instead_of_reading_them(custom_shell, tmp_path, capsys):
+    os.makedirs(tmp_path / 'tree')
+    (tmp_path / 'tree' / 'file.txt').write_text('data')
+    os.mkfifo(tmp_path / 'tree' / 'pipe')
+
+    custom_shell.do_cp('-r tree copy')
+
+    output = capsys.readouterr().out
+    assert "is a named pipe" in output
+    assert (tmp_path / 'copy' / 'file.txt').read_text() == 'data'
+    assert not (tmp_path / 'copy' / 'pipe').exists()
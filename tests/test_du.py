@@ -0,0 +1,28 @@
+import os
+
+import shell
+
+
+def make_tree(root, size):
+    (root / 'tree').mkdir(parents=True)
+    (root / 'tree' / 'data').write_bytes(b'x' * size)
+    os.utime(root / 'tree', ns=(1_000_000_000, 1_000_000_000))
+
+
+def test_cache_is_keyed_on_the_absolute_path(tmp_path, monkeypatch):
+    make_tree(tmp_path / 'small', 10)
+    make_tree(tmp_path / 'large', 1024 * 1024)
+    cache = shell.DirectorySizeCache(str(tmp_path / 'cache.db'))
+    try:
+        monkeypatch.chdir(tmp_path / 'small')
+        small = shell.disk_usage('tree', cache)
+        monkeypatch.chdir(tmp_path / 'large')
+        large = shell.disk_usage('tree', cache)
+        again = shell.disk_usage(str(tmp_path / 'large' / 'tree'), cache)
+    finally:
+        cache.close()
+
+    assert large.scanned == 1
+    assert large.totals['tree'] > small.totals['tree']
+    assert again.scanned == 0
+    assert again.totals[str(tmp_path / 'large' / 'tree')] == large.totals['tree']
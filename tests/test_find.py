@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def tree(tmp_path):
+    os.makedirs(tmp_path / 'tree' / 'data' / 'deep')
+    for name in ('data.txt', 'data/more.txt', 'data/deep/data.csv'):
+        (tmp_path / 'tree' / name).write_text(name)
+    os.symlink('data', tmp_path / 'tree' / 'data-link')
+    return tmp_path / 'tree'
+
+
+def find(custom_shell, capsys, arg):
+    custom_shell.do_find(arg)
+    return sorted(capsys.readouterr().out.splitlines())
+
+
+def test_name_form_lists_files_only(custom_shell, tree, capsys):
+    assert find(custom_shell, capsys, 'tree data') == ['tree/data.txt', 'tree/data/deep/data.csv']
+
+
+def test_name_with_options_matches_directories_too(custom_shell, tree, capsys):
+    assert find(custom_shell, capsys, 'tree data -maxdepth 1') == ['tree/data', 'tree/data-link', 'tree/data.txt']
+
+
+def test_maxdepth_zero_lists_nothing_below_the_directory(custom_shell, tree, capsys):
+    assert find(custom_shell, capsys, 'tree -maxdepth 0') == ["Nothing found in 'tree'."]
+
+
+def test_limit(custom_shell, tree, capsys):
+    assert find(custom_shell, capsys, 'tree -limit 0') == []
+    assert len(find(custom_shell, capsys, 'tree -limit 2')) == 2
+    assert find(custom_shell, capsys, 'tree -limit -1') == ['Invalid find option: -maxdepth and -limit must not be negative']
+
+
+def test_no_matches(custom_shell, tree, capsys):
+    assert find(custom_shell, capsys, 'tree -name "*.md"') == ["Nothing found in 'tree'."]
+    assert find(custom_shell, capsys, 'tree absent') == ["No files matching 'absent' found in 'tree'."]
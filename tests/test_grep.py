@@ -0,0 +1,26 @@
+import shell
+
+
+def test_grep_streams_large_output_from_pool_in_order(custom_shell, tmp_path, capfdbinary, monkeypatch):
+    monkeypatch.setattr(shell, 'GREP_WORKERS', 2)
+    lines = [b'match %d' % number for number in range(50000)]
+    (tmp_path / 'a.txt').write_bytes(b'\n'.join(lines) + b'\n')
+    (tmp_path / 'b.txt').write_bytes(b'nothing\nmatch b\n')
+
+    custom_shell.onecmd('grep match a.txt b.txt')
+
+    out = capfdbinary.readouterr().out
+    expected = b''.join(b'a.txt:' + line + b'\n' for line in lines) + b'b.txt:match b\n'
+    assert out == expected
+    assert custom_shell.last_status == 0
+
+
+def test_grep_missing_file_is_an_error(custom_shell, tmp_path, capsys):
+    (tmp_path / 'a.txt').write_text('match\n')
+
+    custom_shell.onecmd('grep match a.txt missing.txt')
+    assert 'File not found: missing.txt' in capsys.readouterr().out
+    assert custom_shell.last_status == 2
+
+    custom_shell.onecmd('grep absent a.txt')
+    assert custom_shell.last_status == 1
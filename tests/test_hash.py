@@ -0,0 +1,24 @@
+import hashlib
+
+
+def test_hash_prints_sha256sum_lines(custom_shell, tmp_path, capfd):
+    files = {'a.txt': b'alpha\n', 'b.txt': b'beta\n'}
+    for name, content in files.items():
+        (tmp_path / name).write_bytes(content)
+
+    custom_shell.onecmd('hash a.txt b.txt')
+
+    assert capfd.readouterr().out == ''.join(f"{hashlib.sha256(content).hexdigest()}  {name}\n"
+                                             for name, content in files.items())
+
+
+def test_dupes_finds_identical_files(custom_shell, tmp_path, capsys):
+    (tmp_path / 'data').mkdir()
+    for name, content in (('one', b'same' * 1000), ('two', b'same' * 1000), ('three', b'other' * 800)):
+        (tmp_path / 'data' / name).write_bytes(content)
+
+    custom_shell.onecmd('dupes data')
+
+    out = capsys.readouterr().out
+    assert '2 files of 3.9K:\n  data/one\n  data/two\n' in out
+    assert out.splitlines()[-1].startswith('1 duplicate sets, 3.9K reclaimable')
@@ -0,0 +1,24 @@
+def run(custom_shell, line):
+    line = custom_shell.precmd(line)
+    stop = custom_shell.onecmd(line)
+    return custom_shell.postcmd(stop, line)
+
+
+def test_history_records_status_and_starting_directory(custom_shell, tmp_path):
+    (tmp_path / 'sub').mkdir()
+
+    run(custom_shell, 'grep missing no-such-file')
+    run(custom_shell, 'cd sub')
+    custom_shell.history_writer.flush()
+
+    rows = {command: (cwd, status) for command, _, cwd, status in custom_shell.history_index.search('', limit=10)}
+    assert rows['grep missing no-such-file'][1] != 0
+    assert rows['cd sub'] == (str(tmp_path), 0)
+
+
+def test_replay_zero_runs_nothing(custom_shell, capsys):
+    custom_shell.command_history.append('pwd')
+
+    custom_shell.onecmd('replay 0')
+
+    assert capsys.readouterr().out.startswith('Invalid usage.')
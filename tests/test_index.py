@@ -0,0 +1,112 @@
+import os
+import time
+
+import pytest
+
+import shell
+
+
+@pytest.fixture
+def indexed(custom_shell, tmp_path, capsys, monkeypatch):
+    """An indexed tree whose directories all look untouched for a while, so the index is trusted."""
+    tree = tmp_path / 'tree'
+    os.makedirs(tree / 'a' / 'b')
+    for name in ('one.txt', 'a/two.txt', 'a/b/three.txt', 'a/b/notes.md'):
+        (tree / name).write_text(name)
+    os.symlink('one.txt', tree / 'link.txt')
+    past = time.time() - 100
+    for directory in (tree, tree / 'a', tree / 'a' / 'b'):
+        os.utime(directory, (past, past))
+    custom_shell.do_index('build tree')
+    capsys.readouterr()
+    return custom_shell
+
+
+def find(custom_shell, capsys, arg):
+    custom_shell.do_find(arg)
+    return sorted(capsys.readouterr().out.splitlines())
+
+
+def no_walk(*args, **kwargs):
+    raise AssertionError("find walked the tree although the index is fresh")
+
+
+def test_fresh_index_answers_find(indexed, capsys, monkeypatch):
+    monkeypatch.setattr(shell, 'walk_entries', no_walk)
+    assert find(indexed, capsys, 'tree -name "*.txt"') == [
+        'tree/a/b/three.txt', 'tree/a/two.txt', 'tree/link.txt', 'tree/one.txt']
+
+
+def test_stale_index_falls_back_to_walking(indexed, tmp_path, capsys):
+    (tmp_path / 'tree' / 'a' / 'new.txt').write_text('new')
+    assert 'tree/a/new.txt' in find(indexed, capsys, 'tree -name "*.txt"')
+    assert indexed.index_for('tree').stale('tree')
+    assert indexed.glob_from_index('tree/a/*.txt') is None
+
+
+def test_glob_uses_fresh_index(indexed):
+    assert sorted(indexed.glob_from_index('tree/a/b/*')) == ['tree/a/b/notes.md', 'tree/a/b/three.txt']
+
+
+def test_recently_changed_directory_is_not_trusted(custom_shell, tmp_path, capsys):
+    os.makedirs(tmp_path / 'tree')
+    custom_shell.do_index('build tree')
+    capsys.readouterr()
+    (tmp_path / 'tree' / 'late.txt').write_text('late')
+    assert find(custom_shell, capsys, 'tree -name "*.txt"') == ['tree/late.txt']
+
+
+def test_index_type_f_matches_regular_files_only(indexed, capsys, monkeypatch):
+    walked = find(indexed, capsys, 'tree -type f -name "*.txt" -prune none')
+    monkeypatch.setattr(shell, 'walk_entries', no_walk)
+    assert find(indexed, capsys, 'tree -type f -name "*.txt"') == walked
+    assert 'tree/link.txt' not in walked
+
+
+def test_index_regex_sees_the_same_paths_as_a_walk(indexed, capsys, monkeypatch):
+    walked = find(indexed, capsys, r'tree -regex "^tree/a/[^/]+\.txt$" -prune none')
+    assert walked == ['tree/a/two.txt']
+    monkeypatch.setattr(shell, 'walk_entries', no_walk)
+    assert find(indexed, capsys, r'tree -regex "^tree/a/[^/]+\.txt$"') == walked
+
+
+def test_index_legacy_form_lists_files_only(indexed, capsys, monkeypatch):
+    os.makedirs('tree/a/b/notes')
+    past = time.time() - 100
+    for directory in ('tree/a/b/notes', 'tree/a/b'):
+        os.utime(directory, (past, past))
+    indexed.do_index('update tree')
+    capsys.readouterr()
+    walked = find(indexed, capsys, 'tree notes -prune none')
+    monkeypatch.setattr(shell, 'walk_entries', no_walk)
+    assert find(indexed, capsys, 'tree notes') == ['tree/a/b/notes.md']
+    assert walked == ['tree/a/b/notes', 'tree/a/b/notes.md']
+
+
+def test_update_index_without_files(custom_shell, tmp_path, capsys):
+    os.makedirs(tmp_path / 'empty')
+    past = time.time() - 100
+    os.utime(tmp_path / 'empty', (past, past))
+    custom_shell.do_index('build empty')
+    capsys.readouterr()
+
+    custom_shell.do_index('update empty')
+
+    assert 'Error' not in capsys.readouterr().out
+    assert custom_shell.index_for('empty').children('empty') == []
+
+
+def test_stale_checks_the_whole_tree_once_per_interval(indexed, tmp_path, monkeypatch):
+    index = indexed.index_for('tree')
+    checked = []
+    changed = index.changed
+    monkeypatch.setattr(index, 'changed', lambda path, *args: checked.append(path) or changed(path, *args))
+
+    assert not index.stale('tree')
+    assert len(checked) == 3
+    assert not index.stale('tree')
+    assert len(checked) == 4
+
+    (tmp_path / 'tree' / 'a' / 'b' / 'new.txt').write_text('new')
+    monkeypatch.setattr(shell, 'INDEX_VERIFY_INTERVAL', 0)
+    assert index.stale('tree')
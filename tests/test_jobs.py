@@ -0,0 +1,76 @@
+import os
+import signal
+import subprocess
+
+import pytest
+
+import shell
+
+
+@pytest.fixture
+def jobs():
+    table = shell.JobTable()
+    handler = signal.getsignal(signal.SIGCHLD)
+    yield table
+    signal.signal(signal.SIGCHLD, handler)
+    table.close()
+
+
+def test_finished_jobs_are_reaped_with_their_status(jobs):
+    exited = jobs.start(['sh', '-c', 'echo out; exit 3'])
+    killed = jobs.start(['sleep', '30'])
+    jobs.signal(killed, signal.SIGKILL)
+
+    assert jobs.wait([exited, killed], timeout=10)
+    assert [job.describe() for job in jobs.collect()] == ['Exit 3', 'SIGKILL']
+    assert (exited.exit_status(), killed.exit_status()) == (3, 128 + signal.SIGKILL)
+    assert jobs.listing() == []
+
+
+def test_job_reaped_elsewhere_has_unknown_status(jobs):
+    process = subprocess.Popen(['true'])
+    process.wait()
+    job = shell.Job(1, process, 'true', os.devnull)
+
+    with jobs.lock:
+        jobs.update(job)
+
+    assert job.state == 'Done'
+    assert job.describe() == 'Unknown'
+    assert job.exit_status() == 127
+
+
+def test_sigchld_is_installed_when_pidfds_fail_after_the_watcher_started(jobs, monkeypatch):
+    jobs.start(['true'])
+    assert jobs.watcher is not None
+
+    def no_pidfds(pid):
+        raise OSError("pidfd_open not supported")
+
+    monkeypatch.setattr(os, 'pidfd_open', no_pidfds, raising=False)
+    job = jobs.start(['sh', '-c', 'exit 5'])
+
+    assert signal.getsignal(signal.SIGCHLD) == jobs.wake
+    assert jobs.wait([job], timeout=10)
+    assert job.exit_status() == 5
+
+
+def test_wait_and_report(custom_shell, capsys):
+    custom_shell.onecmd('sh -c "exit 4" &')
+    custom_shell.onecmd('wait')
+
+    out = capsys.readouterr().out
+    assert 'Exit 4' in out
+    assert custom_shell.last_status == 4
+    custom_shell.jobs.close()
+
+
+def test_report_survives_a_missing_spool_file(custom_shell, capsys):
+    job = custom_shell.jobs.start(['true'])
+    assert custom_shell.jobs.wait([job], timeout=10)
+    os.remove(job.spool)
+
+    custom_shell.postcmd(False, '')
+
+    assert f"[{job.number}]  Done" in capsys.readouterr().out
+    custom_shell.jobs.close()
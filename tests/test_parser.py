@@ -0,0 +1,158 @@
+import os
+
+import pytest
+
+import shell
+
+
+@pytest.mark.parametrize('line, tokens', [
+    ('echo hello  world', [('word', 'echo'), ('word', 'hello'), ('word', 'world')]),
+    ("echo 'a | b' \"c > d\"", [('word', 'echo'), ('word', 'a | b'), ('word', 'c > d')]),
+    ('echo a\\|b x\\>y', [('word', 'echo'), ('word', 'a|b'), ('word', 'x>y')]),
+    ('echo "say \\"hi\\" \\n"', [('word', 'echo'), ('word', 'say "hi" \\n')]),
+    ("echo ''", [('word', 'echo'), ('word', '')]),
+    ('ls|wc', [('word', 'ls'), ('op', '|'), ('word', 'wc')]),
+    ('cmd 2>&1', [('word', 'cmd'), ('op', '2>&'), ('word', '1')]),
+    ('cmd 2>>log', [('word', 'cmd'), ('op', '2>>'), ('word', 'log')]),
+    ('cmd a2>f', [('word', 'cmd'), ('word', 'a2'), ('op', '>'), ('word', 'f')]),
+    ("cmd '2'>f", [('word', 'cmd'), ('word', '2'), ('op', '>'), ('word', 'f')]),
+    ('cat <<< "two words"', [('word', 'cat'), ('op', '<<<'), ('word', 'two words')]),
+    ('cmd &>> log &', [('word', 'cmd'), ('op', '&>>'), ('word', 'log'), ('op', '&')]),
+])
+def test_tokenize_command_line(line, tokens):
+    assert shell.tokenize_command_line(line) == tokens
+
+
+@pytest.mark.parametrize('line', ["echo 'open", 'echo "open', 'echo "a\\"'])
+def test_tokenize_rejects_unclosed_quotes(line):
+    with pytest.raises(ValueError, match='No closing quotation'):
+        shell.tokenize_command_line(line)
+
+
+@pytest.mark.parametrize('line, stages, background', [
+    ('', [], False),
+    ('ls -l', [(['ls', '-l'], [])], False),
+    ('sleep 1 &', [(['sleep', '1'], [])], True),
+    ('ls | sort -r | head', [(['ls'], []), (['sort', '-r'], []), (['head'], [])], False),
+    ('cmd > out', [(['cmd'], [(1, '>', 'out')])], False),
+    ('cmd >> out', [(['cmd'], [(1, '>>', 'out')])], False),
+    ('cmd < in', [(['cmd'], [(0, '<', 'in')])], False),
+    ('cmd 2> err', [(['cmd'], [(2, '>', 'err')])], False),
+    ('cmd > out 2>&1', [(['cmd'], [(1, '>', 'out'), (2, '>&', '1')])], False),
+    ('cmd 2>&1 > out', [(['cmd'], [(2, '>&', '1'), (1, '>', 'out')])], False),
+    ('cmd &> out', [(['cmd'], [(1, '>', 'out'), (2, '>&', '1')])], False),
+    ('cmd &>> out', [(['cmd'], [(1, '>>', 'out'), (2, '>&', '1')])], False),
+    ('cmd >&2', [(['cmd'], [(1, '>&', '2')])], False),
+    ('cat <<< hi', [(['cat'], [(0, '<<<', 'hi')])], False),
+    ('> out cmd arg', [(['cmd', 'arg'], [(1, '>', 'out')])], False),
+    ('a 2>&1 | b > out &', [(['a'], [(2, '>&', '1')]), (['b'], [(1, '>', 'out')])], True),
+])
+def test_parse_command_line(line, stages, background):
+    assert shell.parse_command_line(line) == (stages, background)
+
+
+@pytest.mark.parametrize('line', ['| wc', 'ls |', 'ls | | wc', 'ls >', 'ls > | wc', 'ls & wc', '> out', '2>&1'])
+def test_parse_command_line_rejects_syntax_errors(line):
+    with pytest.raises(ValueError, match='syntax error'):
+        shell.parse_command_line(line)
+
+
+def close_all(opened):
+    for fd in opened:
+        os.close(fd)
+
+
+def test_redirections_are_applied_left_to_right(tmp_path):
+    path = str(tmp_path / 'out')
+
+    # > out 2>&1: both descriptors go to the file
+    fds = {0: None, 1: None, 2: None}
+    opened = shell.apply_redirections([(1, '>', path), (2, '>&', '1')], fds)
+    try:
+        assert fds[1] == fds[2] == opened[0]
+    finally:
+        close_all(opened)
+
+    # 2>&1 > out: stderr keeps the shell's stdout, only stdout goes to the file
+    fds = {0: None, 1: None, 2: None}
+    opened = shell.apply_redirections([(2, '>&', '1'), (1, '>', path)], fds)
+    try:
+        assert fds[2] == 1
+        assert fds[1] == opened[0]
+    finally:
+        close_all(opened)
+
+
+def test_redirections_truncate_and_append(tmp_path):
+    path = tmp_path / 'out'
+    path.write_bytes(b'old\n')
+
+    for operator, data in (('>>', b'more\n'), ('>', b'new\n'), ('>>', b'last\n')):
+        fds = {0: None, 1: None, 2: None}
+        opened = shell.apply_redirections([(1, operator, str(path))], fds)
+        os.write(fds[1], data)
+        close_all(opened)
+
+    assert path.read_bytes() == b'new\nlast\n'
+
+
+def test_here_string_is_fed_through_a_pipe():
+    fds = {0: None, 1: None, 2: None}
+    opened = shell.apply_redirections([(0, '<<<', 'two words')], fds)
+    try:
+        with os.fdopen(os.dup(fds[0]), 'rb') as pipe:
+            assert pipe.read() == b'two words\n'
+    finally:
+        close_all(opened)
+
+
+@pytest.mark.parametrize('redirection, message', [
+    ((3, '>', 'out'), 'unsupported file descriptor'),
+    ((2, '>&', 'x'), 'bad file descriptor'),
+    ((2, '>&', '7'), 'bad file descriptor'),
+])
+def test_bad_redirections_are_rejected(tmp_path, redirection, message):
+    fds = {0: None, 1: None, 2: None}
+    with pytest.raises(ValueError, match=message):
+        shell.apply_redirections([redirection], fds)
+
+
+def test_failed_redirection_closes_what_it_opened(tmp_path):
+    fds = {0: None, 1: None, 2: None}
+    before = len(os.listdir('/proc/self/fd'))
+
+    with pytest.raises(FileNotFoundError):
+        shell.apply_redirections([(1, '>', str(tmp_path / 'out')), (0, '<', str(tmp_path / 'missing'))], fds)
+
+    assert len(os.listdir('/proc/self/fd')) == before
+
+
+def test_builtin_output_is_appended(custom_shell, tmp_path, capfd):
+    custom_shell.onecmd('pwd >> out.txt')
+    custom_shell.onecmd('pwd >> out.txt')
+
+    assert (tmp_path / 'out.txt').read_text() == f"{tmp_path}\n" * 2
+    assert capfd.readouterr().out == ''
+
+
+def test_builtin_output_and_errors_share_a_file(custom_shell, tmp_path, capfd):
+    custom_shell.onecmd('pwd > out.txt 2>&1')
+
+    assert (tmp_path / 'out.txt').read_text() == f"{tmp_path}\n"
+    assert capfd.readouterr().out == ''
+
+
+def test_builtin_error_redirection_leaves_output_alone(custom_shell, tmp_path, capfd):
+    custom_shell.onecmd('pwd 2> err.txt')
+
+    assert capfd.readouterr().out == f"{tmp_path}\n"
+    assert (tmp_path / 'err.txt').read_text() == ''
+
+
+def test_builtin_reads_a_quoted_file_name(custom_shell, tmp_path, capfd):
+    (tmp_path / 'a | b.txt').write_text('piped name\n')
+
+    custom_shell.onecmd("cat 'a | b.txt' > out.txt")
+
+    assert (tmp_path / 'out.txt').read_text() == 'piped name\n'
+    assert custom_shell.last_status == 0
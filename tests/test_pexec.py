@@ -0,0 +1,34 @@
+import socket
+import time
+
+from conftest import PASSWORD
+
+
+def test_pexec_runs_on_every_host(custom_shell, ssh_server, capsys):
+    destination, _ = ssh_server
+    custom_shell.ssh_pool.connect(destination, PASSWORD)
+
+    custom_shell.onecmd(f'pexec -c {destination},{destination} hello')
+
+    out = capsys.readouterr().out
+    assert f"==> {destination}, {destination} (2 hosts, exit 3) <==\nhello\nto stderr\n" in out
+    assert custom_shell.last_status == 1
+    custom_shell.ssh_pool.close_all()
+
+
+def test_pexec_timeout_bounds_connecting(custom_shell, capsys):
+    # A server that accepts connections but never sends its SSH banner.
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    host = f"tester@127.0.0.1:{listener.getsockname()[1]}"
+
+    started = time.monotonic()
+    custom_shell.onecmd(f'pexec -t 0.5 {host} true')
+    elapsed = time.monotonic() - started
+    listener.close()
+
+    out = capsys.readouterr().out
+    assert f"timed out after 0.5s: {host}" in out
+    assert elapsed < 5
+    assert custom_shell.last_status == 1
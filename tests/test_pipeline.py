@@ -0,0 +1,115 @@
+import os
+
+import pytest
+
+import shell
+
+
+def test_builtin_output_is_redirected(custom_shell, tmp_path, capfd):
+    custom_shell.onecmd('pwd > out.txt')
+
+    assert (tmp_path / 'out.txt').read_text() == f"{tmp_path}\n"
+    assert capfd.readouterr().out == ''
+
+
+def test_builtin_heads_a_pipeline(custom_shell, tmp_path, capfd):
+    (tmp_path / 'b').write_text('')
+    (tmp_path / 'a').write_text('')
+
+    custom_shell.onecmd('ls | sort -r')
+
+    assert capfd.readouterr().out.split() == sorted(['a', 'b', 'home'], reverse=True)
+    assert custom_shell.pipestatus == [0, 0]
+
+
+def test_external_sort_runs_its_workers_from_a_pipeline_stage(custom_shell, tmp_path):
+    # Over 1 MiB with -S 1M, so runs are sorted on the process pool.
+    lines = [b'%07d' % ((number * 7919) % 300000) for number in range(300000)]
+    (tmp_path / 'big.txt').write_bytes(b'\n'.join(lines) + b'\n')
+
+    custom_shell.onecmd('cat big.txt | sort -S 1M > sorted.txt')
+
+    assert (tmp_path / 'sorted.txt').read_bytes() == b'\n'.join(sorted(lines)) + b'\n'
+    assert custom_shell.pipestatus == [0, 0]
+
+
+def test_builtin_running_a_program_is_replaced_by_that_program(custom_shell, capfd):
+    custom_shell.onecmd('ps | wc -l')
+
+    out = capfd.readouterr().out
+    assert len(out.splitlines()) == 1
+    assert int(out) > 1
+
+
+def test_builtin_running_a_program_is_redirected(custom_shell, tmp_path, capfd):
+    custom_shell.onecmd('uname > u.txt')
+
+    assert (tmp_path / 'u.txt').read_text().strip()
+    assert capfd.readouterr().out == ''
+
+
+def test_builtin_with_redirected_stdin_reads_it(custom_shell, tmp_path, capfd):
+    (tmp_path / 'f.txt').write_text('first\nsecond\n')
+
+    custom_shell.onecmd('cat < f.txt')
+    assert capfd.readouterr().out == 'first\nsecond\n'
+
+    custom_shell.onecmd('head -n 1 < f.txt')
+    assert capfd.readouterr().out == 'first\n'
+
+    custom_shell.onecmd('cat <<< hello')
+    assert capfd.readouterr().out == 'hello\n'
+
+
+def test_stage_that_cannot_start_gets_127_and_the_rest_run(custom_shell, tmp_path, capfd):
+    custom_shell.onecmd("true | no-such-command-xyz | wc -l > count.txt")
+
+    assert custom_shell.pipestatus == [0, 127, 0]
+    assert custom_shell.last_status == 0
+    assert (tmp_path / 'count.txt').read_text().strip() == '0'
+    assert 'no-such-command-xyz' in capfd.readouterr().out
+
+    custom_shell.onecmd("true | no-such-command-xyz")
+    assert custom_shell.pipestatus == [0, 127]
+    assert custom_shell.last_status == 127
+
+
+@pytest.mark.parametrize('line, expected', [
+    ('echo $NAME', 'echo world'),
+    ('echo ${NAME}s', 'echo worlds'),
+    ('echo $NAMEs', 'echo '),
+    ('echo $UNSET_XYZ.', 'echo .'),
+    ('echo ${UNSET_XYZ:-fallback}', 'echo fallback'),
+    ('echo ${EMPTY:-fallback}', 'echo fallback'),
+    ('echo ${NAME:-fallback}', 'echo world'),
+    ('echo $?', 'echo 3'),
+    ('echo $$', f'echo {os.getpid()}'),
+    ('echo $NAME$NAME', 'echo worldworld'),
+    ("echo '$NAME'", "echo '$NAME'"),
+    ('echo "$NAME"', 'echo "world"'),
+    ('echo "it\'s $NAME"', 'echo "it\'s world"'),
+    ('echo "\'$NAME\'"', 'echo "\'world\'"'),
+    ("echo \"'$NAME'\"", "echo \"'world'\""),
+    ('echo \\$NAME', 'echo \\$NAME'),
+    ('echo \\\\$NAME', 'echo \\\\world'),
+    ('echo $ 5$', 'echo $ 5$'),
+    ('echo $1', 'echo $1'),
+    ('echo $TRICKY', 'echo $NAME ${NAME} $?'),
+    ('echo ${TRICKY}', 'echo $NAME ${NAME} $?'),
+    ("echo 'unclosed $NAME", "echo 'unclosed $NAME"),
+])
+def test_expand_variables(monkeypatch, line, expected):
+    monkeypatch.setenv('NAME', 'world')
+    monkeypatch.setenv('EMPTY', '')
+    monkeypatch.setenv('TRICKY', '$NAME ${NAME} $?')
+    monkeypatch.delenv('UNSET_XYZ', raising=False)
+
+    assert shell.expand_variables(line, 3) == expected
+
+
+def test_expanded_values_are_used_as_they_are(custom_shell, tmp_path, monkeypatch):
+    monkeypatch.setenv('TARGET', '$HOME.txt')
+
+    custom_shell.onecmd(custom_shell.precmd('pwd > $TARGET'))
+
+    assert (tmp_path / '$HOME.txt').read_text() == f"{tmp_path}\n"
@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+import shell
+
+
+def make_tree(root):
+    for directory in ('a/b/c', 'd'):
+        os.makedirs(root / directory)
+    for name in ('top.txt', 'a/one.txt', 'a/b/two.txt', 'a/b/c/three.txt', 'd/four.txt'):
+        (root / name).write_text(name)
+
+
+def test_remove_tree_removes_everything(tmp_path):
+    make_tree(tmp_path / 'tree')
+    removed, errors = shell.remove_tree(str(tmp_path / 'tree'))
+    assert errors == []
+    assert removed == 10
+    assert not os.path.exists(tmp_path / 'tree')
+
+
+@pytest.mark.parametrize('queued', [True, False])
+def test_remove_tree_does_not_follow_a_swapped_in_symlink(tmp_path, monkeypatch, queued):
+    """Replacing a directory with a link mid-removal must not delete what the link points to."""
+    make_tree(tmp_path / 'tree')
+    victim = tmp_path / 'victim'
+    os.makedirs(victim / 'b' / 'c')
+    (victim / 'b' / 'keep.txt').write_text('keep')
+    (victim / 'b' / 'c' / 'keep.txt').write_text('keep')
+
+    def swap():
+        os.rename(tmp_path / 'tree' / 'a', tmp_path / 'moved')
+        os.symlink(victim, tmp_path / 'tree' / 'a')
+
+    if queued:
+        clear_entries = shell.TreeRemover.clear_entries
+
+        def clear_after_swap(self, directory):
+            if directory['path'].endswith(os.sep + 'a'):
+                swap()
+            return clear_entries(self, directory)
+        monkeypatch.setattr(shell.TreeRemover, 'clear_entries', clear_after_swap)
+    else:
+        # With no descriptors to spare, subdirectories are emptied inline.
+        monkeypatch.setattr(shell, 'REMOVE_OPEN_DIRECTORIES', 0)
+        empty_directory = shell.empty_directory
+
+        def empty_after_swap(fd, path, onremove=None):
+            if path.endswith(os.sep + 'a'):
+                swap()
+            return empty_directory(fd, path, onremove)
+        monkeypatch.setattr(shell, 'empty_directory', empty_after_swap)
+
+    shell.remove_tree(str(tmp_path / 'tree'))
+    assert (victim / 'b' / 'keep.txt').read_text() == 'keep'
+    assert (victim / 'b' / 'c' / 'keep.txt').read_text() == 'keep'
+    assert os.listdir(tmp_path / 'moved') == []
+
+
+@pytest.mark.parametrize('flags', ['-r', '-fr', '-rf -v', '-R -f'])
+def test_rm_accepts_combined_flags(custom_shell, tmp_path, capsys, flags):
+    make_tree(tmp_path / 'tree')
+    custom_shell.do_rm(f'{flags} tree')
+    assert not os.path.exists(tmp_path / 'tree')
+    assert 'removed successfully' in capsys.readouterr().out
+
+
+def test_rm_force_ignores_missing_files(custom_shell, capsys):
+    custom_shell.do_rm('-f missing.txt')
+    assert capsys.readouterr().out == ''
+    custom_shell.do_rm('-x missing.txt')
+    assert 'invalid option' in capsys.readouterr().out
+
+
+def test_rm_refuses_directories_without_r(custom_shell, tmp_path, capsys):
+    make_tree(tmp_path / 'tree')
+    custom_shell.do_rm('tree tree/top.txt')
+    assert "cannot remove 'tree': Is a directory" in capsys.readouterr().out
+    assert os.path.isdir(tmp_path / 'tree')
+    assert not os.path.exists(tmp_path / 'tree' / 'top.txt')
+
+
+def test_rm_verbose_lists_every_entry(custom_shell, tmp_path, capsys):
+    make_tree(tmp_path / 'tree')
+    custom_shell.do_rm('-rv tree')
+    removed = [line for line in capsys.readouterr().out.splitlines() if line.startswith('removed ')]
+    assert len(removed) == 10
+    assert "removed 'tree/a/b/c/three.txt'" in removed
+    assert removed[-1] == "removed 'tree'"
+
+
+def test_rm_async_reports_errors(custom_shell, tmp_path, capsys, monkeypatch):
+    make_tree(tmp_path / 'tree')
+    monkeypatch.setattr(shell, 'remove_tree', lambda root: (3, [f"'{root}/x': Permission denied"]))
+    custom_shell.do_rm('-r --async tree')
+    for thread in [thread for thread in shell.threading.enumerate() if thread.name == 'rm tree']:
+        thread.join()
+    capsys.readouterr()
+
+    custom_shell.postcmd(False, '')
+
+    out = capsys.readouterr().out
+    assert "Permission denied" in out
+    assert "background removal of 'tree' finished: 3 entries removed, 1 error." in out
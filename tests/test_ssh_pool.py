@@ -0,0 +1,64 @@
+import time
+
+import paramiko
+import pytest
+
+import shell
+from conftest import PASSWORD
+
+def run(client, command):
+    output, errors = [], []
+    status = shell.run_remote_command(client, command, output.append, errors.append, timeout=10)
+    return status, b''.join(output), b''.join(errors)
+
+
+def test_connections_are_reused(ssh_server):
+    destination, transports = ssh_server
+    pool = shell.SSHPool()
+    before = len(transports)
+    pool.connect(destination, PASSWORD)
+    with pool.client(destination) as first, pool.client(destination) as second:
+        assert first is second
+        assert run(first, 'hello') == (3, b'hello\n', b'to stderr\n')
+    assert len(transports) == before + 1
+    pool.close_all()
+
+
+def test_evicted_connection_reconnects_with_remembered_password(ssh_server):
+    destination, transports = ssh_server
+    pool = shell.SSHPool(keepalive=0.1, idle_timeout=0.2)
+    pool.connect(destination, PASSWORD)
+    key = shell.destination_key(destination)
+    deadline = time.monotonic() + 5
+    while key in pool.connections and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert key not in pool.connections, "idle connection was not evicted"
+
+    before = len(transports)
+    with pool.client(destination) as client:
+        assert run(client, 'again')[1] == b'again\n'
+    assert len(transports) == before + 1
+    pool.close_all()
+
+
+def test_dead_connection_is_replaced(ssh_server):
+    destination, transports = ssh_server
+    pool = shell.SSHPool()
+    pool.connect(destination, PASSWORD)
+    transports[-1].close()
+    deadline = time.monotonic() + 5
+    while shell.transport_alive(pool.connections[shell.destination_key(destination)]['client']):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    with pool.client(destination) as client:
+        assert run(client, 'revived')[1] == b'revived\n'
+    pool.close_all()
+
+
+def test_disconnect_forgets_the_password(ssh_server):
+    destination, _ = ssh_server
+    pool = shell.SSHPool()
+    key = pool.connect(destination, PASSWORD)
+    assert pool.close(key, forget=True)
+    with pytest.raises(paramiko.SSHException):
+        pool.connect(destination)